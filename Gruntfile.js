@@ -67,6 +67,10 @@ module.exports = function (grunt) {
         cwd: "../../",
         command: exec_web2py_script("private/background_tasks.py"),
       },
+      build_tree_snapshots: {
+        cwd: "../../",
+        command: exec_web2py_script("private/build_tree_snapshots.py"),
+      },
       db_fixtures: {
         command: function () {
             // Either accept a list of test filenames, or work it out ourselves and run all tests
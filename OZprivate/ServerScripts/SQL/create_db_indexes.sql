@@ -37,6 +37,7 @@ call MakeFullUnicode('images_by_ott', 'rights');
 call MakeFullUnicode('images_by_ott', 'licence');
 call MakeFullUnicode('images_by_name', 'rights');
 call MakeFullUnicode('images_by_name', 'licence');
+call MakeFullUnicode('ott_details', 'vernacular');
 
 # note make sure that the name column in vernacular_by_name and the name column in ordered_leaves and ordered_nodes are of the same character set otherwise search can get incredibly slow even with indexes.
 
@@ -233,6 +234,15 @@ CREATE INDEX category_index      ON tree_startpoints (category);
 DROP   INDEX pi_index            ON tree_startpoints;
 CREATE INDEX pi_index            ON tree_startpoints (partner_identifier);
 
+DROP   INDEX ott_lang_index      ON ott_details;
+CREATE UNIQUE INDEX ott_lang_index ON ott_details (ott, lang_primary);
+
+DROP   INDEX node_position_index ON popular_leaves;
+CREATE UNIQUE INDEX node_position_index ON popular_leaves (node_id, position);
+
+DROP   INDEX node_price_position_index ON sponsor_leaves;
+CREATE UNIQUE INDEX node_price_position_index ON sponsor_leaves (node_id, price, position);
+
 # The following are the indexes for ordered leaves & ordered nodes, useful to re-do after a new tree is imported 
 
 DROP   INDEX price_index         ON ordered_leaves;
@@ -289,8 +299,9 @@ CREATE INDEX raw_pop_index       ON ordered_leaves (raw_popularity);
 DROP   INDEX pop_index           ON ordered_nodes;
 CREATE INDEX pop_index           ON ordered_nodes (popularity);
 
+# includes id so that API/children_of_OTT can page through leaves in popularity order from a cursor
 DROP   INDEX pop_index           ON ordered_leaves;
-CREATE INDEX pop_index           ON ordered_leaves (popularity);
+CREATE INDEX pop_index           ON ordered_leaves (popularity, id);
 
 DROP   INDEX poprank_index       ON ordered_leaves;
 CREATE INDEX poprank_index       ON ordered_leaves (popularity_rank);
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 '''
 Looks for EoL ids in a database table, finds the least recently updated ones, and 
-gradually queries them, 15 ids at a time.
+gradually queries them, 15 ids at a time. Several batches of ids are looked up in parallel
+(--threads), with the total rate of calls to the EoL API limited by --requests_per_second.
+Taxa recently inspected on OneZoom (in the eol_inspected table) are checked between batches.
 
 queries leaves for images and common names, and nodes for just common names
 
@@ -12,6 +14,8 @@ our own algorithm to percolate images to higher levels.
 test with e.g. for humans, 7 spot ladybird, and placental mammals
 
 ./EoLQueryPicsNames.py -ott 770315 343294 683263
+
+To test against a local server that mimics the EoL API, pass e.g. --api_url http://localhost:8000/api
 '''
 
 import os
@@ -26,6 +30,8 @@ import html
 import argparse
 import codecs
 import logging
+import threading
+import concurrent.futures
 from collections import OrderedDict
 from datetime import datetime
 from requests.packages.urllib3.util.retry import Retry
@@ -33,7 +39,7 @@ from requests.adapters import HTTPAdapter
 from itertools import islice
 
 ## Local packages
-from getEOL_crops import subdir_name, get_credit, get_file_from_json_struct, convert_rating
+from getEOL_crops import subdir_name, thumb_dir, get_credit, get_file_from_json_struct, crop_images, convert_rating
 # to get globals from ../../../models/_OZglobals.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir, "models")))
 from _OZglobals import src_flags, eol_inspect_via_flags, image_status_labels
@@ -57,6 +63,57 @@ name_length_chars = 190
 loop_starttime = 0
 loop_num=0
 cache_ttl_hack = random.randint(1000, 50000)
+cache_ttl_lock = threading.Lock()
+http_sessions = threading.local()
+
+def next_cache_ttl():
+    """
+    Return a different cache_ttl (cycling through 1000-50000 secs) for each call to the EoL API, so that we
+    don't get cached results. As this is called from several threads, the counter is updated under a lock.
+    """
+    global cache_ttl_hack
+    with cache_ttl_lock:
+        cache_ttl_hack = cache_ttl_hack + 1 if cache_ttl_hack<50000 else 1000
+        return cache_ttl_hack
+
+class TokenBucket:
+    """
+    A thread-safe rate limiter. Each call to acquire() takes a token from the bucket, waiting if necessary.
+    The bucket holds up to `burst` tokens, and is refilled at `rate` tokens per second.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        #hold the lock while waiting, so that waiting threads are served in turn
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+def http_session():
+    """
+    Return an http session for this thread (requests sessions should not be shared between threads),
+    which retries on server errors
+    """
+    if not hasattr(http_sessions, 'session'):
+        s = requests.Session()
+        retries = Retry(total=args.retries,
+                        backoff_factor=1,
+                        status_forcelist=[ 429, 500, 502, 503, 504 ]) #waits for any Retry-After given by the server
+        s.mount('https://', HTTPAdapter(max_retries=retries))
+        s.mount('http://', HTTPAdapter(max_retries=retries)) #e.g. for testing against a local server
+        http_sessions.session = s
+    return http_sessions.session
 
 def store_vote_ratings_in_bytes(ratings):
     """
@@ -86,7 +143,6 @@ def lookup_and_save_bespoke_EoL_images(eol_dataobject_to_ott, sess, API_key, db_
     loop_seconds=loop_seconds or 5.0 #don't mind blatting EoL for a small set of bespoke images
     global loop_num
     global loop_starttime
-    global cache_ttl_hack
 
     #sort this in case we have multiple doIDs for a single ott (e.g. a public domain one)
     ott2eol = {ott:[] for ott in eol_dataobject_to_ott.values()}
@@ -103,13 +159,12 @@ def lookup_and_save_bespoke_EoL_images(eol_dataobject_to_ott, sess, API_key, db_
                     logger.info("Waiting {} seconds so that next query occurs at least {} seconds later".format(wait, loop_seconds))
                     time.sleep(wait)
                 loop_starttime = time.time()
-                url = "https://eol.org/api/data_objects/1.0/{}.json".format(eol_doID); #see http://eol.org/api/docs/pages
-                cache_ttl_hack = cache_ttl_hack + 1 if cache_ttl_hack<50000 else 1000
+                url = "{}/data_objects/1.0/{}.json".format(args.api_url, eol_doID); #see http://eol.org/api/docs/pages
                 pages_params = {
                     'key'            : API_key,
                     'taxonomy'       : 'false',
                     'language'       : 'en',
-                    'cache_ttl'      : cache_ttl_hack, #only cache for X secs
+                    'cache_ttl'      : next_cache_ttl(), #only cache for X secs
                 }
                 
                 #NB we must replace all rows of images for this OTTid
@@ -183,42 +238,23 @@ def lookup_and_save_bespoke_EoL_images(eol_dataobject_to_ott, sess, API_key, db_
 
 
 
-def lookup_and_save_auto_EoL_info(eol_page_to_ott, sess, API_key, db_connection, 
-                             images_table, names_table, loop_seconds=None):
+def query_EoL_pages(eol_page_to_ott, API_key, get_images, limiter):
     '''
-    Given a mapping of EOL to OTT ids, call the EoL batch API for all these EOL ids to get best images and vernacular names.
-    If images_table is none, then only look for (and save) vernacular names. Save the updated time both in the 
-    images, and names tables. If there are no EoL ids returned for an OTT, we should delete these entries from the DB
-    
-    This should return None on failure, otherwise a dict with keys for the EoL ids that have been updated, and values 
-    for the potentially new eol IDs returns from the api (these are usually the same as the keys). If the API has
-    returned "unavailable page id", then the value will be None, indicating we should flag up the "not_available" field in eol_updated
-    
-    We also put a delay in here of loop_seconds to avoid overloading the EoL API.
+    Call the EoL batch API for all the EOL ids in eol_page_to_ott to get vernacular names and, if get_images is
+    True, the best verified, unreviewed, and public domain images. Each call to the API waits for a token from
+    the limiter (a TokenBucket), to avoid overloading the EoL API. This does not touch the database, so can be
+    called from a worker thread.
     
+    Returns a dict of the decoded json for each type of request ('verified', and if get_images is True,
+    'unreviewed' and 'pd'), or None on failure.
     '''
-    if len(eol_page_to_ott) == 0:
-        return {}
-    loop_seconds=loop_seconds or 60.0
-    global loop_num
-    global loop_starttime
-    global cache_ttl_hack
-    loop_num+=1
-    if time.time() - loop_starttime < loop_seconds:
-        wait = abs(loop_seconds - (time.time() - loop_starttime))
-        logger.info("Waiting {} seconds so that next query occurs at least {} seconds later".format(wait, loop_seconds))
-        time.sleep(wait)
-    loop_starttime = time.time()
-    logger.info("== Loop {} ({}) ==> list of eol_pageID: ottIDs to check for {} are {}".format(loop_num, time.asctime(time.localtime(loop_starttime)), "names" if images_table is None else "images & names", eol_page_to_ott))
     EOLids = list(eol_page_to_ott.keys())
-    OTTids = [int(eol_page_to_ott[k]) for k in EOLids]
-    url = "https://eol.org/api/pages/1.0.json" #see http://eol.org/api/docs/pages
-    cache_ttl_hack = cache_ttl_hack + 1 if cache_ttl_hack<50000 else 1000
+    url = "{}/pages/1.0.json".format(args.api_url) #see http://eol.org/api/docs/pages
     pages_params = {
         'batch'          : 'true',
         'id'             : ",".join([str(i) for i in EOLids]),
         'key'            : API_key,
-        'images_per_page': 1 if images_table is not None else 0,     # only look at the first image
+        'images_per_page': 1 if get_images else 0,     # only look at the first image
         'videos_per_page': 0,
         'sounds_per_page': 0,
         'maps_per_page'  : 0,
@@ -230,7 +266,7 @@ def lookup_and_save_auto_EoL_info(eol_page_to_ott, sess, API_key, db_connection,
         'synonyms'       : 'false',
         'taxonomy'       : 'false',
         'language'       : 'en',
-        'cache_ttl'      : cache_ttl_hack, #only cache for X secs. This doesn't work in the EoL API
+        'cache_ttl'      : next_cache_ttl(), #only cache for X secs. This doesn't work in the EoL API
         
         #the next 2 can be subsequently overwritten on a second pass if we also want to get unverified pictures: 
         #EOL says: If 'vetted' is given a value of '1', then only trusted content will be returned. 
@@ -240,130 +276,156 @@ def lookup_and_save_auto_EoL_info(eol_page_to_ott, sess, API_key, db_connection,
         'vetted'         : 1,
         'common_names'   : 'true'
     }
+    #On pass 1 we can get the common names as well as a verified image (vetted = 1)
+    passes = [('verified', {})]
+    if get_images:
+        passes.append(('unreviewed', {'vetted':3, 'common_names': 'false'})) #get unreviewed images (might be better quality). don't bother getting common names, we have those already
+        passes.append(('pd', {'vetted':2, 'common_names': 'false', 'licenses':'pd'})) #get pd images
 
+    sess = http_session()
     req={}
-    try:
-        #NB we must replace all rows of images for this OTTid
-        #On pass 1 we can get the common names as well as a verified image (vetted = 1)
+    for req_focus, new_params in passes:
+        pages_params.update(new_params)
         prepped = requests.Request('GET',url,params=pages_params).prepare()
-        logger.log(logging.EXTREME_DEBUG, "Getting {}".format(prepped.url))
-        time.sleep(1) #wait a second to avoid <Response [429]> timeouts
-        req['verified'] = sess.send(prepped, timeout=10)
-        if images_table:
-            pages_params.update({'vetted':3, 'common_names': 'false'}) #don't bother getting common names, we have those already
-            prepped = requests.Request('GET',url,params=pages_params).prepare() #get unreviewed images (might be better quality)
+        try:
+            limiter.acquire() #wait for our turn, to avoid <Response [429]> timeouts
             logger.log(logging.EXTREME_DEBUG, "Getting {}".format(prepped.url))
-            time.sleep(1) #wait a second to avoid <Response [429]> timeouts
-            req['unreviewed'] = sess.send(prepped, timeout=10)
+            response = sess.send(prepped, timeout=10)
+            req[req_focus] = response.json()
+            if not isinstance(req[req_focus], dict):
+                raise ValueError("Expected a json object")
+        except requests.exceptions.Timeout:
+            logger.warning('socket timed out - URL {}'.format(prepped.url))
+            return None
+        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as error:
+            logger.warning('Data not retrieved because {}\nURL: {}'.format(error, prepped.url))
+            return None
+        except requests.exceptions.RetryError:
+            logger.warning('Failed retrying - URL {}'.format(prepped.url))
+            return None
+        except ValueError:
+            #there is no valid json in the response
+            logger.warning("Problem interpreting json from the string returned from the EoL API for {} ({} request) so aborting the current OTT batch. Json string is\n {}".format(prepped.url, req_focus, response.text))
+            return None
+    return req
 
-            pages_params.update({'vetted':2, 'common_names': 'false', 'licenses':'pd'}) 
-            prepped = requests.Request('GET',url,params=pages_params).prepare() #get pd images
-            logger.log(logging.EXTREME_DEBUG, "Getting {}".format(prepped.url))
-            time.sleep(1) #wait a second to avoid <Response [429]> timeouts
-            req['pd'] = sess.send(prepped, timeout=10)
-    except requests.exceptions.Timeout:
-        logger.warning('socket timed out - URL {}'.format(prepped.url))
-        return None
-    except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as error:
-        logger.warning('Data not retrieved because {}\nURL: {}'.format(error, prepped.url))
-        return None
-    except requests.exceptions.RetryError:
-        logger.warning('Failed retrying - URL {}'.format(prepped.url))
-        return None
+
+def save_auto_EoL_info(eol_page_to_ott, req, db_connection, images_table, names_table):
+    '''
+    Given a mapping of EOL to OTT ids, and the results of querying the EoL batch API for these ids (as returned by
+    query_EoL_pages), save the vernacular names and download and save the best images. If images_table is None,
+    then only save vernacular names. Save the updated time both in the images, and names tables. If there are no
+    EoL ids returned for an OTT, we should delete these entries from the DB
+    
+    Returns a dict with keys for the EoL ids that have been updated, and values for the potentially new eol IDs
+    returned from the api (these are usually the same as the keys). If the API has returned "unavailable page id",
+    then the value will be None, indicating we should flag up the "not_available" field in eol_updated
+    '''
+    logger.info("== Saving {} for eol_pageID: ottIDs {} ==".format("names" if images_table is None else "images & names", eol_page_to_ott))
+    OTTids = [int(ott) for ott in eol_page_to_ott.values()]
 
     completed_eols = {} #will be returned
     db_cursor = db_connection.cursor()
     image_ranking_tables = {ott:{} for ott in OTTids} if images_table else {} #a set of 'tables', one for each ott, to help us choose which images to download/use for this OTT
     image_information = {} #accompanying information for each new data object ID saved into an image_ranking_tables
-    for req_focus, get_result in req.items():
-        try:
-            for EOLid, data in get_result.json().items():
-                logging.debug("Result for {}, EoL ID {}".format(req_focus, EOLid))
-                EOLid = int(EOLid)
-                if 'identifier' not in data:
-                    #this is probably "unavailable page id"
-                    completed_eols[EOLid] = None
-                else:
-                    completed_eols[EOLid]=int(data['identifier'])
-                    if EOLid  != completed_eols[EOLid]:
-                        logger.warning("The requested EOL id ({}) has changed to {}. The mapping of OTT to EOL ids may need updating".format(EOLid, data['identifier']))
-                    OTTid = eol_page_to_ott[EOLid]
-                    if 'vernacularNames' in data:
-                        #remove all the outdated names for this ott (don't care if there are none)
-                        sql = "DELETE FROM {0} WHERE ott={1} AND src={1};".format(names_table, subs)
-                        dummy = db_cursor.execute(sql, (OTTid,src_flags['eol']))
+    for req_focus, result in req.items():
+        for EOLid, data in result.items():
+            logging.debug("Result for {}, EoL ID {}".format(req_focus, EOLid))
+            EOLid = int(EOLid)
+            if 'identifier' not in data:
+                #this is probably "unavailable page id"
+                completed_eols[EOLid] = None
+            else:
+                completed_eols[EOLid]=int(data['identifier'])
+                if EOLid  != completed_eols[EOLid]:
+                    logger.warning("The requested EOL id ({}) has changed to {}. The mapping of OTT to EOL ids may need updating".format(EOLid, data['identifier']))
+                OTTid = eol_page_to_ott[EOLid]
+                if 'vernacularNames' in data:
+                    #remove all the outdated names for this ott (don't care if there are none)
+                    sql = "DELETE FROM {0} WHERE ott={1} AND src={1};".format(names_table, subs)
+                    dummy = db_cursor.execute(sql, (OTTid,src_flags['eol']))
             
-                        for nm in data['vernacularNames']:
-                            vernacular = html.unescape(nm['vernacularName'])
-                            try:
-                                #lang_primary is the 'primary' letter (lowercase) language, e.g. 'en', 'cmn'
-                                lang_primary = nm['language'].split('-')[0].lower()
-                                if len(vernacular) > name_length_chars:
-                                    logger.warning("vernacular name for EOL {} (ott {}) > {} characters.\nTruncating".format(EOLid, OTTid, name_length_chars))
-                                if lang_primary=='en' and (vernacular.startswith("A ") or vernacular.startswith("a ")):
-                                    #ignore english vernaculars like "a beetle" 
-                                    continue
-                                sql = "INSERT INTO {0} (ott, vernacular, lang_primary, lang_full, preferred, src, src_id, updated) VALUES ({1}, {1}, {1}, {1}, {1}, {1},{1}, {2});".format(names_table, subs, datetime_now)
-                                db_cursor.execute(sql, (OTTid, vernacular[:name_length_chars], lang_primary, nm['language'].lower(), 1 if nm.get('eol_preferred') else 0, src_flags['eol'],EOLid))
-                                logging.debug("Inserted vernacular ({}) for {}".format(vernacular, data['scientificName']))
-                            except:
-                                logger.warning("problem inserting vernacular name for EOL {} (ott {})".format(EOLid, OTTid))
-                        db_connection.commit()
-                    if images_table:
-                        if len(image_ranking_tables[OTTid]) == 0:
-                            #create the ranking table:
-                            # For each OTT, we want a table which contains the (up to) 3 new images specified by the API,
-                            # as well as the existing image entries for this OTT in our own database.
-                            # We will eventually rank these by image rating, but ensure that new images always have the highest 
-                            # rating if they have an appropriate image.
-                            # Making a table like this means that if we fail to get an image from EoL, we can get the next best
-                            #  ranked image, eventually reverting to the previously downloaded ones if necessary
-                            image_ranking_table = image_ranking_tables[OTTid] #this will contain the image ranking table
-                            db_fields1 = ['src', 'rating']
-                            db_fields2 = ['best_'+l for l in image_status_labels]
-                            sql="SELECT {0} FROM `{1}` WHERE ott = {2} AND src_id={2}".format(
-                                ",".join(db_fields1 + db_fields2),
-                                 images_table,
-                                 subs)
-                            db_cursor.execute(sql, (OTTid, src_flags['eol']))
+                    for nm in data['vernacularNames']:
+                        vernacular = html.unescape(nm['vernacularName'])
+                        try:
+                            #lang_primary is the 'primary' letter (lowercase) language, e.g. 'en', 'cmn'
+                            lang_primary = nm['language'].split('-')[0].lower()
+                            if len(vernacular) > name_length_chars:
+                                logger.warning("vernacular name for EOL {} (ott {}) > {} characters.\nTruncating".format(EOLid, OTTid, name_length_chars))
+                            if lang_primary=='en' and (vernacular.startswith("A ") or vernacular.startswith("a ")):
+                                #ignore english vernaculars like "a beetle" 
+                                continue
+                            sql = "INSERT INTO {0} (ott, vernacular, lang_primary, lang_full, preferred, src, src_id, updated) VALUES ({1}, {1}, {1}, {1}, {1}, {1},{1}, {2});".format(names_table, subs, datetime_now)
+                            db_cursor.execute(sql, (OTTid, vernacular[:name_length_chars], lang_primary, nm['language'].lower(), 1 if nm.get('eol_preferred') else 0, src_flags['eol'],EOLid))
+                            logging.debug("Inserted vernacular ({}) for {}".format(vernacular, data['scientificName']))
+                        except:
+                            logger.warning("problem inserting vernacular name for EOL {} (ott {})".format(EOLid, OTTid))
+                    db_connection.commit()
+                if images_table:
+                    if len(image_ranking_tables[OTTid]) == 0:
+                        #create the ranking table:
+                        # For each OTT, we want a table which contains the (up to) 3 new images specified by the API,
+                        # as well as the existing image entries for this OTT in our own database.
+                        # We will eventually rank these by image rating, but ensure that new images always have the highest 
+                        # rating if they have an appropriate image.
+                        # Making a table like this means that if we fail to get an image from EoL, we can get the next best
+                        #  ranked image, eventually reverting to the previously downloaded ones if necessary
+                        image_ranking_table = image_ranking_tables[OTTid] #this will contain the image ranking table
+                        db_fields1 = ['src', 'rating']
+                        db_fields2 = ['best_'+l for l in image_status_labels]
+                        sql="SELECT {0} FROM `{1}` WHERE ott = {2} AND src_id={2}".format(
+                            ",".join(db_fields1 + db_fields2),
+                             images_table,
+                             subs)
+                        db_cursor.execute(sql, (OTTid, src_flags['eol']))
                             
-                            for r in db_cursor.fetchall():
-                                DOid, rating = int(r[0]), float(r[1])/10000.0
-                                is_best = {l:r[len(db_fields1)+i] for i,l in enumerate(db_fields2)}
-                                #Make the ranking table of previously downloaded images, putting original ratings
-                                # only where the image is marked as 'best' for that type, e.g. if doIDs are 1,2:
-                                #{ -1 : {best_any: 0, best_pd: 2.5, best_verified: 2.0},
-                                #{ -2 : {best_any: 4.1, best_pd: 0, best_verified: 0} 
-                                #NB: previously downloaded images are given a negative data object id, to distinguish them from 
-                                #the about-to-be downloaded ones
-                                image_ranking_table[-DOid]={lab: rating if is_best[colname] else 0 for colname,lab in zip(db_fields2, image_status_labels)}
-                            if len(image_ranking_table):
-                                logger.debug("Created table of previously downloaded EoL images for ott {} (objects {})".format(ott, image_ranking_table.keys()))
-                        if image_ranking_tables[OTTid] is not None:
-                            image_ranking_table = image_ranking_tables[OTTid]
-                            #just use the first object from each API call (if there is one)
-                            if 'dataObjects' in data and len(data['dataObjects']):
-                                d=data['dataObjects'][0]
-                                image_id = d['dataObjectVersionID']
-                                #we store ratings as integers from 10000-50000, which always makes them higher than existing
-                                image_rating = convert_rating(d['dataRating'])
-                                #create a dict for the data object ID index if it doesn't exist
-                                if image_id not in image_ranking_table:
-                                    image_ranking_table[image_id]={s:0 for s in image_status_labels}
-                                row = image_ranking_table[image_id]
-                                row["any"] = image_rating
-                                if d['vettedStatus']=='Trusted':
-                                    row['verified'] = image_rating
-                                if req_focus=='pd':
-                                    row['pd'] = image_rating
-                                image_information[image_id]={'data_object':d, 'page_id': data.get("identifier"), "sci_name":data.get("scientificName")}
-        except (AttributeError,ValueError):
-            #there is no valid json in get_result
-            logger.warning("Problem interpreting json from the string returned from the EoL API for {} ({} request) so aborting the current OTT batch. Json string is\n {}".format(get_result.url, req_focus, get_result))
-            db_cursor.close() 
-            return None
+                        for r in db_cursor.fetchall():
+                            DOid, rating = int(r[0]), float(r[1])/10000.0
+                            is_best = {l:r[len(db_fields1)+i] for i,l in enumerate(db_fields2)}
+                            #Make the ranking table of previously downloaded images, putting original ratings
+                            # only where the image is marked as 'best' for that type, e.g. if doIDs are 1,2:
+                            #{ -1 : {best_any: 0, best_pd: 2.5, best_verified: 2.0},
+                            #{ -2 : {best_any: 4.1, best_pd: 0, best_verified: 0} 
+                            #NB: previously downloaded images are given a negative data object id, to distinguish them from 
+                            #the about-to-be downloaded ones
+                            image_ranking_table[-DOid]={lab: rating if is_best[colname] else 0 for colname,lab in zip(db_fields2, image_status_labels)}
+                        if len(image_ranking_table):
+                            logger.debug("Created table of previously downloaded EoL images for ott {} (objects {})".format(ott, image_ranking_table.keys()))
+                    if image_ranking_tables[OTTid] is not None:
+                        image_ranking_table = image_ranking_tables[OTTid]
+                        #just use the first object from each API call (if there is one)
+                        if 'dataObjects' in data and len(data['dataObjects']):
+                            d=data['dataObjects'][0]
+                            image_id = d['dataObjectVersionID']
+                            #we store ratings as integers from 10000-50000, which always makes them higher than existing
+                            image_rating = convert_rating(d['dataRating'])
+                            #create a dict for the data object ID index if it doesn't exist
+                            if image_id not in image_ranking_table:
+                                image_ranking_table[image_id]={s:0 for s in image_status_labels}
+                            row = image_ranking_table[image_id]
+                            row["any"] = image_rating
+                            if d['vettedStatus']=='Trusted':
+                                row['verified'] = image_rating
+                            if req_focus=='pd':
+                                row['pd'] = image_rating
+                            image_information[image_id]={'data_object':d, 'page_id': data.get("identifier"), "sci_name":data.get("scientificName")}
     db_cursor.close() 
 
+    #The new images that are top-ranked for each type will almost always be used, so download and crop these
+    #in parallel first. Any that fail will be replaced by the next best, which is downloaded below.
+    first_choices = []
+    for image_ranking_table in image_ranking_tables.values():
+        if image_ranking_table:
+            for image_label in image_status_labels:
+                best_image_id, best_image_ranks = sorted(image_ranking_table.items(), key=lambda row: row[1][image_label], reverse=True)[0]
+                if best_image_id >= 0 and best_image_ranks[image_label] != 0:
+                    first_choices.append((src_flags['eol'], best_image_id))
+    cropped = crop_images(
+        first_choices,
+        lambda src, src_id: image_information[src_id]['data_object'],
+        lambda src, src_id: thumb_dir(args.output_dir, src, src_id),
+        args.thumbnail_size, args.add_percent, args.threads)
+
     #Now go through the image tables for each OTT, and see if we can get the best for each type
     for ott, image_ranking_table in image_ranking_tables.items():
         if image_ranking_table is not None:
@@ -396,12 +458,14 @@ def lookup_and_save_auto_EoL_info(eol_page_to_ott, sess, API_key, db_connection,
                             #this still needs downloading
                             try:
                                 image_info = image_information[best_image_id]
-                                logger.info("= Getting data object {} for ott {} (eol page {}) ({}) =".format(best_image_id, ott, image_info['page_id'], image_info['sci_name']))
-                                best_image_id
-                                output_dir = os.path.join(args.output_dir, str(src_flags['eol']), subdir_name(best_image_id))
-                                image_info['copyinfo'] = get_file_from_json_struct(
-                                    image_info['data_object'], output_dir, best_image_id,
-                                    args.thumbnail_size, args.add_percent)
+                                if (src_flags['eol'], best_image_id) in cropped:
+                                    image_info['copyinfo'] = cropped[(src_flags['eol'], best_image_id)]
+                                else:
+                                    logger.info("= Getting data object {} for ott {} (eol page {}) ({}) =".format(best_image_id, ott, image_info['page_id'], image_info['sci_name']))
+                                    output_dir = thumb_dir(args.output_dir, src_flags['eol'], best_image_id)
+                                    image_info['copyinfo'] = get_file_from_json_struct(
+                                        image_info['data_object'], output_dir, best_image_id,
+                                        args.thumbnail_size, args.add_percent)
                                 if image_info['copyinfo'] is not None:
                                     #Got it!
                                     got_img[image_label] = best_image_id
@@ -466,27 +530,73 @@ def lookup_and_save_auto_EoL_info(eol_page_to_ott, sess, API_key, db_connection,
     return completed_eols
 
 
-def save_eol_to_ott(eol_page_to_ott, sess, API_key, db_connection, images_table, inspected_table):
-    if len(eol_page_to_ott):
-        EoLdone = lookup_and_save_auto_EoL_info(
-            eol_page_to_ott, sess, API_key, db_connection, images_table, names_table=args.save_names_table, loop_seconds=args.loop_seconds)
-        if EoLdone is not None:
-            db_curs = db_connection.cursor()
-            for old_eol, new_eol in EoLdone.items():
-                ott = eol_page_to_ott[old_eol]
-                sql = "INSERT INTO `{0}` (eol, updated, real_eol_id) VALUES ({1},{2},{1}) ON DUPLICATE KEY UPDATE updated={2}, real_eol_id={1}".format(args.save_update_times_table, subs, datetime_now)
-                db_curs.execute(sql, (int(old_eol), None if new_eol is None else int(new_eol), None if new_eol is None else int(new_eol)))
-                if inspected_table is not None:
-                    sql = "DELETE FROM `{}` WHERE ott = {}".format(inspected_table, subs)
-                    db_curs.execute(sql, int(ott))
-            db_connection.commit()
-            db_curs.close()
+
+def save_eol_updated(eol_done, eol_page_to_ott, db_connection, inspected_table=None):
+    """
+    Record the time that the EoL ids in eol_done (as returned by save_auto_EoL_info) were updated, and if
+    inspected_table is given, remove their otts from the inspected table. As this is committed after each
+    batch, an interrupted harvest will pick up where it left off.
+    """
+    db_curs = db_connection.cursor()
+    for old_eol, new_eol in eol_done.items():
+        ott = eol_page_to_ott[old_eol]
+        sql = "INSERT INTO `{0}` (eol, updated, real_eol_id) VALUES ({1},{2},{1}) {3} updated={2}, real_eol_id={1}".format(args.save_update_times_table, subs, datetime_now, on_duplicate('eol'))
+        db_curs.execute(sql, (int(old_eol), None if new_eol is None else int(new_eol), None if new_eol is None else int(new_eol)))
+        if inspected_table is not None:
+            sql = "DELETE FROM `{}` WHERE ott = {}".format(inspected_table, subs)
+            db_curs.execute(sql, (int(ott),))
+    db_connection.commit()
+    db_curs.close()
+
+
+def harvest(jobs, API_key, db_connection, limiter, threads, progress=None):
+    """
+    Take an iterable of (eol_page_to_ott, images_table, inspected_table) jobs, and look them up in the EoL API
+    using up to `threads` worker threads, subject to the rate limiter. To bound the number of jobs in memory,
+    no more than 2 * threads jobs are taken from `jobs` at a time, so `jobs` can be an endless generator that
+    queries the database as it goes. The results are saved (in this thread, as the database connection cannot
+    be shared) as each job completes. EoL ids that are already being looked up are dropped from new jobs.
+    
+    If given, progress['saved'] is incremented after each job is saved.
+    """
+    jobs = iter(jobs)
+    in_progress = {} #future => job
+    in_progress_eols = set()
+    more_jobs = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while more_jobs or in_progress:
+            for i in range(threads * 2 - len(in_progress)):
+                job = next(jobs, None)
+                if job is None:
+                    more_jobs = False
+                    break
+                eol_page_to_ott, images_table, inspected_table = job
+                eol_page_to_ott = {e:o for e, o in eol_page_to_ott.items() if e not in in_progress_eols}
+                if len(eol_page_to_ott):
+                    in_progress_eols.update(eol_page_to_ott.keys())
+                    future = executor.submit(query_EoL_pages, eol_page_to_ott, API_key, images_table is not None, limiter)
+                    in_progress[future] = (eol_page_to_ott, images_table, inspected_table)
+            if not in_progress:
+                continue
+            done, not_done = concurrent.futures.wait(in_progress, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                eol_page_to_ott, images_table, inspected_table = in_progress.pop(future)
+                try:
+                    req = future.result()
+                    if req is not None:
+                        eol_done = save_auto_EoL_info(eol_page_to_ott, req, db_connection, images_table, args.save_names_table)
+                        save_eol_updated(eol_done, eol_page_to_ott, db_connection, inspected_table)
+                        if progress is not None:
+                            progress['saved'] = progress.get('saved', 0) + 1
+                finally:
+                    in_progress_eols.difference_update(eol_page_to_ott.keys())
 
 
 #To DO - we also need to do this for images_by_name and vernacular_by_name
-def check_OTTs(otts, sess, API_key, db_connection, batch_size, all_tables, inspected_table=None):
+def OTT_jobs(otts, db_connection, batch_size, all_tables, inspected_table=None):
     """
-    Take a list of otts and look them up in batches (could be either for nodes (names only) or leaves (also images)
+    Take a list of otts and generate jobs for harvest() to look them up in batches (could be either for nodes
+    (names only) or leaves (also images).
     if 'inspected_table' is given, remove these otts from the inspected table after checking.
     """
     opentree_id_batches = [set(otts[i:i+batch_size]) for i in range(0, len(otts), batch_size)]
@@ -508,11 +618,12 @@ def check_OTTs(otts, sess, API_key, db_connection, batch_size, all_tables, inspe
                         #because if the lookup fails, we want to keep the ott in the inspected table
                         batch.discard(ott)
                 db_curs.close()
-                save_eol_to_ott(eol_page_to_ott, sess, API_key, db_connection, im_table, inspected_table)
-
+                if len(eol_page_to_ott):
+                    yield (eol_page_to_ott, im_table, inspected_table)
         if inspected_table is not None:
             # There may still be some otts left - e.g. orphans (present on a previous tree) or force-harvests. 
-            # If so, we may need to delete them from the original table.
+            # If so, we may need to delete them from the original table. Note that these are deleted
+            # as soon as all the jobs for the batch have been taken, which is fine as they are not being looked up.
             
             #first tackle the force harvests that only need the name checking
             if len(batch):
@@ -526,7 +637,8 @@ def check_OTTs(otts, sess, API_key, db_connection, batch_size, all_tables, inspe
                         eol_page_to_ott[eol]=ott
                         batch.discard(ott)
                 db_curs.close()
-                save_eol_to_ott(eol_page_to_ott, sess, API_key, db_connection, None, inspected_table)
+                if len(eol_page_to_ott):
+                    yield (eol_page_to_ott, None, inspected_table)
 
             #now tackle the ones that need both name and image checking
             if len(batch):
@@ -541,7 +653,8 @@ def check_OTTs(otts, sess, API_key, db_connection, batch_size, all_tables, inspe
                         eol_page_to_ott[eol]=ott
                         batch.discard(ott)
                 db_curs.close()
-                save_eol_to_ott(eol_page_to_ott, sess, API_key, db_connection, im_table, inspected_table)
+                if len(eol_page_to_ott):
+                    yield (eol_page_to_ott, next((t for t in all_tables.values() if t is not None), None), inspected_table)
 
             #any remaining in batch are orphans, and can be deleted
             if len(batch):
@@ -551,13 +664,13 @@ def check_OTTs(otts, sess, API_key, db_connection, batch_size, all_tables, inspe
                 db_curs.execute(sql, list(batch))
                 db_connection.commit()
                 db_curs.close()
-            
-            
-def check_recently_inspected(sess, API_key, db_connection, batch_size, all_tables, inspected_table):
+
+
+def inspected_jobs(db_connection, batch_size, all_tables, inspected_table):
     """
-    Look at the 'eol_inspected' table for items that were inspected > 5 minutes ago, and run these through the checking script.
-    Delete from the table if they are checked.
-    We carry out this as a function so that it can be injected into long running loops
+    Look at the 'eol_inspected' table for items that were inspected > 5 minutes ago, and generate jobs for harvest()
+    to check them. They are deleted from the table once they are checked.
+    We carry out this as a generator so that it can be injected into long running loops
     """
     db_curs = db_connection.cursor()
     db_curs.execute("SELECT ott from {} WHERE {} >= 5 ORDER BY `{}`;".format(inspected_table, diff_minutes('inspected', datetime_now), 'inspected'))
@@ -566,7 +679,85 @@ def check_recently_inspected(sess, API_key, db_connection, batch_size, all_table
     if len(otts):
         logger.debug("Found {} recently inspected EoL taxa - refreshing these".format(len(otts)))
         #check these OTT ids in the leaf and nodes tables
-        check_OTTs(otts, sess, API_key, db_connection, batch_size, all_tables, inspected_table)
+        yield from OTT_jobs(otts, db_connection, batch_size, all_tables, inspected_table)
+
+
+def auto_jobs(db_connection, batch_size, all_tables, inspected_table):
+    """
+    Endlessly generate jobs for harvest(). Look for eol ids in the input tables that do not match eol ids in the
+    eol_updated table. These require immediate querying via the API, with the entries that require names and
+    images (i.e. leaves) checked first. Once all have been checked, look in the images table for the least recently
+    updated images that also have an ott in any of the input tables. Any recently inspected taxa are checked before
+    each batch, so the inspected table is drained as we go.
+    """
+    big_batch=batch_size*100 #to avoid many slow db queries, get a big_batch from the db and split it into smaller ones for the API
+    while True:
+        #first look for unchecked eol IDs in ordered_leaves or ordered_nodes (i.e. if the count of eol ids > count when joined with updated
+        for eolott_table, im_table in all_tables.items():
+            while True:
+                batches = []
+                db_curs = db_connection.cursor()
+                #tackle eol IDs that have not been checked: get them in batches
+                logger.info("Checking EoL ids that have never been looked at: getting a big batch for {}".format(eolott_table))
+                sql = "SELECT ott, eol, popularity FROM {0} WHERE eol IS NOT NULL AND NOT EXISTS (SELECT(1) FROM {1} WHERE {0}.eol = {1}.eol) ORDER BY popularity DESC LIMIT {2}".format(eolott_table, args.save_update_times_table, big_batch)
+                db_curs.execute(sql)
+                rows=True
+                while rows:
+                    #get the rows in batches
+                    rows = {row[1]:row[0] for row in db_curs.fetchmany(batch_size) if row[0] and row[1]}
+                    if rows:
+                        batches.append(rows)
+                db_curs.close()
+                if len(batches)==0:
+                    logger.info("Checking EoL ids in {} that have never been looked at, but nothing left to check".format(eolott_table))
+                    break;
+
+                for eol_page_to_ott in batches:
+                    #within each loop, do an additional check in case there have been any recent inspections of stuff
+                    #these will all get done first, in sequential batches
+                    yield from inspected_jobs(db_connection, batch_size, all_tables, inspected_table)
+                    yield (eol_page_to_ott, im_table, None)
+
+        # Once we have knocked off all the taxa in ordered_nodes or ordered_leaves that have never been checked
+        # (i.e. have an eol id in leaves/nodes but are not in eol_updated) then we want to do some updating of
+        # existing entries, or ones in the recently inspected table.
+        #
+        # Search through the oldest updated eol id that is still in one of the ordered_leaves/nodes tables.
+        logger.info("Updating info for EoL ids: getting a big batch of {} from the DB".format(big_batch))
+        db_curs = db_connection.cursor()
+        sql = "select eols_in_tree.ott, eols_in_tree.eol, eols_in_tree.table_index from ("
+        sql += " UNION ALL ".join(["(select eol, ott, {} AS table_index FROM {} WHERE eol IS NOT NULL)".format(i, list(all_tables.keys())[i]) for i in range(len(all_tables))])
+        sql += ") eols_in_tree INNER JOIN {0} ON eols_in_tree.eol = {0}.eol".format(args.save_update_times_table)
+        sql += " ORDER BY {}.updated LIMIT {}".format(args.save_update_times_table, big_batch)
+        db_curs.execute(sql)
+        batch_queue = [] #store a set of batches to send to the api
+        table_batch_buffer = {} #keep a list of the numbers in each batch here, until they get large enough to stick into the queue
+        for row in db_curs.fetchall():
+            ott = int(row[0])
+            eol = int(row[1])
+            table_name = list(all_tables.keys())[row[2]]
+            #Add to the appropriate batch. Once any batches get to size batch_size, stick them in the queue
+            if table_name not in table_batch_buffer:
+                table_batch_buffer[table_name] = {}
+            table_batch_buffer[table_name][eol]=ott
+            if len(table_batch_buffer[table_name]) == batch_size:
+                batch_queue.append({'table_name':table_name, 'eol_page_to_ott':table_batch_buffer.pop(table_name)})
+        for table_name in table_batch_buffer.keys():
+            batch_queue.append({'table_name':table_name, 'eol_page_to_ott':table_batch_buffer[table_name]})
+        db_curs.close()
+        if len(batch_queue)==0:
+            logger.info("No EoL ids to update: waiting a minute before looking again")
+            yield from inspected_jobs(db_connection, batch_size, all_tables, inspected_table)
+            time.sleep(60)
+        
+        #now we can go through the batches
+        for batch in batch_queue:
+            #within each loop, do an additional check in case there have been any recent inspections of stuff
+            yield from inspected_jobs(db_connection, batch_size, all_tables, inspected_table)
+            if len(batch['eol_page_to_ott']):
+                yield (batch['eol_page_to_ott'], all_tables[batch['table_name']], None)
+
+
 if __name__ == "__main__":
 
     default_appconfig_file = "../../../private/appconfig.ini"
@@ -589,7 +780,11 @@ if __name__ == "__main__":
     parser.add_argument('--thumbnail_size', '-s', type=int, choices=range(1, 8001), default=150, help='maximum width in pixels of thumbnail produced')
     #parser.add_argument('--force_size', '-z', action="store_true", help="force the thumbnail to be the maximum size (don't allow smaller thumbnails for small pictures)")
     parser.add_argument('--retries', '-r', type=int, default=5, help='number of times to retry getting the image')
-    parser.add_argument('--loop_seconds', '-t', type=int, default=None, help='number of seconds between API calls (to avoid bombing EoL API)')
+    parser.add_argument('--loop_seconds', '-t', type=int, default=None, help='number of seconds between API calls when getting user-specified images (to avoid bombing EoL API)')
+    parser.add_argument('--requests_per_second', '-rps', type=float, default=1.0, help='maximum average rate of calls to the EoL API when harvesting names and images (to avoid bombing EoL API)')
+    parser.add_argument('--burst', type=int, default=3, help='maximum number of calls to the EoL API that can be made at once, if we have been under the --requests_per_second rate')
+    parser.add_argument('--threads', type=int, default=4, help='number of batches of EoL ids to look up in parallel when harvesting names and images, and of images to download and crop in parallel')
+    parser.add_argument('--api_url', default="https://eol.org/api", help='the base url of the EoL API (e.g. change to a local server for testing)')
     parser.add_argument('--EOL_API_key', '-k', default=None, help='your EoL API key. If not given, the script looks for the variable api.eol_api_key in the file {} (relative to the script location)'.format(default_appconfig_file))
     parser.add_argument('--script', action="store_true", help="Don't use 'getpass' to get the password, so it can be scriptified")
     args = parser.parse_args()
@@ -635,17 +830,16 @@ if __name__ == "__main__":
             'img')
                     
         
-    #make a single http session, which we can tweak
-    s = requests.Session()
-    retries = Retry(total=args.retries,
-                    backoff_factor=1,
-                    status_forcelist=[ 500, 502, 503, 504 ])
-    s.mount('https://', HTTPAdapter(max_retries=retries))
-    
+    args.api_url = args.api_url.rstrip("/")
+    limiter = TokenBucket(args.requests_per_second, args.burst)
+
     if args.database.startswith("sqlite://"):
         from sqlite3 import dbapi2 as sqlite
-        db_connection = sqlite.connect(os.path.relpath(args.database[len("sqlite://"):], args.treedir))
+        db_connection = sqlite.connect(os.path.join( # as web2py, relative to the app's databases dir
+            os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir, 'databases', args.database[len("sqlite://"):]))
         datetime_now = "datetime('now')";
+        diff_minutes=lambda a,b: '((julianday({1}) - julianday({0})) * 24 * 60)'.format(a,b)
+        on_duplicate=lambda key: 'ON CONFLICT({}) DO UPDATE SET'.format(key)
         subs="?"
         
     elif args.database.startswith("mysql://"): #mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>
@@ -663,6 +857,7 @@ if __name__ == "__main__":
         db_connection = pymysql.connect(user=match.group(1), passwd=pw, host=match.group(3), db=match.group(4), port=3306, charset='utf8mb4')
         datetime_now = "NOW()"
         diff_minutes=lambda a,b: 'TIMESTAMPDIFF(MINUTE,{},{})'.format(a,b)
+        on_duplicate=lambda key: 'ON DUPLICATE KEY UPDATE'
         subs="%s"
     else:
         logger.error("No recognized database specified: {}".format(args.database))
@@ -674,14 +869,14 @@ if __name__ == "__main__":
         db_curs.execute("SELECT verified_preferred_image,OTT_ID from reservations WHERE verified_preferred_image IS NOT NULL AND (deactivated IS NULL or deactivated = '');")
         eol_DOid_to_ott = {int(r[0]):int(r[1]) for r in db_curs.fetchall() if r[0] and r[1]}
         db_curs.close()
-        lookup_and_save_bespoke_EoL_images(eol_DOid_to_ott, s, args.EOL_API_key, db_connection, args.save_images_table, loop_seconds=args.loop_seconds)
+        lookup_and_save_bespoke_EoL_images(eol_DOid_to_ott, http_session(), args.EOL_API_key, db_connection, args.save_images_table, loop_seconds=args.loop_seconds)
         
     elif args.eol_image_id:
         if len(args.eol_image_id) != len(args.opentree_id):
             logger.error("If you are hand-chosing an image for onezoom, you have to give the same total number of ott ids as eol data object ids, but you have given totals of {} and {} respectively".format(len(args.opentree_id), len(args.eol_image_id)))
             sys.exit()
         eol_DOid_to_ott = {int(args.eol_image_id[i]):int(args.opentree_id[i]) for i in range(len(args.opentree_id))}
-        lookup_and_save_bespoke_EoL_images(eol_DOid_to_ott, s, args.EOL_API_key, db_connection, args.save_images_table, loop_seconds=args.loop_seconds)
+        lookup_and_save_bespoke_EoL_images(eol_DOid_to_ott, http_session(), args.EOL_API_key, db_connection, args.save_images_table, loop_seconds=args.loop_seconds)
         #don't bother saving the update time - this might not even have an eol page id anyway (we only need a doID)
     else:
         #we are getting stuff from ordered_leaves or ordered_nodes
@@ -692,100 +887,23 @@ if __name__ == "__main__":
         all_tables = OrderedDict([(table,im_tab) for tables,im_tab in im_tables for table in tables])
         if args.opentree_id:
             #we are getting a bespoke set of ott ids via the command-line, so just re-check these
-            check_OTTs(args.opentree_id, s, args.EOL_API_key, db_connection, batch_size, all_tables)
+            harvest(OTT_jobs(args.opentree_id, db_connection, batch_size, all_tables),
+                args.EOL_API_key, db_connection, limiter, args.threads)
         else:
-            # Look for eol ids in the input tables that do not match eol ids in the eol_updated table.
-            #  These require immediate querying via the API, with 
-            #  the entries that require names and images (i.e. leaves) checked first.
-            # Once all have been checked, look in the images table for the least recently updated images
-            #  that also have an ott in any of the input tables.
-            big_batch=batch_size*100 #to avoid many slow db queries, get a big_batch from the db and split it into smaller ones for the API
+            # Progress is saved to the eol_updated table after each batch, so if we are interrupted, we
+            # simply start again from the least recently updated EoL ids.
             logger.info("Automatic mode - will first look at unchecked EoL IDs then update existing (any recently inspected on OneZoom will be updated first)")
+            progress = {'saved': 0}
+            retry_seconds = 60
             while True:
+                saved = progress['saved']
                 try:
-                    #first look for unchecked eol IDs in ordered_leaves or ordered_nodes (i.e. if the count of eol ids > count when joined with updated
-                    for eolott_table, im_table in all_tables.items():
-                        while True:
-                            batches = []
-                            db_curs = db_connection.cursor()
-                            #tackle eol IDs that have not been checked: get them in batches
-                            logger.info("Checking EoL ids that have never been looked at: getting a big batch for {}".format(eolott_table))
-                            sql = "SELECT ott, eol, popularity FROM {0} WHERE eol IS NOT NULL AND NOT EXISTS (SELECT(1) FROM {1} WHERE {0}.eol = {1}.eol) ORDER BY popularity DESC LIMIT {2}".format(eolott_table, args.save_update_times_table, big_batch)
-                            db_curs.execute(sql)
-                            rows=True
-                            while rows:
-                                #get the rows in batches
-                                rows = {row[1]:row[0] for row in db_curs.fetchmany(batch_size) if row[0] and row[1]}
-                                if rows:
-                                    batches.append(rows)
-                            db_curs.close()
-                            if len(batches)==0:
-                                logger.info("Checking EoL ids in {} that have never been looked at, but nothing left to check".format(eolott_table))
-                                break;
-    
-                            for eol_page_to_ott in batches:
-                                #within each loop, do an additional check in case there have been any recent inspections of stuff
-                                #these will all get done first, in sequential batches
-                                check_recently_inspected(s, args.EOL_API_key, db_connection, batch_size, all_tables, args.eol_inspected_table)
-
-                                #now go ahead and do the batch lookup
-                                EoLdone = lookup_and_save_auto_EoL_info(
-                                    eol_page_to_ott, s, args.EOL_API_key, db_connection, images_table=im_table, names_table=args.save_names_table, loop_seconds=args.loop_seconds)
-                                if EoLdone is not None:
-                                    db_curs = db_connection.cursor()
-                                    for old_eol, new_eol in EoLdone.items():
-                                        ott = eol_page_to_ott[old_eol]
-                                        sql = "INSERT INTO `{0}` (eol, updated, real_eol_id) VALUES ({1},{2},{1}) ON DUPLICATE KEY UPDATE updated={2}, real_eol_id={1}".format(args.save_update_times_table, subs, datetime_now)
-                                        db_curs.execute(sql, (int(old_eol), None if new_eol is None else int(new_eol), None if new_eol is None else int(new_eol)))
-                                    db_connection.commit()
-                                    db_curs.close()
-    
-                      
-                    
-                    # Once we have knocked off all the taxa in ordered_nodes or ordered_leaves that have never been checked
-                    # (i.e. have an eol id in leaves/nodes but are not in eol_updated) then we want to do some updating of
-                    # existing entries, or ones in the recently inspected table.
-                    #
-                    # Search through the oldest updated eol id that is still in one of the ordered_leaves/nodes tables.
-                    logger.info("Updating info for EoL ids: getting a big batch of {} from the DB".format(big_batch))
-                    db_curs = db_connection.cursor()
-                    sql = "select eols_in_tree.ott, eols_in_tree.eol, eols_in_tree.table_index from ("
-                    sql += " UNION ALL ".join(["(select eol, ott, {} AS table_index FROM {} WHERE eol IS NOT NULL)".format(i, list(all_tables.keys())[i]) for i in range(len(all_tables))])
-                    sql += ") eols_in_tree INNER JOIN eol_updated ON eols_in_tree.eol = eol_updated.eol"
-                    sql += " ORDER BY eol_updated.updated LIMIT {}".format(big_batch)
-                    db_curs.execute(sql)
-                    batch_queue = [] #store a set of batches to send to the api
-                    table_batch_buffer = {} #keep a list of the numbers in each batch here, until they get large enough to stick into the queue
-                    for row in db_curs.fetchall():
-                        ott = int(row[0])
-                        eol = int(row[1])
-                        table_name = list(all_tables.keys())[row[2]]
-                        #Add to the appropriate batch. Once any batches get to size batch_size, stick them in the queue
-                        if table_name not in table_batch_buffer:
-                            table_batch_buffer[table_name] = {}
-                        table_batch_buffer[table_name][eol]=ott
-                        if len(table_batch_buffer[table_name]) == batch_size:
-                            batch_queue.append({'table_name':table_name, 'eol_page_to_ott':table_batch_buffer.pop(table_name)})
-                    for table_name in table_batch_buffer.keys():
-                        batch_queue.append({'table_name':table_name, 'eol_page_to_ott':table_batch_buffer[table_name]})
-                    db_curs.close()
-                    
-                    #now we can go through the batches
-                    for batch in batch_queue:
-                        #within each loop, do an additional check in case there have been any recent inspections of stuff
-                        check_recently_inspected(s, args.EOL_API_key, db_connection, batch_size, all_tables, args.eol_inspected_table)
-
-                        if len(batch['eol_page_to_ott']):
-                            EoLdone = lookup_and_save_auto_EoL_info(
-                                batch['eol_page_to_ott'], s, args.EOL_API_key, db_connection, images_table=all_tables[batch['table_name']], names_table=args.save_names_table, loop_seconds=args.loop_seconds)
-                            if EoLdone is not None:
-                                db_curs = db_connection.cursor()
-                                for old_eol, new_eol in EoLdone.items():
-                                    ott = batch['eol_page_to_ott'][old_eol]
-                                    sql = "INSERT INTO `{0}` (eol, updated, real_eol_id) VALUES ({1},{2},{1}) ON DUPLICATE KEY UPDATE updated={2}, real_eol_id={1}".format(args.save_update_times_table, subs, datetime_now)
-                                    db_curs.execute(sql, (int(old_eol), None if new_eol is None else int(new_eol), None if new_eol is None else int(new_eol)))
-                                db_connection.commit()
-                                db_curs.close()
+                    harvest(auto_jobs(db_connection, batch_size, all_tables, args.eol_inspected_table),
+                        args.EOL_API_key, db_connection, limiter, args.threads, progress)
                 except Exception as e:
-                    logger.warning("There is a problem: {}. Waiting 30 mins before retrying.".format(e))
-                    time.sleep(60*30)
+                    if progress['saved'] > saved:
+                        retry_seconds = 60 #we were making progress before this problem, so retry soon
+                    logger.warning("There is a problem: {}. Waiting {} secs before retrying.".format(e, retry_seconds))
+                    time.sleep(retry_seconds)
+                    retry_seconds = min(retry_seconds * 2, 60*30)
+
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fill out the ott_details table: a denormalized summary of the per-taxon details needed by
+the API/node_details call, so that the API can look these up by (ott, lang_primary)
+rather than joining vernacular_by_ott, images_by_ott and iucn on the fly.
+
+For each leaf ott in the tree, a row with lang_primary='' holds the IUCN status and the
+src, src_id and rating of the overall best image of each type (any, verified, pd). For
+each taxon (leaf or node) with a preferred vernacular name, a row per primary language
+holds that name (where there are several, the one with the lowest src is used).
+
+This should be run after loading a new tree, after running picProcess.py and IUCNquery.py,
+and periodically thereafter so that new images and names are picked up. The table is
+entirely replaced in a single transaction, along with its row in the precomputed_tables
+table, recording the tree version it was built for and when. The API only uses ott_details
+if it was built for the tree currently loaded, and within tree_cache.ott_details_max_age_hours
+(see private/appconfig.ini), otherwise it reverts to looking up the original tables.
+"""
+import datetime
+import os
+import sys
+import re
+import argparse
+
+image_status_labels = ['any', 'verified', 'pd'] # should match those in models/_OZglobals.py
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+def info(*objs):
+    try:
+        if args.verbosity<1:
+            return
+    except:
+        pass;
+    print(*objs, file=sys.stderr)
+
+default_appconfig_file = "../../../private/appconfig.ini"
+
+parser = argparse.ArgumentParser(description='Build the denormalized ott_details table used by the node_details API')
+parser.add_argument('--database', '-db', default=None, help='name of the db containing the tree, in the same format as in web2py, e.g. sqlite://../databases/storage.sqlite or mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>. If no password is given, it will prompt for one. If no --database option is given, it will look for one in {} (relative to the script location)'.format(default_appconfig_file))
+parser.add_argument('--verbosity', '-v', default=0, action="count", help='verbosity: output extra non-essential info')
+args = parser.parse_args()
+
+# look for appconfig if no database string given
+if args.database is None:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), default_appconfig_file)) as conf:
+        conf_type=None
+        for line in conf:
+        #look for [db] line, followed by uri
+            m = re.match(r'\[([^]]+)\]', line)
+            if m:
+                conf_type = m.group(1)
+            if conf_type == 'db':
+                m = re.match(r'uri\s*=\s*(\S+)', line)
+                if m:
+                    args.database = m.group(1)
+
+if args.database.startswith("sqlite://"):
+    from sqlite3 import dbapi2 as sqlite
+    subs = "?"
+    db_connection = sqlite.connect(os.path.relpath(args.database[len("sqlite://"):]))
+elif args.database.startswith("mysql://"): #mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>
+    import pymysql
+    from getpass import getpass
+    match = re.match(r'mysql://([^:]+):([^@]*)@([^/]+)/([^?]*)', args.database.strip())
+    if match.group(2) == '':
+        #enter password on the command line, if not given (more secure)
+        pw = getpass("Enter the sql database password")
+    else:
+        pw = match.group(2)
+    subs = "%s"
+    db_connection = pymysql.connect(user=match.group(1), passwd=pw, host=match.group(3), db=match.group(4), port=3306, charset='utf8mb4')
+else:
+    warning("No recognized database specified: {}".format(args.database))
+    sys.exit()
+
+db_curs = db_connection.cursor()
+
+info("Removing old details")
+db_curs.execute("DELETE FROM ott_details;")
+
+info("Saving IUCN status and best images for leaves")
+# NB: there should only be one overall_best_XXX image per ott, but pick the lowest id just in case
+image_cols = []
+image_joins = []
+for label in image_status_labels:
+    image_cols += ["{0}.src".format(label), "{0}.src_id".format(label), "{0}.rating".format(label)]
+    image_joins.append("""
+LEFT JOIN (
+  SELECT ott, src, src_id, rating, ROW_NUMBER() OVER (PARTITION BY ott ORDER BY id) AS rn
+  FROM images_by_ott WHERE overall_best_{0} = TRUE
+) {0} ON {0}.ott = leaves.ott AND {0}.rn = 1""".format(label))
+sql = """
+INSERT INTO ott_details (ott, lang_primary, status_code, {cols})
+SELECT leaves.ott, '', iucn.status_code, {image_cols}
+FROM (SELECT DISTINCT ott FROM ordered_leaves WHERE ott IS NOT NULL AND ott <> 0) leaves
+LEFT JOIN iucn ON iucn.ott = leaves.ott {image_joins}
+WHERE iucn.status_code IS NOT NULL OR {any_image};""".format(
+    cols=",".join("{}_{}".format(label, c) for label in image_status_labels for c in ('src', 'src_id', 'rating')),
+    image_cols=",".join(image_cols),
+    image_joins="".join(image_joins),
+    any_image=" OR ".join("{}.src IS NOT NULL".format(label) for label in image_status_labels))
+db_curs.execute(sql)
+info(" {} rows".format(db_curs.rowcount))
+
+info("Saving preferred vernacular names for leaves and nodes")
+sql = """
+INSERT INTO ott_details (ott, lang_primary, vernacular)
+SELECT ott, lang_primary, vernacular FROM (
+  SELECT ott, lang_primary, vernacular,
+    ROW_NUMBER() OVER (PARTITION BY ott, lang_primary ORDER BY src, id) AS rn
+  FROM vernacular_by_ott
+  WHERE preferred = TRUE AND ott IN (
+    SELECT ott FROM ordered_leaves WHERE ott IS NOT NULL
+    UNION
+    SELECT ott FROM ordered_nodes WHERE ott IS NOT NULL)
+) ranked WHERE rn = 1;"""
+db_curs.execute(sql)
+info(" {} rows".format(db_curs.rowcount))
+
+info("Recording the tree version")
+db_curs.execute("DELETE FROM precomputed_tables WHERE name = 'ott_details';")
+# The tree version is stored as the negative parent of the root node
+db_curs.execute(
+    "INSERT INTO precomputed_tables (name, tree_version, built)"
+    " SELECT 'ott_details', -parent, {0} FROM ordered_nodes WHERE id = 1;".format(subs),
+    (datetime.datetime.now(), ))
+if db_curs.rowcount != 1:
+    warning("There is no tree loaded, so the ott_details table will not be used")
+
+db_connection.commit()
+db_connection.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fill out the popular_leaves table: for each node with more than --top leaves, the ids and
+otts of its --top most popular leaves, in the order given by "ORDER BY popularity DESC, ott".
+This extends the idea of the popleaf & popleaf_ott columns in ordered_nodes to more than
+one leaf, so that the most popular species in a clade can be looked up by node id rather
+than by sorting every leaf in the clade.
+
+The lists are built in a single pass up the tree, merging the (already sorted) lists of
+the children of each node.
+
+This should be run after loading a new tree (which sets the popularity of each leaf). The
+table is entirely replaced in a single transaction, and the tree version it was built for
+is recorded in the precomputed_tables table: the table is ignored once a different tree is
+loaded. Nodes missing from the table (for example if it is left empty) are sorted in the
+database instead.
+"""
+import os
+import sys
+import re
+import argparse
+import datetime
+import heapq
+from itertools import islice
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+def info(*objs):
+    try:
+        if args.verbosity<1:
+            return
+    except:
+        pass;
+    print(*objs, file=sys.stderr)
+
+default_appconfig_file = "../../../private/appconfig.ini"
+
+parser = argparse.ArgumentParser(description='Build the popular_leaves table of the most popular leaves in each large node')
+parser.add_argument('--database', '-db', default=None, help='name of the db containing the tree, in the same format as in web2py, e.g. sqlite://../databases/storage.sqlite or mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>. If no password is given, it will prompt for one. If no --database option is given, it will look for one in {} (relative to the script location)'.format(default_appconfig_file))
+parser.add_argument('--top', '-k', default=100, type=int, help='how many of the most popular leaves to save for each node. Nodes with no more leaves than this are not saved, as sorting their leaves is quick anyway')
+parser.add_argument('--batch_size', default=5000, type=int, help='how many rows to insert in one go')
+parser.add_argument('--verbosity', '-v', default=0, action="count", help='verbosity: output extra non-essential info')
+args = parser.parse_args()
+
+# look for appconfig if no database string given
+if args.database is None:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), default_appconfig_file)) as conf:
+        conf_type=None
+        for line in conf:
+        #look for [db] line, followed by uri
+            m = re.match(r'\[([^]]+)\]', line)
+            if m:
+                conf_type = m.group(1)
+            if conf_type == 'db':
+                m = re.match(r'uri\s*=\s*(\S+)', line)
+                if m:
+                    args.database = m.group(1)
+
+if args.database.startswith("sqlite://"):
+    from sqlite3 import dbapi2 as sqlite
+    db_connection = sqlite.connect(os.path.relpath(args.database[len("sqlite://"):]))
+elif args.database.startswith("mysql://"): #mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>
+    import pymysql
+    from getpass import getpass
+    match = re.match(r'mysql://([^:]+):([^@]*)@([^/]+)/([^?]*)', args.database.strip())
+    if match.group(2) == '':
+        #enter password on the command line, if not given (more secure)
+        pw = getpass("Enter the sql database password")
+    else:
+        pw = match.group(2)
+    db_connection = pymysql.connect(user=match.group(1), passwd=pw, host=match.group(3), db=match.group(4), port=3306, charset='utf8mb4')
+else:
+    warning("No recognized database specified: {}".format(args.database))
+    sys.exit()
+
+db_curs = db_connection.cursor()
+subs = "?" if args.database.startswith("sqlite://") else "%s"
+
+info("Reading leaves")
+# Sort keys as for ORDER BY popularity DESC, ott in MySQL: NULL popularity last, NULL ott first
+leaves_by_parent = {}
+db_curs.execute("SELECT id, parent, ott, popularity FROM ordered_leaves;")
+for id, parent, ott, popularity in db_curs.fetchall():
+    leaves_by_parent.setdefault(parent, []).append(
+        (popularity is None, -(popularity or 0), ott is not None, ott or 0, id))
+
+info("Reading nodes")
+db_curs.execute("SELECT id, parent, leaf_lft, leaf_rgt FROM ordered_nodes ORDER BY id DESC;")
+nodes = db_curs.fetchall()
+
+info("Removing old lists")
+db_curs.execute("DELETE FROM popular_leaves;")
+
+info("Saving the {} most popular leaves of each node".format(args.top))
+sql = "INSERT INTO popular_leaves (node_id, position, leaf_id, leaf_ott) VALUES ({});".format(
+    ",".join([subs] * 4))
+child_lists = {}  # sorted lists of the most popular leaves of each child, by parent id
+rows = []
+n_nodes = n_rows = 0
+# Node ids are in preorder, so children (with higher ids) are done before their parents
+for id, parent, leaf_lft, leaf_rgt in nodes:
+    lists = child_lists.pop(id, [])
+    lists.append(sorted(leaves_by_parent.pop(id, [])))
+    best = list(islice(heapq.merge(*lists), args.top))
+    if leaf_rgt - leaf_lft + 1 > args.top:
+        rows.extend((id, pos, key[4], key[3] if key[2] else None) for pos, key in enumerate(best))
+        n_nodes += 1
+        if len(rows) >= args.batch_size:
+            db_curs.executemany(sql, rows)
+            n_rows += len(rows)
+            rows = []
+    if parent > 0:
+        child_lists.setdefault(parent, []).append(best)
+if rows:
+    db_curs.executemany(sql, rows)
+    n_rows += len(rows)
+info(" {} rows for {} nodes".format(n_rows, n_nodes))
+
+info("Recording the tree version")
+db_curs.execute("DELETE FROM precomputed_tables WHERE name = 'popular_leaves';")
+# The tree version is stored as the negative parent of the root node
+db_curs.execute(
+    "INSERT INTO precomputed_tables (name, tree_version, built)"
+    " SELECT 'popular_leaves', -parent, {0} FROM ordered_nodes WHERE id = 1;".format(subs),
+    (datetime.datetime.now(), ))
+if db_curs.rowcount != 1:
+    warning("There is no tree loaded, so the popular_leaves table will not be used")
+
+db_connection.commit()
+db_connection.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fill out the sponsor_leaves table: for each node with at least --min_leaves leaves, and
+each price band, the otts of the first --top sponsorable leaves in the band, in the order
+that default/sponsor_node_price shows them. For all but the cheapest band, that is leaves
+with an image by descending image rating, then leaves without an image by descending
+popularity. For the cheapest band, it is leaves without an image by ott, then leaves with
+an image by ascending image rating. Leaves whose images have no overall_best_any image are
+never shown, as on the sponsor pages.
+
+Whether a leaf has already been sponsored is checked when the lists are read, so they do
+not need rebuilding when reservations change. As with build_popular_leaves.py, the lists
+are built in a single pass up the tree, merging the (sorted) lists of each child node.
+
+This should be run after loading a new tree, setting the leaf prices, or downloading
+many new images. The table is entirely replaced in a single transaction, and the tree
+version it was built for is recorded in the precomputed_tables table: the table is
+ignored once a different tree is loaded. Nodes missing from the table (for example if it
+is left empty) are looked up in the database instead.
+"""
+import os
+import sys
+import re
+import argparse
+import datetime
+import heapq
+from itertools import islice
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+def info(*objs):
+    try:
+        if args.verbosity<1:
+            return
+    except:
+        pass;
+    print(*objs, file=sys.stderr)
+
+default_appconfig_file = "../../../private/appconfig.ini"
+
+parser = argparse.ArgumentParser(description='Build the sponsor_leaves table of the sponsorable leaves in each price band of each large node')
+parser.add_argument('--database', '-db', default=None, help='name of the db containing the tree, in the same format as in web2py, e.g. sqlite://../databases/storage.sqlite or mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>. If no password is given, it will prompt for one. If no --database option is given, it will look for one in {} (relative to the script location)'.format(default_appconfig_file))
+parser.add_argument('--top', '-k', default=100, type=int, help='how many leaves to save for each node and price band. Pages of leaves beyond these (or beyond those left after skipping sponsored leaves) are looked up in the database')
+parser.add_argument('--min_leaves', default=1000, type=int, help='only save lists for nodes with at least this many leaves, as looking up leaves in smaller nodes is quick anyway')
+parser.add_argument('--batch_size', default=5000, type=int, help='how many rows to insert in one go')
+parser.add_argument('--verbosity', '-v', default=0, action="count", help='verbosity: output extra non-essential info')
+args = parser.parse_args()
+
+# look for appconfig if no database string given
+if args.database is None:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), default_appconfig_file)) as conf:
+        conf_type=None
+        for line in conf:
+        #look for [db] line, followed by uri
+            m = re.match(r'\[([^]]+)\]', line)
+            if m:
+                conf_type = m.group(1)
+            if conf_type == 'db':
+                m = re.match(r'uri\s*=\s*(\S+)', line)
+                if m:
+                    args.database = m.group(1)
+
+if args.database.startswith("sqlite://"):
+    from sqlite3 import dbapi2 as sqlite
+    db_connection = sqlite.connect(os.path.relpath(args.database[len("sqlite://"):]))
+elif args.database.startswith("mysql://"): #mysql://<mysql_user>:<mysql_password>@localhost/<mysql_database>
+    import pymysql
+    from getpass import getpass
+    match = re.match(r'mysql://([^:]+):([^@]*)@([^/]+)/([^?]*)', args.database.strip())
+    if match.group(2) == '':
+        #enter password on the command line, if not given (more secure)
+        pw = getpass("Enter the sql database password")
+    else:
+        pw = match.group(2)
+    db_connection = pymysql.connect(user=match.group(1), passwd=pw, host=match.group(3), db=match.group(4), port=3306, charset='utf8mb4')
+else:
+    warning("No recognized database specified: {}".format(args.database))
+    sys.exit()
+
+db_curs = db_connection.cursor()
+subs = "?" if args.database.startswith("sqlite://") else "%s"
+
+info("Reading prices and images")
+db_curs.execute("SELECT price FROM prices;")
+bands = [r[0] for r in db_curs.fetchall()]
+lowest_price = min(bands)
+bands.append(None)  # "contact us"
+db_curs.execute("SELECT DISTINCT ott FROM images_by_ott;")
+has_image = set(r[0] for r in db_curs.fetchall())
+db_curs.execute("SELECT ott, rating FROM images_by_ott WHERE overall_best_any = 1;")
+best_rating = {ott: rating for ott, rating in db_curs.fetchall()}
+
+info("Reading leaves")
+# Sort keys to match the ORDER BY clauses in default/sponsor_node_price (NULLs are first
+# in ascending order in MySQL), with the ott to break ties
+leaves_by_parent = {}
+db_curs.execute("SELECT parent, ott, popularity, price FROM ordered_leaves WHERE ott IS NOT NULL AND name LIKE '% %';")
+for parent, ott, popularity, price in db_curs.fetchall():
+    if price not in bands:
+        continue
+    if ott in best_rating:
+        rating = best_rating[ott]
+        if price == lowest_price:
+            key = (1, rating is not None, rating or 0, ott)
+        else:
+            key = (0, rating is None, -(rating or 0), ott)
+    elif ott in has_image:
+        continue  # Has images, but none are shown
+    elif price == lowest_price:
+        key = (0, False, 0, ott)
+    else:
+        key = (1, popularity is None, -(popularity or 0), ott)
+    leaves_by_parent.setdefault(parent, {}).setdefault(price, []).append(key)
+
+info("Reading nodes")
+db_curs.execute("SELECT id, parent, leaf_lft, leaf_rgt FROM ordered_nodes ORDER BY id DESC;")
+nodes = db_curs.fetchall()
+
+info("Removing old lists")
+db_curs.execute("DELETE FROM sponsor_leaves;")
+
+info("Saving up to {} leaves per price band of each node with at least {} leaves".format(args.top, args.min_leaves))
+sql = "INSERT INTO sponsor_leaves (node_id, price, position, leaf_ott, band_size) VALUES ({});".format(
+    ",".join([subs] * 5))
+child_lists = {}  # for each parent id, a dict of price => [(band size, sorted list of leaves)] for each child
+rows = []
+n_nodes = n_rows = 0
+# Node ids are in preorder, so children (with higher ids) are done before their parents
+for id, parent, leaf_lft, leaf_rgt in nodes:
+    lists = child_lists.pop(id, {})
+    for price, keys in leaves_by_parent.pop(id, {}).items():
+        lists.setdefault(price, []).append((len(keys), sorted(keys)))
+    best = {
+        price: (sum(size for size, _ in sizes_and_lists), list(islice(heapq.merge(*[l for _, l in sizes_and_lists]), args.top)))
+        for price, sizes_and_lists in lists.items()}
+    if leaf_rgt - leaf_lft + 1 >= args.min_leaves:
+        for price, (size, keys) in best.items():
+            rows.extend((id, price, pos, key[3], size) for pos, key in enumerate(keys))
+        n_nodes += 1
+        if len(rows) >= args.batch_size:
+            db_curs.executemany(sql, rows)
+            n_rows += len(rows)
+            rows = []
+    if parent > 0:
+        siblings = child_lists.setdefault(parent, {})
+        for price, size_and_list in best.items():
+            siblings.setdefault(price, []).append(size_and_list)
+if rows:
+    db_curs.executemany(sql, rows)
+    n_rows += len(rows)
+info(" {} rows for {} nodes".format(n_rows, n_nodes))
+
+info("Recording the tree version")
+db_curs.execute("DELETE FROM precomputed_tables WHERE name = 'sponsor_leaves';")
+# The tree version is stored as the negative parent of the root node
+db_curs.execute(
+    "INSERT INTO precomputed_tables (name, tree_version, built)"
+    " SELECT 'sponsor_leaves', -parent, {0} FROM ordered_nodes WHERE id = 1;".format(subs),
+    (datetime.datetime.now(), ))
+if db_curs.rowcount != 1:
+    warning("There is no tree loaded, so the sponsor_leaves table will not be used")
+
+db_connection.commit()
+db_connection.close()
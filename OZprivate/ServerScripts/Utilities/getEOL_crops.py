@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-This script takes a list of EoL data object IDs and queries the EoL API to get a filename and (potentially) a crop location, then downloads the full image file from EoL, crops it according to the crop positions, plus a certain percentage (if specified), and saves the jpg under the data object name, with copyright string and rating attached via EXIF tags. It requires the python package piexif (easy_install piexif OR pip install piexif) and the 'mogrify' command from the imagemagick suite (http://www.imagemagick.org/script/index.php)
+This script takes a list of EoL data object IDs and queries the EoL API to get a filename and (potentially) a crop location, then downloads the full image file from EoL, crops it according to the crop positions, plus a certain percentage (if specified), and saves the jpg under the data object name, with copyright string and rating attached via EXIF tags. Images are cropped in-process, several at a time (--threads). It requires the python packages piexif and Pillow (pip install piexif Pillow)
 
 ServerScripts/Utilities/getEOL_crops.py --DOid 7370441 --output_dir ../static/FinalOutputs/img/3 -v
 
@@ -28,7 +28,7 @@ python -c 'import piexif; piexif.insert(piexif.dump({"0th":{piexif.ImageIFD.Copy
 import os
 import re
 import sys
-import filecmp
+import math
 import logging
 
 logger = logging.getLogger(__name__)
@@ -131,11 +131,19 @@ def get_file_from_doID(doID, sess, output_dir, thumbnail_size, EOL_API_key, add_
     Get a file using an EoL data object ID, querying the api to get url and crop coords.
     output_fn will have .jpg appended. Directories are created as necessary
     """
-    import requests
     image_final = os.path.join(output_dir, str(doID) + '.jpg')
     if os.path.isfile(image_final) and not force_overwrite:
         logger.info("File {} already exists, ignoring.".format(image_final))
         return
+    dobj = get_data_object(doID, sess, EOL_API_key)
+    if dobj is not None:
+        get_file_from_json_struct(dobj, output_dir, doID, thumbnail_size, add_percent)
+
+def get_data_object(doID, sess, EOL_API_key):
+    """
+    Query the EoL api for the json data object with this ID, returning None if it could not be found
+    """
+    import requests
     url = "http://eol.org/api/data_objects/1.0/{}.json".format(doID)
     logger.debug("Querying API for data object {} @ {}.".format(doID, url))
     try:
@@ -143,10 +151,10 @@ def get_file_from_doID(doID, sess, output_dir, thumbnail_size, EOL_API_key, add_
             params={'cache_ttl':100, 'key':EOL_API_key, 'taxonomy':'false'})
     except requests.exceptions.Timeout:
         logger.warning('Socket timed out - URL {}'.format(url))
-        return
+        return None
     except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as error:
         logger.warning('Data not retrieved because {}\nURL: {}'.format(error, url))
-        return
+        return None
 
     EOLdata=r.json()['taxon']
     if len(EOLdata["dataObjects"]) > 0:
@@ -160,23 +168,89 @@ def get_file_from_doID(doID, sess, output_dir, thumbnail_size, EOL_API_key, add_
                 logger.error("Something's odd: the returned data object ID is different"
                 " from the requested one ({} vs {})".format(doID, dobj["dataObjectVersionID"]))        
             else:
-                get_file_from_json_struct(dobj, output_dir, doID, thumbnail_size, add_percent)
+                return dobj
+    return None
+
+def crop_box(d, add_percent, fn):
+    """
+    Return the square (left, top, size) to crop from the image described by the EoL data object d, expanded
+    by add_percent on each side where possible, or None if there is no valid crop info in d
+    """
+    #note that crop_width is in percent ****
+    try:
+        initial_thumb_px = float(d['crop_width'])
+        if initial_thumb_px < 1:
+            return None  # The crop_width is not really a valid value: pretend it wasn't there
+        crop_top_fraction = float(d['crop_y'])/initial_thumb_px
+        crop_bottom_fraction = (float(d['height']) - float(d['crop_y']) - initial_thumb_px)/initial_thumb_px
+        crop_left_fraction = float(d['crop_x'])/initial_thumb_px
+        crop_right_fraction = (float(d['width']) - float(d['crop_x']) - initial_thumb_px)/initial_thumb_px
+    except KeyError:
+        return None
+    min_crop_fraction = min(crop_top_fraction, crop_bottom_fraction, crop_left_fraction, crop_right_fraction)
+    if min_crop_fraction < 0:
+        #the crop is right against the corner, and we cannot make it bigger
+        if add_percent>0:
+            logger.debug("Cannot expand crop for data object {} by {}%: image is against the edge.".format(fn, add_percent))
+        return (int(round(float(d['crop_x']))), int(round(float(d['crop_y']))), int(round(initial_thumb_px)))
+    if min_crop_fraction > add_percent/100.0:
+        min_crop_fraction = add_percent/100.0
+    else:
+        if add_percent>0:
+            logger.debug("NOTICE: Cannot expand crop for data object {} by {}%: borders are not large enough, so using {}%.".format(fn, add_percent, min_crop_fraction*100))
+    min_crop_pixels = min_crop_fraction * initial_thumb_px
+    logger.log(logging.EXTREME_DEBUG, "crop info: {}...{}".format(initial_thumb_px, 2*min_crop_pixels))
+    return (
+        int(round(float(d['crop_x']) - min_crop_pixels)),
+        int(round(float(d['crop_y']) - min_crop_pixels)),
+        int(round(initial_thumb_px + 2*min_crop_pixels)))
+
+def make_thumbnail(image_file, box, thumbnail_size):
+    """
+    Decode an image file, crop the square box=(left, top, size) from it (or the largest central square if
+    box is None) and resize it to thumbnail_size pixels square, returning an RGB PIL image. As with
+    ImageMagick's -crop, a box that overlaps the edge of the image is trimmed, giving a smaller, non-square
+    thumbnail.
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(image_file)
+    width, height = image.size
+    crop_px = box[2] if box else min(width, height)
+    if crop_px > thumbnail_size:
+        # Let the jpeg decoder scale down (by up to 8x) while still leaving enough pixels for the thumbnail
+        scale = thumbnail_size / crop_px
+        image.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+    scale = image.size[0] / width
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if box is None:
+        return ImageOps.fit(image, (thumbnail_size, thumbnail_size), Image.LANCZOS)
+    left, top, size = (v * scale for v in box)
+    region = (max(0, left), max(0, top), min(image.size[0], left + size), min(image.size[1], top + size))
+    region = tuple(int(round(v)) for v in region)
+    if region[2] - region[0] < 1 or region[3] - region[1] < 1:
+        raise ValueError("Crop {} lies outside the {}x{} image".format(box, width, height))
+    image = image.crop(region)
+    fit = thumbnail_size / max(image.size)
+    return image.resize(
+        (max(1, int(round(image.size[0] * fit))), max(1, int(round(image.size[1] * fit)))), Image.LANCZOS)
 
 def get_file_from_json_struct(data_obj_json_struct, output_dir, fn, thumbnail_size, add_percent=12.5):
     """
     Get and crop a file using data present in an EoL json response, which includes object ID, crop info, etc
-    Return the rights & license, or None if something failed.  Directories are created as necessary
+    Return the rights & license, or None if something failed.  Directories are created as necessary.
+    The image is downloaded, cropped, resized and tagged in memory, then moved into place, so that a
+    partially written image is never visible at output_dir/fn.jpg
     """
     #NB: image_cols = ['dataObjectVersionID','eolMediaURL','vettedStatus','dataRating','crop_x', 'crop_y', 'crop_width']
-    #note that crop_width is in percent ****
-    import shutil
-    from subprocess import call
+    import io
+    import tempfile
     import urllib.request
     import urllib.error
 
     import piexif
 
-    CONVERT = shutil.which('convert') #needed in windows, to get the correct 'convert' command
     d=data_obj_json_struct
     fn = str(fn)
     os.umask(0o002) #set group write so that the normal login has same rights as the web server 
@@ -184,90 +258,95 @@ def get_file_from_json_struct(data_obj_json_struct, output_dir, fn, thumbnail_si
     if 'eolMediaURL' not in d:
         logger.error("'eolMediaURL' must be present in data object {}.".format(d))
         return None
+    image_final = os.path.join(output_dir, fn + '.jpg')
     try:
-        output_fn = os.path.join(output_dir, fn)
-        image_orig = output_fn + '_orig.jpg'
-        image_intermediate = output_fn + '_tmp.jpg'
-        image_final = output_fn + '.jpg'
-        logger.info("Downloading {} to {}.".format(d['eolMediaURL'], image_orig))
+        logger.info("Downloading {} for {}.".format(d['eolMediaURL'], image_final))
         try:
-            urllib.request.urlretrieve(d['eolMediaURL'], image_orig)
-            os.chmod(image_orig, 0o664) #allow both the webserver and the web2py user (both in the same group) to overwrite these files
+            with urllib.request.urlopen(d['eolMediaURL'], timeout=60) as response:
+                image_data = response.read()
         except urllib.error.HTTPError as err:
             if err.code == 404:
-                logger.warning("404: File '{0}' missing for data object {1} @ http://eol.org/data_objects/{1}".format(d['eolMediaURL'], image_orig))
+                logger.warning("404: File '{0}' missing for data object {1} @ http://eol.org/data_objects/{1}".format(d['eolMediaURL'], fn))
                 return None
             else:
                 raise
-        #calculate fractions as proportion of square thumbnail
-        try:
-            initial_thumb_px = float(d['crop_width'])
-            if initial_thumb_px < 1:
-                raise KeyError  # The crop_width is not really a valid value: pretend it wasn't there
-            crop_top_fraction = float(d['crop_y'])/initial_thumb_px
-            crop_bottom_fraction = (float(d['height']) - float(d['crop_y']) - initial_thumb_px)/initial_thumb_px
-            crop_left_fraction = float(d['crop_x'])/initial_thumb_px
-            crop_right_fraction = (float(d['width']) - float(d['crop_x']) - initial_thumb_px)/initial_thumb_px
-            
-            min_crop_fraction = min(crop_top_fraction, crop_bottom_fraction, crop_left_fraction, crop_right_fraction)
-            if min_crop_fraction < 0:
-                #the crop is right against the corner, and we cannot make it bigger
-                top = str(int(round(float(d['crop_y']))))
-                left = str(int(round(float(d['crop_x']))))
-                size = str(int(round(float(d['crop_width']))))
-                if add_percent>0:
-                    logger.debug("Cannot expand crop for data object {} by {}%: image is against the edge.".format(fn, add_percent))
-            else:
-                if min_crop_fraction > add_percent/100.0:
-                    min_crop_fraction = add_percent/100.0
-                else:
-                    if add_percent>0:
-                        logger.debug("NOTICE: Cannot expand crop for data object {} by {}%: borders are not large enough, so using {}%.".format(fn, add_percent, min_crop_fraction*100))
-                min_crop_pixels = min_crop_fraction * initial_thumb_px
-                top = str(int(round(float(d['crop_y']) - min_crop_pixels)))
-                left = str(int(round(float(d['crop_x']) - min_crop_pixels)))
-                size = str(int(round(initial_thumb_px + 2*min_crop_pixels)))
-                logger.log(logging.EXTREME_DEBUG, "crop info: {}...{}, {}".format(initial_thumb_px, 2*min_crop_pixels, size))
-            cmd = [CONVERT, image_orig, '-crop', size+'x'+size+'+'+left+'+'+top, '+repage', 
-                   '-resize', str(thumbnail_size)+'x'+str(thumbnail_size), image_intermediate
-                   ]
-            logger.debug("Custom crop: {}.".format(" ".join(cmd)))
-        except KeyError:
-            #hasn't got crop info: use default
-            cmd = [CONVERT, image_orig, '-gravity', 'Center', 
-                   '-resize', str(thumbnail_size)+'x'+str(thumbnail_size)+'^', "-extent", str(thumbnail_size)+'x'+str(thumbnail_size), image_intermediate
-                   ]
-            logger.debug("Default crop: {}.".format(" ".join(cmd)))
-        call(cmd)
+        box = crop_box(d, add_percent, fn)
+        logger.debug("{} crop for {}: {}.".format("Default" if box is None else "Custom", fn, box))
+        thumbnail = make_thumbnail(io.BytesIO(image_data), box, thumbnail_size)
         r, l = get_credit(d, fn)
         copyright_str = ' / '.join([r, l])
         rating = convert_rating(d['dataRating']) #EXIF 'Rating' is 16bit unsigned, i.e. 0-65535. EoL ratings are 0-5 floating point, so for ease of mapping we multiply EOL ratings by 10,000 to get ratings from 0-50,000
-        #call(['exiftool', '-q', '-codedcharacterset=utf8', '-IPTC:Contact='+'http://eol.org/data_objects/'+fn, '-IPTC:Credit='+r, '-IPTC:CopyrightNotice='+l, '-overwrite_original', '-m', image_orig])
-        piexif.insert(piexif.dump({"0th":{piexif.ImageIFD.Copyright:copyright_str.encode("utf8"), piexif.ImageIFD.Rating:rating}, "Exif":{}}), image_intermediate)
-        logger.info("Downloaded with rating {} and cropped into {}".format(rating, image_intermediate))
-    except OSError as e: 
-        logger.error("Cannot call 'convert' properly: {}\n Have you installed Imagemagick?".format(e))      
+        exif = piexif.dump({"0th":{piexif.ImageIFD.Copyright:copyright_str.encode("utf8"), piexif.ImageIFD.Rating:rating}, "Exif":{}})
+        thumbnail_data = io.BytesIO()
+        thumbnail.save(thumbnail_data, 'JPEG', quality=92, exif=exif)
+        logger.info("Downloaded with rating {} and cropped {}".format(rating, fn))
+    except (OSError, ValueError) as e:
+        logger.error("Cannot download or crop the image for data object {}: {}".format(fn, e))
         return None
     try:
-        os.remove(image_orig)
-        os.chmod(image_intermediate, 0o664) #allow both www & web2py to overwrite, etc
-        if os.path.exists(image_final) and filecmp.cmp(image_intermediate, image_final, shallow=False):
-            logger.info("Deleted large original, but cropped version is identical to old image ({}), so not replacing".format(image_final))
-            os.remove(image_intermediate)
-        else:
+        if os.path.exists(image_final):
+            with open(image_final, 'rb') as f:
+                if f.read() == thumbnail_data.getvalue():
+                    logger.info("Cropped version is identical to old image ({}), so not replacing".format(image_final))
+                    return (r,l)
+        #write to a temporary file in the same dir, so the image can be moved into place in one step
+        handle, image_intermediate = tempfile.mkstemp(prefix=fn + '_', suffix='_tmp.jpg', dir=output_dir)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(thumbnail_data.getvalue())
+            os.chmod(image_intermediate, 0o664) #allow both www & web2py to overwrite, etc
             os.replace(image_intermediate, image_final)
-            logger.info("Deleted large original and moved cropped image from {} into {}".format(image_intermediate, image_final))
+        except OSError:
+            os.remove(image_intermediate)
+            raise
+        logger.info("Saved cropped image into {}".format(image_final))
     except OSError as e: 
-        logger.warning("Could not remove the original downloaded file, or move the new file to its final place: {} \nPerhaps EoL has a problem.".format(e))      
+        logger.warning("Could not move the new file to its final place: {}".format(e))
         return None
     return (r,l)
 
+def thumb_dir(img_dir, src, src_id):
+    """
+    The directory under img_dir in which to save the image for (src, src_id), as in img.thumb_path
+    """
+    return os.path.join(img_dir, str(src), subdir_name(src_id))
+
+def crop_images(pending, get_data_object, save_dir, thumbnail_size, add_percent=12.5, threads=4):
+    """
+    Download, crop, resize and tag the images for a queue of pending (src, src_id) pairs, using a pool of
+    `threads` workers. Most of the work (downloading, and decoding and resizing in PIL) releases the GIL, so
+    threads are enough to keep several cores busy. get_data_object(src, src_id) should return the EoL json
+    data object for the image, or None to skip it, and save_dir(src, src_id) the directory in which to save
+    it as {src_id}.jpg (usually thumb_dir(img_dir, src, src_id)). Both are called from the worker threads.
+    Duplicate pairs are only processed once.
+    
+    Returns a dict mapping each (src, src_id) pair to the (rights, licence) of the saved image, or None if
+    it could not be saved.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def crop(pair):
+        src, src_id = pair
+        try:
+            d = get_data_object(src, src_id)
+            if d is None:
+                return None
+            return get_file_from_json_struct(d, save_dir(src, src_id), src_id, thumbnail_size, add_percent)
+        except Exception as e:
+            logger.warning("Could not get image for {}: {}".format(pair, e))
+            return None
+
+    pending = list(dict.fromkeys(pending))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(pending, executor.map(crop, pending)))
+
 if __name__ == "__main__":
     import requests
     from requests.packages.urllib3.util.retry import Retry
     from requests.adapters import HTTPAdapter
     import argparse
     import csv
+    import threading
 
     class writeable_dir(argparse.Action):
         def __call__(self,parser, namespace, values, option_string=None):
@@ -292,6 +371,7 @@ if __name__ == "__main__":
     #parser.add_argument('--force_size', '-z', action="store_true", help="force the thumbnail to be the maximum size (don't allow smaller thumbnails for small pictures)")
     parser.add_argument('--force_overwrite', '-f', action="store_true", help='download and crop even if the image file already exists')
     parser.add_argument('--retries', '-r', type=int, default=5, help='number of times to retry getting the image')
+    parser.add_argument('--threads', type=int, default=4, help='number of images to download and crop in parallel')
     parser.add_argument('--verbosity', '-v', action="count", default=0, help='verbosity: output extra non-essential info')
     parser.add_argument('--EOL_API_key', '-k', default=None, help='your EoL API key. If not given, the script looks for the variable api.eol_api_key in the file {} (relative to the script location)'.format(default_appconfig_file))
     args = parser.parse_args()
@@ -317,22 +397,29 @@ if __name__ == "__main__":
                     if m:
                         args.EOL_API_key = m.group(1)
 
-    #make a single http session, which we can tweak
-    s = requests.Session()
-    retries = Retry(total= args.retries,
-                    backoff_factor=2,
-                    status_forcelist=[ 500, 502, 503, 504 ])
-    s.mount('http://', HTTPAdapter(max_retries=retries))
+    #make an http session for each worker thread, which we can tweak
+    http_sessions = threading.local()
+    def get_data_object_for(src, DOid):
+        if os.path.isfile(os.path.join(save_dir(src, DOid), str(DOid) + '.jpg')) and not args.force_overwrite:
+            logger.info("File for {} already exists, ignoring.".format(DOid))
+            return None
+        if not hasattr(http_sessions, 's'):
+            http_sessions.s = requests.Session()
+            retries = Retry(total= args.retries,
+                            backoff_factor=2,
+                            status_forcelist=[ 500, 502, 503, 504 ])
+            http_sessions.s.mount('http://', HTTPAdapter(max_retries=retries))
+        return get_data_object(DOid, http_sessions.s, args.EOL_API_key)
                 
+    # The output dir is specific to the image source, so the src in the (src, src_id) pairs is unused
     if args.omit_suffix_dir: 
-        save_dir = lambda DOid: args.output_dir
+        save_dir = lambda src, DOid: args.output_dir
     else:
-        save_dir = lambda DOid: os.path.join(args.output_dir, subdir_name(DOid))
+        save_dir = lambda src, DOid: os.path.join(args.output_dir, subdir_name(DOid))
     
+    DOids = []
     if args.DOid:
-        for d in args.DOid:
-            get_file_from_doID(d, s, save_dir(d), args.thumbnail_size, args.EOL_API_key,
-                               args.add_percent, args.force_overwrite)
+        DOids.extend(args.DOid)
     if args.file:
         with args.file as f:
             reader = csv.reader(f)
@@ -340,9 +427,7 @@ if __name__ == "__main__":
                 if len(line) > args.csvfield-1:
                     try:
                         if (args.start_after is None):
-                            d=str(int(line[args.csvfield-1]))
-                            get_file_from_doID(d, s, save_dir(d), args.thumbnail_size, args.EOL_API_key, 
-                                               args.add_percent, args.force_overwrite)
+                            DOids.append(str(int(line[args.csvfield-1])))
                         else:
                             try:
                                 if args.start_after == int(line[args.csvfield-1]):
@@ -358,4 +443,5 @@ if __name__ == "__main__":
                                 logger.warning("Could not convert field {} to an EoL data object ID for line :'{}'".format(args.csvfield-1, ",".join(line)))
                     except IndexError:
                         logger.warning("Could not get index {} from {}".format(args.csvfield,line))              
-    
+    crop_images([(None, d) for d in DOids], get_data_object_for, save_dir,
+                args.thumbnail_size, args.add_percent, args.threads)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prepare the tree data files for a version (completetree_<version>.js, cut_position_map_<version>.js
+and dates_<version>.js in static/FinalOutputs/data) to be served as immutable, long-cached
+assets. For each version this writes
+
+  * <file>.gz (if missing or out of date) and <file>.br (if the brotli package is
+    installed) for each of the files above
+  * tree_files_<version>.json: a manifest giving the sha256 hash and size of each file
+    and the names and sizes of its compressed variants, as read by modules/tree_files.py.
+    The tree viewer then loads the files from the static folder, at URLs including their
+    hashes, and nginx serves the compressed variants (see install-nginx.sh)
+
+The manifest is written last, so the files it lists are always complete. This should be
+run after a new tree has been built into static/FinalOutputs/data, e.g.
+
+    OZprivate/ServerScripts/Utilities/precompress_tree_files.py 28017344
+
+With no version given, all versions without a manifest are processed.
+"""
+import os
+import sys
+import re
+import argparse
+import gzip
+import hashlib
+import json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+def info(*objs):
+    try:
+        if args.verbosity<1:
+            return
+    except:
+        pass;
+    print(*objs, file=sys.stderr)
+
+default_data_dir = "../../../static/FinalOutputs/data"
+file_stems = ("completetree", "cut_position_map", "dates")
+
+
+def write_if_changed(path, data):
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+
+def existing_gzip(path, data):
+    """Return True if path is a gzip file of data (e.g. one made when building the tree)"""
+    try:
+        with gzip.open(path, "rb") as f:
+            return f.read() == data
+    except (OSError, EOFError):
+        return False
+
+
+def process_version(data_dir, version):
+    files = {}
+    names = [n for n in (
+        ["{}_{}.js".format(stem, version) for stem in file_stems] + ["dates_{}.json".format(version)]
+    ) if os.path.isfile(os.path.join(data_dir, n))]
+    if "completetree_{}.js".format(version) not in names:
+        warning("No completetree_{}.js in {}".format(version, data_dir))
+        return False
+
+    for name in names:
+        path = os.path.join(data_dir, name)
+        with open(path, "rb") as f:
+            data = f.read()
+        entry = files[name] = dict(sha256=hashlib.sha256(data).hexdigest(), size=len(data), encodings={})
+        if not existing_gzip(path + ".gz", data):
+            info("Compressing {} with gzip".format(name))
+            write_if_changed(path + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+        entry['encodings']['gzip'] = dict(file=name + ".gz", size=os.path.getsize(path + ".gz"))
+        if brotli is not None:
+            info("Compressing {} with brotli".format(name))
+            write_if_changed(path + ".br", brotli.compress(data, quality=11))
+            entry['encodings']['br'] = dict(file=name + ".br", size=os.path.getsize(path + ".br"))
+
+    manifest = json.dumps(dict(version=version, files=files), indent=1, sort_keys=True).encode()
+    write_if_changed(os.path.join(data_dir, "tree_files_{}.json".format(version)), manifest)
+    info("Wrote manifest for version {}: {} files".format(version, len(files)))
+    return True
+
+
+parser = argparse.ArgumentParser(description='Write precompressed copies and a manifest of content hashes for the tree data files')
+parser.add_argument('versions', nargs='*', type=int, help='the tree versions to process. If none are given, process all those without a manifest')
+parser.add_argument('--data_dir', default=None, help='the folder containing the tree data files. Defaults to {} (relative to the script location)'.format(default_data_dir))
+parser.add_argument('--verbosity', '-v', default=0, action="count", help='verbosity: output extra non-essential info')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    data_dir = args.data_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), default_data_dir)
+    if brotli is None:
+        warning("The brotli package is not installed, so only gzip versions will be made")
+    versions = args.versions
+    if not versions:
+        versions = sorted(
+            int(m.group(1)) for m in (re.match(r"completetree_(\d+)\.js$", n) for n in os.listdir(data_dir))
+            if m and not os.path.isfile(os.path.join(data_dir, "tree_files_{}.json".format(m.group(1)))))
+    failed = [v for v in versions if not process_version(data_dir, v)]
+    if failed:
+        sys.exit(1)
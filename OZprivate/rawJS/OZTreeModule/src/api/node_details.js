@@ -8,8 +8,46 @@ class NodeDetailsAPI {
   constructor() {
     this.leaves_in_cache = [];
     this.nodes_in_cache = [];
+    // otts of representative leaves (not explicitly requested) already returned by the API
+    this.rep_otts_held = new Set();
+    this.rep_otts_image_source = null;
+    this.rep_otts_lang = null;
     this.update_metadata_header(col_headers);
   }
+  /**
+   * Return a comma-separated list of the representative leaf otts we already hold details
+   * for, which the API then need not return again (empty if this is turned off in the config)
+   */
+  cached_otts() {
+    if (!config.api.node_details_send_cached_otts) return "";
+    if (this.rep_otts_image_source !== data_repo.image_source || this.rep_otts_lang !== config.lang) {
+      // The images or vernaculars we hold are for a different image source or language
+      // (e.g. tree_settings.change_language has cleared the vernaculars)
+      this.rep_otts_held.clear();
+      this.rep_otts_image_source = data_repo.image_source;
+      this.rep_otts_lang = config.lang;
+    }
+    return Array.from(this.rep_otts_held).join(",");
+  }
+  /**
+   * Remember the otts of leaves returned by the API that weren't explicitly requested
+   * (i.e. representative leaves), keeping at most node_details_max_cached_otts of them
+   */
+  record_rep_otts(res, requested_leaf_ids) {
+    if (!config.api.node_details_send_cached_otts) return;
+    let requested = new Set(requested_leaf_ids);
+    for (let i=0; i<res.leaves.length; i++) {
+      let ott = res.leaves[i][this.leaf_cols["ott"]];
+      if (ott && !requested.has(res.leaves[i][this.leaf_cols["id"]])) {
+        this.rep_otts_held.delete(ott);  // re-add, so it becomes the most recent
+        this.rep_otts_held.add(ott);
+      }
+    }
+    for (let ott of this.rep_otts_held) {
+      if (this.rep_otts_held.size <= config.api.node_details_max_cached_otts) break;
+      this.rep_otts_held.delete(ott);
+    }
+  }
   
   start(controller) {
     //fill these in on start as they may not be defined in config until then
@@ -239,11 +277,13 @@ function node_detail_ajax_call_2(node_details_api, controller, nodes_to_fetch, l
     data: {
       node_ids: nttoids.join(","),
       leaf_ids: lttoids.join(","),
-      image_source: data_repo.image_source
+      image_source: data_repo.image_source,
+      cached_otts: node_details_api.cached_otts()
     },
     success: function(res) {
       try {
         data_repo.update_metadata(res);
+        node_details_api.record_rep_otts(res, lttoids);
         update_nodes_details(nodes_arr);
         update_nodes_details(leaves_arr);
         if (controller) controller.trigger_refresh_loop();
@@ -48,6 +48,9 @@ config.api = {
   node_details_node_num: 400,
   node_details_interval_when_idle: 1000,
   node_details_interval_when_busy: 200,
+  // Tell the API which representative leaves we already hold, so they are not sent again
+  node_details_send_cached_otts: false,
+  node_details_max_cached_otts: 2000,
 
   update_visit_count_api: null,
   update_visit_count_interval: 240000,  //update_visit_count_api every 4 mins
@@ -4,10 +4,16 @@ import sys
 import re
 from numbers import Number
 
+import api_usage
+import buffered_counts
 import OZfunc
 import img
 import sponsorship_search
 import pinpoint
+import search_index
+import tree_cache
+import tree_files
+import tree_topology
 """
 This contains the API functions - node_details, image_details, search_names, and search_sponsors. search_node also exists, which is a combination of search_names and search_sponsors.
 # request.vars:
@@ -58,32 +64,59 @@ def error():
     
 
 def version():
+    """
+    Return the tree version, and (if the tree data files have been precompressed, see
+    modules/tree_files.py) tree_files, the static URL of each data file including its
+    content hash, so that a changed file is never read from a cache
+    """
     v = OZfunc.__check_version()
     try:
-        return dict(version=int(v))
+        v = int(v)
     except ValueError:
         return dict(version=None, error=v)
+    hashes = tree_files.hashed_names(v)
+    if not hashes:
+        return dict(version=v)
+    return dict(version=v, tree_files={
+        name: URL('static', 'FinalOutputs/data/' + name, vars=dict(h=h), scheme=True, host=True)
+        for name, h in hashes.items()})
+
+def tree_file():
+    """
+    Serve a tree data file for a version, e.g. http://mysite/API/tree_file/completetree_<version>.js?h=<hash>,
+    precompressed and with a long-lived ETag if listed in the version's manifest (see
+    modules/tree_files.py). Unchanged files are answered with a 304 without being read.
+    This is only a fallback for servers which can't serve the precompressed static files
+    themselves: the tree viewer loads them from the static folder, as given by API/version.
+    """
+    session.forget(response)
+    response.headers["Access-Control-Allow-Origin"] = '*'
+    return tree_files.serve(request.args[0] if request.args else "")
 
 def node_details():
     """
     This is the main API call, and should be optimized to within an inch of its life. Some ideas:
     1) Move it to another process (not web2py). E.g. Falcon. See http://klen.github.io/py-frameworks-bench/
-    2) Put some of the load on the SQL server, but adding SQL joins rather than making 7
-        queries (but mysql does not support full outer joins, which we would need)
-    3) Do not return info about the leaf taxa in the representative image array, as we
-        probably end up returning these many times over and over again. Instead, we could
-        return the leaf IDs, and get the client to work out if we need to add them to the
-        next API call.
+    2) (Done) Put some of the load on the SQL server: all the lookups are now made in a
+        single round trip, see OZfunc.nodes_info_from_string()
+    3) (Done, opt-in) Do not return info about the leaf taxa in the representative image
+        array, as we probably end up returning these many times over and over again. The
+        client can pass the otts of representative leaves it already holds as a
+        comma-separated `cached_otts` list, and these will not be looked up or returned
+        (unless specifically requested in leaf_ids).
+    4) (Done) Cache responses in each worker, keyed by tree version, see
+        tree_cache.node_details()
     """
     session.forget(response)
     response.headers["Access-Control-Allow-Origin"] = '*'
     try:
         language = request.vars.lang or request.env.http_accept_language or 'en'
-        return OZfunc.nodes_info_from_string(
+        return tree_cache.node_details(
             request.vars.leaf_ids or "",
             request.vars.node_ids or "",
             include_names_in=language,
-            image_type=request.vars.get('image_source') or "")
+            image_type=request.vars.get('image_source') or "",
+            exclude_rep_otts=request.vars.cached_otts or "")
     except:  # E.g. if bad data has been passed in
         return {}
 
@@ -273,6 +306,11 @@ def search_by_name(searchFor, language, order_by_popularity=False, limit=None, s
     So if we want to also match against one or two letter words, we need to use normal text matches
     *in addition* to full text matches. For speed, we are restricted to matching at the start of the 
     entire phrase
+
+    To avoid all this, if the in-memory name index is turned on (tree_cache.search_index
+    in appconfig.ini) and has been built for the current tree, we use that instead: it
+    matches the start of any word, including one and two letter words, and returns hits
+    in order of popularity. See search_index.py
     """
     
     
@@ -304,6 +342,13 @@ def search_by_name(searchFor, language, order_by_popularity=False, limit=None, s
             )
         ):
             return ret
+        results = search_index.search(
+            searchFor, lang_primary, limit=limit, start=start,
+            restrict_tables=restrict_tables, include_price=include_price)
+        if results is not None:
+            ret['leaf_hits'] = results.get('ordered_leaves')
+            ret['node_hits'] = results.get('ordered_nodes')
+            return ret
         longWords = []
         shortWords = []
         for word in searchFor:
@@ -516,39 +561,25 @@ def get_ids_by_ott_array():
     return OZfunc.otts2ids(OZfunc.query_val_to_ints(request.vars.getlast("ott_array", "")))
 
 def update_visit_count():
+    """
+    Count hits on the otts in the comma-separated api_hits, search_hits and
+    leaf_click_count request variables. Counts are buffered in memory and written to the
+    visit_count table in periodic batches (see modules/buffered_counts.py), so that
+    many viewers reporting at once do not contend for the same visit_count rows.
+    """
     session.forget(response)
     response.headers["Access-Control-Allow-Origin"] = '*'
     try:
-        if request.vars.api_hits:            
-            values = []
-            for ott in request.vars.api_hits.split(","):
-                values.append("(" + ott + ",1,0,0)")
-            values = ",\n".join(values)
-            query = "insert into visit_count (ott, detail_fetch_count, search_count, leaf_click_count) values \n" + values + "\n"
-            query = query + "on duplicate key update detail_fetch_count = detail_fetch_count + 1"
-            db.executesql(query)
-            
-        if request.vars.search_hits:
-            values = []
-            for ott in request.vars.search_hits.split(","):
-                values.append("(" + ott + ",0,1,0)")
-            values = ",\n".join(values)
-            query = "insert into visit_count (ott, detail_fetch_count, search_count, leaf_click_count) values \n" + values + "\n"
-            query = query + "on duplicate key update search_count = search_count + 1"
-            db.executesql(query)
-            
-        if request.vars.leaf_click_count:
-            values = []
-            for ott in request.vars.leaf_click_count.split(","):
-                values.append("(" + ott + ",0,0,1)")
-            values = ",\n".join(values)
-            query = "insert into visit_count (ott, detail_fetch_count, search_count, leaf_click_count) values \n" + values + "\n"
-            query = query + "on duplicate key update leaf_click_count = leaf_click_count + 1"
-            db.executesql(query)
-            
-        return {"status":"success"}
+        buffered_counts.record_visits(
+            request.vars.api_hits, request.vars.search_hits, request.vars.leaf_click_count)
     except:
         return {"status":"failure"}
+    try:
+        buffered_counts.flush_visits()
+    except Exception:
+        # The counts remain buffered, and will be written on a later call
+        buffered_counts.logger.exception("Could not write visit counts")
+    return {"status":"success"}
     
     
 def get_id_by_ott():
@@ -558,6 +589,19 @@ def get_id_by_ott():
     session.forget(response)
     response.headers["Access-Control-Allow-Origin"] = '*'
     ott = request.vars.ott
+    topology = tree_topology.get()
+    if topology is not None:
+        try:
+            ozids = topology.ozids_for_ott(int(ott))
+        except (TypeError, ValueError):
+            return {"id": "none"}
+        # As in the database: the first node, otherwise the first leaf
+        nodes = [ozid for ozid in ozids if ozid > 0]
+        if nodes:
+            return {"id": nodes[0]}
+        if len(ozids):
+            return {"id": max(ozids)}
+        return {"id": "none"}
     query = db.ordered_nodes.ott == ott
     result = db(query).select(db.ordered_nodes.id, db.ordered_nodes.ott)
     if len(result) > 0:
@@ -583,6 +627,7 @@ def getOTT():
     response.headers["Access-Control-Allow-Origin"] = '*'
     sources = ["eol", "gbif", "ncbi", "iucn"]
     data = {'errors': []}
+    topology = tree_topology.get()
 
     for s in sources:
         if not request.vars.get(s, False):
@@ -597,6 +642,9 @@ def getOTT():
             data['errors'].append("%s could not be converted to int" % s)
             continue
 
+        if topology is not None:
+            data[s] = topology.ott_map(s, id_list)
+            continue
         leaf_rows = db(db.ordered_leaves[s].belongs(id_list)).select(db.ordered_leaves[s], db.ordered_leaves.ott)
         if s == 'iucn':
             node_rows = ()
@@ -611,18 +659,34 @@ def children_of_OTT():
         http://mysite/children_of_OTT.json/13943?sort=popularity&max=10. The parameters <sortcol>, <max> and <page> are optional, with defaults
         <sortcol> = id, <max> = 50 and <page>=1. if <max> is greater than 1000 it is set to 1000, to avoid responding with huge queries.
         The JSON returned should have the ott, name (scientific name), eol, wikidataQ, and popularity  
+        To fetch all the leaves of a large clade, pass after= (empty) rather than page=1, and on each following request pass
+        after=<next>, where <next> is the cursor returned in the previous response (null when there are no more leaves). Each
+        page then starts from where the last one finished, rather than skipping over all the previous pages. This only works
+        with <sortcol> = id (the default), popularity or POPULARITY.
     """
     try:
         OTTid = int(request.args[0])
-        query = OZfunc.child_leaf_query('ott', OTTid)
-        query = query & (db.ordered_leaves.eol!=None)
+    except ValueError: # probably bad int inputted
+        return(dict(errors=['OTT id must be an integer'], data=None))
+    query = OZfunc.child_leaf_query('ott', OTTid)
+    query = query & (db.ordered_leaves.eol!=None)
+    if request.vars.after is None:
         rows = select_leaves(query,
                              request.vars.get('page'),
                              request.vars.get('max'),
                              request.vars.get('sort'))
         return(dict(data={'rows':rows.as_list(), 'EOL2OTT':{r.eol:r.ott for r in rows}}))
-    except ValueError: # probably bad int inputted
-        return(dict(errors=['OTT id must be an integer'], data=None))
+    try:
+        rows, next_after = select_leaves_after(query,
+                                         request.vars.after,
+                                         request.vars.get('max'),
+                                         request.vars.get('sort'))
+    except ValueError as e:
+        return(dict(errors=[str(e)], data=None))
+    return(dict(data={
+        'rows':[{k: v for k, v in r.items() if k != 'id'} for r in rows.as_list()],
+        'EOL2OTT':{r.eol:r.ott for r in rows},
+        'next':next_after}))
 
 def children_of_EOL():
     """ Return a set of terminal nodes for this OTT taxon: easily done using the nested set representation. The URL is of the form
@@ -631,18 +695,28 @@ def children_of_EOL():
         http://mysite/descendant_leaves.json/2684257?sort=popularity&max=10. The parameters <sortcol>, <max> and <page> are optional, with defaults
         <sortcol> = id, <max> = 50 and <page>=1. if <max> is greater than 1000 it is set to 1000, to avoid responding with huge queries.
         The JSON returned should have the ott, name (scientific name), eol, wikidataQ, and popularity  
+        Pages can also be fetched with an after=<next> cursor, as for children_of_OTT
     """
     try:
         EOLid = int(request.args[0])
-        query = OZfunc.child_leaf_query('eol', EOLid)
-        query = query & (db.ordered_leaves.eol!=None)
+    except ValueError: # probably bad int inputted
+        return(dict(errors=['EOL id must be an integer'], data=None))
+    query = OZfunc.child_leaf_query('eol', EOLid)
+    query = query & (db.ordered_leaves.eol!=None)
+    if request.vars.after is None:
         rows = select_leaves(query,
                              request.vars.get('page'),
                              request.vars.get('max'),
                              request.vars.get('sort'))
         return(dict(data={'EOL2OTT':{r.eol:r.ott for r in rows}}))
-    except ValueError: # probably bad int inputted
-        return(dict(errors=['EOL id must be an integer'], data=None))
+    try:
+        rows, next_after = select_leaves_after(query,
+                                         request.vars.after,
+                                         request.vars.get('max'),
+                                         request.vars.get('sort'))
+    except ValueError as e:
+        return(dict(errors=[str(e)], data=None))
+    return(dict(data={'EOL2OTT':{r.eol:r.ott for r in rows}, 'next':next_after}))
 
 
 ############################
@@ -864,6 +938,67 @@ def select_leaves(query, page=None, limit=None, sortcol=""):
     return db(query).select(limitby=limitby, orderby=orderby, *select)
 
 
+def select_leaves_after(query, after, limit=None, sortcol=""):
+    """
+    Selects on a query using keyset pagination: return up to 'limit' rows following on from the
+    leaf given by the cursor 'after' (from the start if empty), plus the cursor for the next
+    page (None if there are no more rows). Rows are in id order (i.e. leaf_lft order within a
+    clade), or by popularity then id, both ascending ('popularity') or both descending
+    ('POPULARITY'). Each page is read from the primary key or the (popularity, id) index
+    (pop_index in OZprivate/ServerScripts/SQL/create_db_indexes.sql) starting at the cursor, so
+    reading all the pages is linear in the number of rows, unlike using offsets in select_leaves.
+    NULL popularities sort as in MySQL.
+    """
+    leaves = db.ordered_leaves
+    select = [leaves[field] for field in ['ott', 'name', 'eol', 'wikidata', 'popularity', 'id']]
+    try:
+        limit = min(int(limit or 40), 1000)
+    except ValueError:
+        limit = 40
+    sortcol = sortcol or "id"
+    if sortcol.lower() not in ("id", "popularity"):
+        raise ValueError("Can only page through leaves sorted by id, popularity or POPULARITY")
+    by_popularity = sortcol.lower() == "popularity"
+    descending = by_popularity and sortcol != sortcol.lower()
+    if after:
+        try:
+            if by_popularity:
+                pop, last_id = after.split("_")
+                pop = None if pop == "null" else float(pop)
+            else:
+                last_id = after
+            last_id = int(last_id)
+        except ValueError:
+            raise ValueError("Invalid 'after' cursor for sort={}: use the 'next' value from the previous page".format(sortcol))
+        # Ties are broken by id in the same direction, so the (popularity, id) index can be
+        # read forwards or backwards from the cursor
+        same = (leaves.id < last_id) if descending else (leaves.id > last_id)
+        if not by_popularity:
+            query &= same
+        elif pop is None:
+            # NULL popularities are first in ascending order, last in descending order
+            query &= (leaves.popularity == None) & same if descending else \
+                ((leaves.popularity == None) & same) | (leaves.popularity != None)
+        elif descending:
+            query &= (leaves.popularity < pop) | ((leaves.popularity == pop) & same) | (leaves.popularity == None)
+        else:
+            query &= (leaves.popularity > pop) | ((leaves.popularity == pop) & same)
+    if not by_popularity:
+        orderby = leaves.id
+    elif descending:
+        orderby = ~leaves.popularity | ~leaves.id
+    else:
+        orderby = leaves.popularity | leaves.id
+    rows = db(query).select(limitby=(0, limit + 1), orderby=orderby, *select)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows.last()
+    if not by_popularity:
+        return rows, str(last.id)
+    return rows, "{}_{}".format("null" if last.popularity is None else repr(last.popularity), last.id)
+
+
 def make_unicode(input):
     try:
         if input and type(input) != unicode:
@@ -877,15 +1012,14 @@ def get_limits(API_key):
     """
     Similar to get_limits in popularity.py but only return the max taxa allowed per query
     """
-    results = db(db.API_users.APIkey == API_key).select(db.API_users.ALL)
-    if results:
-        result = results.first()
-        if result.max_taxa_per_query:
-            return result.max_taxa_per_query
+    result = api_usage.api_user(API_key)
+    if result:
+        if result['max_taxa_per_query']:
+            return result['max_taxa_per_query']
         else:
             redirect(URL('error', vars=dict(
                 code=400,
-                text=f"Sorry, the API key {result.APIkey} ({result.API}) is no longer allowed"
+                text=f"Sorry, the API key {result['APIkey']} ({result['API_user_name']}) is no longer allowed"
             )))
     else:
         redirect(URL('error', vars=dict(
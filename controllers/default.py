@@ -12,7 +12,9 @@ import json
 from collections import OrderedDict
 
 import ozmail
+import sponsorable_index
 import tour
+import tree_cache
 from embed import embedize_url
 from sponsorship import (
     sponsorship_enabled, reservation_total_counts, clear_reservation, get_reservation,
@@ -21,7 +23,7 @@ from sponsorship import (
     sponsorship_expiry_soon_date,
     sponsorship_email_reminders, sponsor_verify_url,
     sponsorship_restrict_contact, sponsor_renew_request_logic,
-    sponsorship_config, sponsorable_children_query)
+    sponsorship_config, sponsorable_children_query, precomputed_sponsorable_children)
 from pinpoint import resolve_pinpoint_to_row
 
 from usernames import donor_name_for_username
@@ -149,14 +151,21 @@ def index():
         if key not in images:
             images[key] = blank
 
+    # The remaining blocks are cached between requests (see tree_cache.homepage_block),
+    # with the quotes picked at random from a cached list
+    quotes = tree_cache.homepage_block('quotes', lambda: [
+        list(db(db.quotes.quality >= 190).select(db.quotes.ALL)),
+        list(db((db.quotes.quality < 190) & (db.quotes.quality >= 100)).select(db.quotes.ALL)),
+    ], stamps=('quotes', ))
+    sponsored = tree_cache.homepage_block('sponsored', lambda: dict(
+        donors=reservation_total_counts('donors'),
+        otts=reservation_total_counts('otts'),
+    ), stamps=('reservations', ))
     return dict(
-        n_species=db(db.ordered_leaves).count(),
-        n_images=db(db.images_by_ott).count(),
-        quotes=[
-            db(db.quotes.quality >= 190).select(db.quotes.ALL, orderby='<random>', limitby=(0, 2)),
-            db((db.quotes.quality < 190) & (db.quotes.quality >= 100)).select(db.quotes.ALL, orderby='<random>', limitby=(0, 8))
-            ],
-        news=[
+        n_species=__homepage_n_species(),
+        n_images=tree_cache.homepage_block('n_images', lambda: db(db.images_by_ott).count()),
+        quotes=[random.sample(rows, min(n, len(rows))) for rows, n in zip(quotes, (2, 8))],
+        news=tree_cache.homepage_block('news', lambda: [
             dict(
                 heading=row.text_date if row.text_date else row.news_date.strftime("%d %B %Y").lstrip('0'),
                 body=row.html_description.replace(' class="thumbnail"', ' style="display:none"'),
@@ -164,17 +173,23 @@ def index():
                 more_href=URL("timeline.html#news-item{}".format(row.id))
             )
             for row in db().select(db.news.ALL, orderby =~ db.news.news_date, limitby = (0, 5))
-        ],
+        ], stamps=('news', )),
         carousel=carousel,
         hrefs=hrefs, images=images, html_names=titles, has_vernacular=has_vernacular, add_the=add_the,
-        n_total_sponsored=reservation_total_counts('donors'),
-        n_sponsored_leaves=reservation_total_counts('otts'),
+        n_total_sponsored=sponsored['donors'],
+        n_sponsored_leaves=sponsored['otts'],
         menu_splash_images={
             sub_menu[0]:URL('static', 'images/oz-newssplash-%s.jpg' % sub_menu[0].lower().replace("for ", ""))
             for sub_menu in response.menu
         }
     )
 
+def __homepage_n_species():
+    """
+    The number of species in the tree, which only changes when a new tree is loaded
+    """
+    return tree_cache.homepage_block('n_species', lambda: db(db.ordered_leaves).count())
+
 def footer_sponsor_items():
     """
     Three hardcoded images for groups that can be sponsored - appears on every page =>
@@ -1198,7 +1213,9 @@ def sponsor_node_price():
       millions of leaves according to the image ranking. For this reason, we make 2
       queries, firstly for leaves with an image, ranked by image rating, and then 
       (if we don't get enough results returned) for leaves without an image, ranked
-      by popularity.
+      by popularity. For large nodes, the leaves are instead read from lists made in
+      advance (see sponsorship.precomputed_sponsorable_children), if available. Ties are
+      broken by ott, as in those lists, so that both give the same order.
     """
     price_levels_pence = {
         row.price: (str(row.class_description), str(row.price_description))
@@ -1211,11 +1228,12 @@ def sponsor_node_price():
     lowest_price_pence = min(price_levels_pence.keys())
     try:
         if request.vars.get('id'):
-            query = sponsorable_children_query(int(request.vars.id), qtype="id")
+            target_id, qtype = int(request.vars.id), "id"
         elif request.vars.get('ott'):
-            query = sponsorable_children_query(int(request.vars.ott), qtype="ott")
+            target_id, qtype = int(request.vars.ott), "ott"
         else:
             raise
+        query = sponsorable_children_query(target_id, qtype=qtype)
         n = int(request.vars.get('n') or 6)
         start = int(request.vars.get('start') or 0)
         if request.vars.get('price'):
@@ -1227,7 +1245,17 @@ def sponsor_node_price():
         # Use some shortcuts
         img_tab = db.images_by_ott
         leaf_tab = db.ordered_leaves
-        if price_pence is None or price_pence > lowest_price_pence:
+        precomputed = precomputed_sponsorable_children(target_id, qtype, price_pence, start+n+1)
+        if precomputed is not None:
+            precomputed = precomputed[start:]
+            otts = [ott for ott, name in precomputed]
+            sci_names = dict(precomputed)
+            rows_with_img = db(img_tab.ott.belongs(otts) & (img_tab.overall_best_any == True)).select(
+                img_tab.ott, img_tab.src, img_tab.src_id, img_tab.rights, img_tab.licence)
+            image_urls = {r.ott: img.thumb_url(r.src, r.src_id) for r in rows_with_img}
+            image_attributions = {
+                r.ott: (' / '.join([t for t in [r.rights, r.licence] if t])) for r in rows_with_img}
+        elif price_pence is None or price_pence > lowest_price_pence:
             rows_with_img = db(query & (img_tab.overall_best_any)).select(
                 db.ordered_leaves.ott,
                 db.ordered_leaves.name,
@@ -1237,7 +1265,7 @@ def sponsor_node_price():
                 img_tab.licence,
                 join=img_tab.on(img_tab.ott == leaf_tab.ott),
                 limitby=(start, start+n+1), # add an extra one to check if more required
-                orderby=~img_tab.rating)
+                orderby=~img_tab.rating | leaf_tab.ott)
             otts = [r.ordered_leaves.ott for r in rows_with_img]
             sci_names = {
                 r.ordered_leaves.ott: r.ordered_leaves.name for r in rows_with_img}
@@ -1264,7 +1292,7 @@ def sponsor_node_price():
                     db.ordered_leaves.name,
                     left = db.images_by_ott.on(db.images_by_ott.ott == db.ordered_leaves.ott),
                     limitby=(start, start+extra_needed),
-                    orderby = "ordered_leaves.popularity DESC")
+                    orderby = "ordered_leaves.popularity DESC, ordered_leaves.ott")
                 otts.extend([species.ott for species in rows_without_images])
                 sci_names.update({species.ott:species.name for species in rows_without_images})
         else:
@@ -1296,7 +1324,7 @@ def sponsor_node_price():
                     db.images_by_ott.licence,
                     join = db.images_by_ott.on(db.images_by_ott.ott == db.ordered_leaves.ott),
                     limitby=(start, start+extra_needed), 
-                    orderby = "images_by_ott.rating ASC")
+                    orderby = "images_by_ott.rating ASC, ordered_leaves.ott")
                 image_urls = {
                     species.ordered_leaves.ott: img.thumb_url(species.images_by_ott.src, species.images_by_ott.src_id)
                     for species in rows_with_img
@@ -1383,6 +1411,19 @@ def sponsor_handpicks():
         image_urls = {}
         sci_names = {}
         html_names = {}
+        # Get all the bands at once, then split them up (keeping the order within each band)
+        rows_by_price = {}
+        for r in db(query &
+                     (db.ordered_leaves.price.belongs([p for p in prices_pence if p]) | (db.ordered_leaves.price == None)) &
+                     ((db.images_by_ott.overall_best_any == True) | (db.images_by_ott.overall_best_any == None))
+                     ).select(db.ordered_leaves.ott,
+                              db.ordered_leaves.name,
+                              db.ordered_leaves.price,
+                              db.images_by_ott.src,
+                              db.images_by_ott.src_id,
+                              left = db.images_by_ott.on(db.images_by_ott.ott == db.ordered_leaves.ott),
+                              orderby = orderby):
+            rows_by_price.setdefault(r.ordered_leaves.price, []).append(r)
         for p in prices_pence:
             if (p):
                 if (float(p)/100).is_integer():
@@ -1391,15 +1432,7 @@ def sponsor_handpicks():
                     price_pounds = '{:.2f}'.format(p/100.0)
             else:
                 price_pounds = "contact us"
-            rows = db(query &
-                      (db.ordered_leaves.price==p) & 
-                      ((db.images_by_ott.overall_best_any == True) | (db.images_by_ott.overall_best_any == None))
-                      ).select(db.ordered_leaves.ott, 
-                               db.ordered_leaves.name,
-                               db.images_by_ott.src,
-                               db.images_by_ott.src_id,
-                               left = db.images_by_ott.on(db.images_by_ott.ott == db.ordered_leaves.ott),
-                               orderby = orderby)
+            rows = rows_by_price.get(p, [])
             otts[price_pounds] = [r.ordered_leaves.ott for r in rows]
             image_urls.update({
                 species.ordered_leaves.ott: img.thumb_url(species.images_by_ott.src, species.images_by_ott.src_id)
@@ -1438,18 +1471,22 @@ def list_sponsorable_children():
     }
     try:
         if request.vars.get('id'):
-            query = sponsorable_children_query(int(request.vars.id), qtype="id")
+            target_id, qtype = int(request.vars.id), "id"
         elif request.vars.get('ott'):
-            query = sponsorable_children_query(int(request.vars.ott), qtype="ott")
-        limitby=(page*items_per_page,(page+1)*items_per_page+1)
-        species = db(query).select(db.ordered_leaves.ott, 
-                                   db.ordered_leaves.name,
-                                   db.ordered_leaves.price,
-                                   limitby=limitby, 
-                                   orderby=db.ordered_leaves.name)
+            target_id, qtype = int(request.vars.ott), "ott"
+        species, next_after = __sponsorable_children_page(target_id, qtype, page, items_per_page)
+        if species is None:
+            query = sponsorable_children_query(target_id, qtype=qtype)
+            limitby=(page*items_per_page,(page+1)*items_per_page+1)
+            species = db(query).select(db.ordered_leaves.ott, 
+                                       db.ordered_leaves.name,
+                                       db.ordered_leaves.price,
+                                       limitby=limitby, 
+                                       orderby=db.ordered_leaves.name)
         return dict(
             species=species,
             page=page,
+            next_after=next_after,
             items_per_page=items_per_page,
             price_levels_pence=price_levels_pence,
             sponsorship_enabled = sponsorship_enabled(),
@@ -1463,10 +1500,43 @@ def list_sponsorable_children():
             items_per_page=items_per_page,
             price_levels_pence=price_levels_pence,
             sponsorship_enabled = sponsorship_enabled(),
+            next_after=None,
             error="Sorry, you passed in an ID that doesn't seem to correspond to a group on the tree",
         )
 
 
+def __sponsorable_children_page(target_id, qtype, page, items_per_page):
+    """
+    Look up a page of list_sponsorable_children (plus one more leaf, to show if there are
+    more pages) using the in-memory sponsorable_index. The page starts after the leaf at
+    position request.vars.after in the index, if given (as in the link to the next page),
+    otherwise after skipping page*items_per_page leaves. Returns the leaves and the
+    position to start the next page after, or (None, None) to look them up in the
+    database instead.
+    """
+    index = sponsorable_index.get()
+    if index is None:
+        return None, None
+    node = db(
+        (db.ordered_nodes.id if qtype == "id" else db.ordered_nodes.ott) == target_id
+    ).select(db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt).first()
+    if node is None:
+        return None, None  # A leaf, not a clade
+    try:
+        after = int(request.vars.after)
+    except (TypeError, ValueError):
+        after = None
+    leaves = index.page(
+        node.leaf_lft, node.leaf_rgt, items_per_page + 1,
+        skip=0 if after is not None else page*items_per_page,
+        after=-1 if after is None else after,
+        unavailable=sponsorable_index.sponsored_otts())
+    rows = {r.id: r for r in db(db.ordered_leaves.id.belongs([id for pos, id in leaves])).select(
+        db.ordered_leaves.id, db.ordered_leaves.ott, db.ordered_leaves.name, db.ordered_leaves.price)}
+    species = [rows[id] for pos, id in leaves if id in rows]
+    return species, (leaves[items_per_page - 1][0] if len(leaves) > items_per_page else None)
+
+
 def pp_process_post():
     """
     Only visited by paypal, to confirm the payment has been made. For debugging problems, see
@@ -1697,7 +1767,7 @@ def accessibility():
 
 def FAQ():
     price_levels_pence = sorted([row.price for row in db().select(db.prices.price)])
-    return dict(n_species =  db(db.ordered_leaves).count(), second_cheapest_price_pence=price_levels_pence[1])
+    return dict(n_species = __homepage_n_species(), second_cheapest_price_pence=price_levels_pence[1])
 
 def gallery():
     return dict()
@@ -1876,32 +1946,40 @@ def text_tree(pinpoint_string):
         else:
             info[row.id]=row
             bases[row.id]=base
-        
-            #since the base is a node, we can iterate down it to find descendants
-            for row1 in db(db.ordered_nodes.real_parent == row.id).select(db.ordered_nodes.id, db.ordered_nodes.ott, db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt, db.ordered_nodes.name, orderby =~ db.ordered_nodes.id):
-                info[row1.id]=row1
-                base[row1.id]=list1=OrderedDict()
-                for row2 in db(db.ordered_nodes.real_parent == row1.id).select(db.ordered_nodes.id, db.ordered_nodes.ott, db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt, db.ordered_nodes.name, orderby =~ db.ordered_nodes.id):
-                    info[row2.id]=row2
-                    list1[row2.id]=list2=OrderedDict()
-                    for row3 in db(db.ordered_nodes.real_parent == row2.id).select(db.ordered_nodes.id, db.ordered_nodes.ott, db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt, db.ordered_nodes.name, orderby =~ db.ordered_nodes.id):
-                        info[row3.id]=row3
-                        list2[row3.id]=list3=OrderedDict()
-                        for row4 in db(db.ordered_nodes.real_parent == row3.id).select(db.ordered_nodes.id, db.ordered_nodes.ott, db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt, db.ordered_nodes.name, orderby =~ db.ordered_nodes.id):
-                            info[row4.id]=row4
-                            list3[row4.id]=list4=OrderedDict()
-                        for row4 in db(db.ordered_leaves.real_parent == row3.id).select(db.ordered_leaves.id, db.ordered_leaves.ott, db.ordered_leaves.name):
-                            info[-row4.id]=row4
-                            list3[-row4.id]=None
-                    for row3 in db(db.ordered_leaves.real_parent == row2.id).select(db.ordered_leaves.id, db.ordered_leaves.ott, db.ordered_leaves.name):
-                        info[-row3.id]=row3
-                        list2[-row3.id]=None
-                for row2 in db(db.ordered_leaves.real_parent == row1.id).select(db.ordered_leaves.id, db.ordered_leaves.ott, db.ordered_leaves.name):
-                    info[-row2.id]=row2
-                    list1[-row2.id]=None
-            for row1 in db(db.ordered_leaves.real_parent == row.id).select(db.ordered_leaves.id, db.ordered_leaves.ott, db.ordered_leaves.name):
-                info[-row1.id]=row1
-                base[-row1.id]=None
+
+            # Since the base is a node, find its descendants, a level at a time. Rather
+            # than a query per node, each level is a single query over the base's
+            # nested-set range, so the number of queries doesn't grow with fan-out.
+            # Nodes go 4 levels down, and leaves are included down to the 4th level.
+            node_cols = [
+                db.ordered_nodes.id, db.ordered_nodes.real_parent, db.ordered_nodes.ott,
+                db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt, db.ordered_nodes.name]
+            children_of = {row.id: base}
+            parent_ids = [row.id]
+            for depth in range(4):
+                next_ids = []
+                for child in db(
+                    (db.ordered_nodes.id > row.id) & (db.ordered_nodes.id <= row.node_rgt) &
+                    db.ordered_nodes.real_parent.belongs(parent_ids)
+                ).select(*node_cols, orderby =~ db.ordered_nodes.id):
+                    info[child.id] = child
+                    children_of[child.real_parent][child.id] = children_of[child.id] = OrderedDict()
+                    next_ids.append(child.id)
+                if not next_ids:
+                    break
+                parent_ids = next_ids
+            # Leaves are only included for the base and the first 3 levels of nodes
+            deepest = set(next_ids)
+            leaf_parents = [n for n in children_of if n not in deepest]
+            for leaf in db(
+                (db.ordered_leaves.id >= row.leaf_lft) & (db.ordered_leaves.id <= row.leaf_rgt) &
+                db.ordered_leaves.real_parent.belongs(leaf_parents)
+            ).select(
+                db.ordered_leaves.id, db.ordered_leaves.real_parent, db.ordered_leaves.ott,
+                db.ordered_leaves.name, orderby = db.ordered_leaves.id
+            ):
+                info[-leaf.id] = leaf
+                children_of[leaf.real_parent][-leaf.id] = None
     
     #now we have constructed the heirarchy, we can get the other info and fill it in 
     otts =[row.ott for row in info.values() if row.ott]
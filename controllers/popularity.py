@@ -3,7 +3,9 @@
 This contains the popularity API functions as used e.g. by Phylotastic.
 All code in this file is released under the public domain by the author, Yan Wong
 """
-import datetime
+import api_usage
+import popularity_index
+import tree_topology
 
 def index():
     """
@@ -25,45 +27,10 @@ def test():
     Pass in an OTT and get a list of the popularity ratings of the parents plus 
     a wikidata identifiers, so that we can query the current values using the wiki APIs
     
-    Uses a stored procedure in the DB like this:
-    
-    DELIMITER $$
-    DROP PROCEDURE IF EXISTS GetParents $$
-    CREATE PROCEDURE GetParents (GivenID INT, ColumnsReturned TEXT, WhereCondition TEXT)
-    /* This gets all the parents with wikidata IDs up to the root for a ordered_node ID */
-    BEGIN
-        DECLARE rv TEXT;
-        DECLARE cm CHAR(1);
-        DECLARE ch INT;
-        DECLARE loop_max INT;
-    
-        SET rv = '';
-        SET cm = '';
-        SET ch = GivenID;
-        SET loop_max = 5000; /* to avoid infinite loops - shouldn't have >5000 real parents in a tree */
-        WHILE ch <> 0  AND loop_max > 0 DO
-        	set loop_max = loop_max-1;
-            SELECT IFNULL(real_parent,0) INTO ch FROM
-            (SELECT real_parent, name FROM ordered_nodes WHERE id = ABS(ch)) A;
-            IF ch <> 0 THEN
-                SET rv = CONCAT(rv,cm,ch);
-                SET cm = ',';
-            END IF;
-        END WHILE;
-        SET @s = CONCAT('SELECT ', ColumnsReturned, ' FROM ordered_nodes');
-        IF WhereCondition = '' THEN
-            SET @s = CONCAT(@s, ' WHERE id IN (',rv,')');
-        ELSE
-            SET @s = CONCAT(@s, ' WHERE id IN (',rv,') AND (', WhereCondition, ')');
-        END IF;
-        SET @s = CONCAT(@s, ' ORDER BY id DESC');
-        PREPARE stmt1 FROM @s;
-        EXECUTE stmt1;
-    	DEALLOCATE PREPARE stmt1;
-        
-    END $$
-    DELIMITER ;
-
+    The lineage (following real_parent up to the root) comes from the in-memory tree
+    topology, so the ancestors are fetched in a single read by primary key. As when
+    this used the GetParents stored procedure, the lineage starts from the ancestors
+    of the taxon's real parent, which is not itself returned.
     """
     session.forget(response)
     response.headers["Access-Control-Allow-Origin"] = '*'
@@ -86,9 +53,11 @@ def test():
                         ",".join(headers + ['real_parent']), db.placeholder), ott)
                 
                 if len(taxon):
-                    taxon_parent = taxon[0][len(headers)]
-                    parents = db.executesql("CALL GetParents({}, '{}', '{}')".format(
-                        taxon_parent, ",".join(headers), 'wikidata is not NULL'))
+                    ancestors = tree_topology.lineage(abs(taxon[0][len(headers)] or 0))[1:]
+                    parents = db.executesql(
+                        "SELECT {} FROM ordered_nodes WHERE id IN ({}) AND wikidata IS NOT NULL ORDER BY id DESC".format(
+                            ",".join(headers), ",".join([db.placeholder] * len(ancestors))),
+                        ancestors) if ancestors else []
                     return {
                         'error':'' if len(taxon)==1 else 'Caution: the ott {} matched against {} taxa'.format(ott, len(taxon)), 
                         'taxa': [taxon[0]] + [p for p in parents], 'headers_index':headers_index
@@ -96,9 +65,6 @@ def test():
                 return {'error':'', 'taxa': [], 'headers_index':headers_index}
             except ValueError:
                 return {'error':"Something's not right: you need to provide an integer ott", 'taxa':[]}
-            except:
-                raise
-                return {'error':"Something's not right - have you defined the `GetParents()` stored procedure in your database?", 'taxa':[]}
         else:
             return {'error':'', 'taxa':False}
     else:
@@ -197,67 +163,53 @@ def list():
     )
     
     if queryvar_is_true("expand_taxa"):
-        #convert to a series of leaf constraints
-        n_taxa = 0
-        expanded_intervals = {} #save the left=>right spans of any nodes, so we can work out how many tips should have been returned
-        query = db.ordered_leaves.ott.belongs(otts)
-        sql_select = "SELECT `" + "`,`".join(colnames) + "` FROM ordered_leaves"
-        sql_template = sql_select + " WHERE {q} ORDER BY {o} LIMIT {n} OFFSET 0"
-        #select_columns = [getattr(db.ordered_leaves, a) for a in colnames]
-        #get the leaf_ids of any leaves in the set of otts, so we can count the max number returned
-        leaf_ids = sorted([row.id for row in db(query).select(db.ordered_leaves.id)])
-        results = db(db.ordered_nodes.ott.belongs(otts)).select(db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt)
+        #convert to a set of leaf id intervals, one for each leaf or node asked for
+        leaf_ids = [row.id for row in db(db.ordered_leaves.ott.belongs(otts)).select(db.ordered_leaves.id)]
         if queryvar_is_true("db_seconds"):
             db_seconds += db._lastsql[1]
-        if len(leaf_ids) == 0:
-            query = None
-            sql_parts = []
-        else:
+        nodes = {row.id: (row.leaf_lft, row.leaf_rgt) for row in db(db.ordered_nodes.ott.belongs(otts)).select(
+            db.ordered_nodes.id, db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt)}
+        node_intervals = sorted(set(nodes.values()))
+        if queryvar_is_true("db_seconds"):
+            db_seconds += db._lastsql[1]
+        #merge nested clades and leaves within them, so we can work out how many tips should have been returned
+        intervals = popularity_index.merge_intervals([(i, i) for i in leaf_ids] + node_intervals)
+        ret['n_taxa'] = sum(rgt - lft + 1 for lft, rgt in intervals)
+        sql_select = "SELECT `" + "`,`".join(colnames) + "` FROM ordered_leaves"
+        #the in-memory index is in the default sort order
+        index = popularity_index.get() if sort not in ("rank", "raw") else None
+        if len(intervals) == 0:
+            ret['data'] = []
+        elif index is not None:
             if queryvar_is_true("spread_taxa_evenly"):
-                sql_parts = ["{s} WHERE {q}".format(s=sql_select, q=str(query))]
+                ids = set(leaf_ids)
+                for interval in node_intervals:
+                    ids.update(index.most_popular([interval], max_per_input_taxon))
             else:
-                sql_parts = [str(query)]
-        if results:
-            for row in results:
-                #if query:
-                #    query = query | ((db.ordered_leaves.id >= row.leaf_lft) & (db.ordered_leaves.id <= row.leaf_rgt))
-                #else:
-                #    query = ((db.ordered_leaves.id >= row.leaf_lft) & (db.ordered_leaves.id <= row.leaf_rgt))
-                sql_where = "(ordered_leaves.id >= {:d}) AND (ordered_leaves.id <= {:d})".format(row.leaf_lft, row.leaf_rgt)
-                if queryvar_is_true("spread_taxa_evenly"):
-                    sql_parts.append(sql_template.format(q=sql_where, o=orderby, n=max_per_input_taxon))
-                else:
-                    sql_parts.append(sql_where)
-                #now count the number of results that we would return, if not expanded
-                try:
-                    expanded_intervals[row.leaf_lft] = max(expanded_intervals[row.leaf_lft], row.leaf_rgt)
-                except KeyError:
-                    expanded_intervals[row.leaf_lft] = row.leaf_rgt
-        #count number of expands
-        leaf_idx = prev_rgt = 0
-        for lft, rgt in sorted(expanded_intervals.items()):
-            while leaf_idx < len(leaf_ids): #check none of the existing leaves are included
-                if leaf_ids[leaf_idx] < lft:
-                    n_taxa += 1
-                else:
-                    break
-                leaf_idx += 1
-                
-            if lft > prev_rgt: #only count the tips if it is not nested in a previous clade
-                while leaf_idx < len(leaf_ids):
-                    if lft <= leaf_ids[leaf_idx] <= rgt:
-                        leaf_idx += 1
-                    else:
-                        break
-                n_taxa += rgt-lft+1
-                prev_rgt = rgt
-        
-        ret['n_taxa']=n_taxa + (len(leaf_ids)-leaf_idx)
-        if queryvar_is_true("spread_taxa_evenly"):
-            sql = "(" + ") UNION (".join(sql_parts) + ") ORDER BY {o}".format(o=orderby)
+                ids = index.most_popular(intervals, n)
+            ret['data'] = db.executesql("{} WHERE id IN ({}) ORDER BY {}".format(
+                sql_select, ",".join([db.placeholder] * len(ids)), orderby), [i for i in ids]) if ids else []
         else:
-            sql = sql_template.format(q=("(" + ") OR (".join(sql_parts) + ")"), n=n, o=orderby)
-        ret['data'] = db.executesql(sql)
+            sql_where = "(ordered_leaves.id BETWEEN {:d} AND {:d})"
+            spread = queryvar_is_true("spread_taxa_evenly")
+            #the most popular leaves of large clades may have been precomputed (by build_popular_leaves.py)
+            precomputed = popularity_index.precomputed_most_popular(
+                nodes, max_per_input_taxon if spread else n) if sort not in ("rank", "raw") else {}
+            ids = leaf_ids + [i for top in precomputed.values() for i in top]
+            to_sort = [nodes[node_id] for node_id in nodes if node_id not in precomputed]
+            if spread:
+                sql_parts = ["{} WHERE ordered_leaves.id IN ({})".format(
+                    sql_select, ",".join(str(i) for i in ids))] if ids else []
+                sql_parts += ["{} WHERE {} ORDER BY {} LIMIT {:d}".format(
+                    sql_select, sql_where.format(lft, rgt), orderby, max_per_input_taxon)
+                    for lft, rgt in sorted(set(to_sort))]
+                sql = "(" + ") UNION (".join(sql_parts) + ") ORDER BY {o}".format(o=orderby)
+            else:
+                #the top n overall must be among the top n of each clade
+                sql_parts = ["ordered_leaves.id IN ({})".format(",".join(str(i) for i in ids))] if ids else []
+                sql_parts += [sql_where.format(lft, rgt) for lft, rgt in popularity_index.merge_intervals(to_sort)]
+                sql = "{} WHERE {} ORDER BY {} LIMIT {:d}".format(sql_select, " OR ".join(sql_parts), orderby, n)
+            ret['data'] = db.executesql(sql)
 
     else:
         #this turns out to be a little more complicated in SQL terms, because for speed we probably want to sort 
@@ -299,34 +251,21 @@ def queryvar_is_true(queryvar):
 def get_limits(API_key):
     """
     Return the max taxa allowed per query, and the max number of return values per taxon
+    (API key details are cached for a short while: see modules/api_usage.py)
     """
-    results = db(db.API_users.APIkey == API_key).select(db.API_users.ALL)
-    if results:
-        result = results.first()
-        if result.max_taxa_per_query:
-            return result.max_taxa_per_query, result.max_returns_per_taxon
+    result = api_usage.api_user(API_key)
+    if result:
+        if result['max_taxa_per_query']:
+            return result['max_taxa_per_query'], result['max_returns_per_taxon']
         else:
-            raise(HTTP(400,"Sorry, the API key {} ({}) is no longer allowed".format(result.APIkey, result.API)))
+            raise(HTTP(400,"Sorry, the API key {} ({}) is no longer allowed".format(result['APIkey'], result['API_user_name'])))
     else: 
         raise(HTTP(400,"Sorry, the API key {} has not been recognised".format(API_key)))
 
 
 def record_usage(API_key, API_name, n_taxa, n_returns):
     """
-    Record the API use. See https://stackoverflow.com/questions/49722812/web2py-update-or-insert-to-increment-a-counter
-    """
-    
-    if not update_count(API_key, API_name, n_taxa, n_returns):
-        #could be a race condition causing 2 identical rows here, but if so, both will simply be updated
-        db.API_use.insert(APIkey=API_key, API=API_name, start_date=datetime.datetime.now(), end_date=None, n_calls=0, n_taxa=0, n_returns=0) 
-        update_count(API_key, API_name, n_taxa, n_returns)
-
-    
-def update_count(API_key, API_name, n_t, n_r):
-    """
-    Update the number of taxa and number of returns for this call
-    There may be multiple entries in API_use for a given API key, 
-    but should only be one where the end_date is None
+    Record the API use. Counts are buffered in memory and added to the API_use table
+    in batches: see modules/api_usage.py
     """
-    return db((db.API_use.APIkey == API_key) & (db.API_use.API == API_name) & (db.API_use.end_date == None)).update(
-        n_calls=db.API_use.n_calls + 1, n_taxa=db.API_use.n_taxa + n_t, n_returns=db.API_use.n_returns + n_r)
+    api_usage.record_usage(API_key, API_name, n_taxa, n_returns)
@@ -109,6 +109,13 @@ server {
 }
 EOF
 
+# Serve precompressed brotli files if nginx has the ngx_brotli module
+if nginx -V 2>&1 | grep -q brotli; then
+    BROTLI_STATIC="brotli_static on;"
+else
+    BROTLI_STATIC="#brotli_static on; (needs the ngx_brotli module)"
+fi
+
 cat <<EOF > ${NGINX_PATH}/${WEB2PY_NAME}_static_include.inc
 #### Generated by $0 - DO NOT EDIT
 
@@ -118,9 +125,11 @@ alias ${PROJECT_PATH}/static/;
 location ~ /FinalOutputs/data/ {
     # add_header 'X-static-gzipping' 'on' always;
     gzip_static on;
+    #serve the .br files made by precompress_tree_files.py, if nginx has the brotli module
+    ${BROTLI_STATIC}
     #files in /data/ (e.g. the topology) have timestamps, so never change, and browsers can always use cache
     expires max;
-    add_header Cache-Control "public";
+    add_header Cache-Control "public, immutable";
 }
 
 location ~* \.(?:jpg|jpeg|gif|png|ico|gz|svg)\$ {
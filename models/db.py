@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import os.path
 import img
+import tree_cache
 import json
 
 #########################################################################
@@ -411,6 +412,54 @@ db.define_table('iucn',
     Field('status_code', type='string', length=10), #LC, VN, etc.
     format = '%(iucn)s', migrate=is_testing)
 
+# The tables above and below which are precomputed offline by scripts in
+# OZprivate/ServerScripts/Utilities (ott_details, popular_leaves, sponsor_leaves): which
+# tree version each was built for, and when. A precomputed table is only used if it was
+# built for the tree currently loaded (see tree_cache.precomputed_table_built)
+db.define_table('precomputed_tables',
+    Field('name', type='string', length=64, unique=True, notnull=True),
+    Field('tree_version', type='integer'),
+    Field('built', type='datetime'),
+    format = '%(name)s')
+
+# A denormalized summary of the details that the API/node_details call needs for each ott,
+# built offline from vernacular_by_ott, images_by_ott and iucn (by running
+# OZprivate/ServerScripts/Utilities/build_ott_details.py) whenever a new tree is loaded,
+# or the images and names are updated. There is one row with lang_primary='' for each
+# leaf ott holding the language-independent details (best images & IUCN status), and one
+# row for each (ott, lang_primary) pair holding the preferred vernacular in that language.
+db.define_table('ott_details',
+    Field('ott', type='integer', notnull=True),
+    Field('lang_primary', type='string', notnull=True, length=3), # '' for language-independent details
+    Field('vernacular', type='string', length=name_length_chars), #in mySQL, need to set this to charset utf8mb4
+    Field('status_code', type='string', length=10), # IUCN status
+    # The src, src_id and rating of the overall best image of each type in image_status_labels
+    *[Field('{}_{}'.format(label, col), type='integer') for label in image_status_labels for col in ('src', 'src_id', 'rating')],
+    format = '%(ott)s_%(lang_primary)s')
+
+# The most popular leaves of each node with many leaves (more than the --top option of
+# OZprivate/ServerScripts/Utilities/build_popular_leaves.py, which fills this out whenever a
+# new tree is loaded), in the order "popularity DESC, ott". Like popleaf and popleaf_ott in
+# ordered_nodes, but for more than one leaf. Position 0 is the most popular leaf.
+db.define_table('popular_leaves',
+    Field('node_id', type='integer', notnull=True), # id in ordered_nodes
+    Field('position', type='integer', notnull=True),
+    Field('leaf_id', type='integer', notnull=True), # id in ordered_leaves
+    Field('leaf_ott', type='integer'),
+    format = '%(node_id)s_%(position)s')
+
+# The sponsorable leaves of each node with many leaves (at least the --min_leaves option of
+# OZprivate/ServerScripts/Utilities/build_sponsor_leaves.py), for each price band, in the
+# order they are shown by default/sponsor_node_price. At most --top leaves are kept per
+# band. Reservations are not taken into account: sponsored leaves are skipped when read.
+db.define_table('sponsor_leaves',
+    Field('node_id', type='integer', notnull=True), # id in ordered_nodes
+    Field('price', type='integer'), # the price band in pence, NULL for "contact us"
+    Field('position', type='integer', notnull=True),
+    Field('leaf_ott', type='integer', notnull=True),
+    Field('band_size', type='integer', notnull=True), # total leaves in this node & band
+    format = '%(node_id)s_%(price)s_%(position)s')
+
 # Table for availability of IPNIs in Kew's Plants of the World Online portal (PoWO):
 # this contains IPNIs which have live pages of the form 
 # http://powo.science.kew.org/taxon/urn:lsid:ipni.org:names:<ipni_id>
@@ -873,6 +922,12 @@ db.define_table('embed_key',
     Field('created', 'datetime', default=request.now),
 )
 
+# Rebuild the cached blocks of the home page when the news, quotes or sponsorship totals change
+tree_cache.watch_table(db.news)
+tree_cache.watch_table(db.quotes)
+tree_cache.watch_table(db.reservations, fields=('verified_time', 'deactivated', 'username'))
+tree_cache.watch_table(db.expired_reservations, name='reservations')
+
 # add extra indexes on OTT_ID etc in tables. Index name (ott_index) is arbitrary 
 # http://stackoverflow.com/questions/4601138/what-is-the-significance-of-the-index-name-when-creating-an-index-in-mysql
 if db._uri.startswith("sqlite://"):
@@ -884,6 +939,7 @@ if db._uri.startswith("sqlite://"):
     db.executesql('CREATE INDEX IF NOT EXISTS eol_index ON ordered_leaves (eol);')
     db.executesql('CREATE INDEX IF NOT EXISTS name_index ON ordered_nodes (name);')
     db.executesql('CREATE INDEX IF NOT EXISTS name_index ON ordered_leaves (name);')
+    db.executesql('CREATE INDEX IF NOT EXISTS pop_index ON ordered_leaves (popularity, id);')
 #note mysql does not allow IF NOT EXISTS for index creation. Indexes may need to be added manually. See 
 # http://stackoverflow.com/questions/36602374/web2py-how-to-call-a-call-a-function-on-table-creation
 # for mysql, try this one-off command
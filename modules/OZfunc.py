@@ -11,8 +11,6 @@ import random
 from gluon import current
 from gluon.http import HTTP
 
-from .tour import tours_related_to_ott
-
 def raise_incorrect_url(example_url, info=current.T("Incorrect usage")):
     raise HTTP(400,  info+ "<br />" + current.T("Try e.g. %s") % "<a href='{0}'>{0}</a>".format(example_url), link='<{}>; rel="example"'.format(example_url))
 
@@ -350,6 +348,8 @@ def nodes_info_from_array(
     image_type='best_any',
     include_sponsorship=True,
     include_pic_details=False,
+    use_ott_details=False,
+    exclude_rep_otts=(),
 ):
     leafIDs_string = ",".join([str(int(l)) for l in leafIDs_array])
     nodeIDs_string = ",".join([str(int(n)) for n in nodeIDs_array])
@@ -361,6 +361,8 @@ def nodes_info_from_array(
         image_type=image_type,
         include_sponsorship=include_sponsorship,
         include_pic_details=include_pic_details,
+        use_ott_details=use_ott_details,
+        exclude_rep_otts=",".join([str(int(o)) for o in exclude_rep_otts]),
         check_malicious = False)  # No need to check if badly formed: we have made them
 
 def nodes_info_from_string(
@@ -373,161 +375,74 @@ def nodes_info_from_string(
     include_pic_details=False,
     include_tours_by_ott=True,
     check_malicious=True,
+    use_ott_details=False,
+    exclude_rep_otts="",
 ):
     """
     This is the most frequently used function, called primarily by API/node_details.json
     It needs to be very fast, so does a lot of plain SQL command construction.
-    
+
     include_names_in is a string from e.g. request.vars.lang, such as "en-gb, en-us"
     which will get split up
-    
+
     image_type determines not only which type (public domain, verified, etc) to get for
     this taxon, but also which taxa are used as the representative array of images for an
     internal node
+
+    If use_ott_details is True, the preferred vernaculars, best images and IUCN statuses
+    for otts are looked up in the denormalized ott_details table (see
+    OZprivate/ServerScripts/Utilities/build_ott_details.py) rather than being picked out
+    of the vernacular_by_ott, images_by_ott and iucn tables. Only one (the preferred)
+    vernacular is then returned per ott. Image rights and licences are not stored in
+    ott_details, so include_pic_details always uses images_by_ott.
+
+    exclude_rep_otts is a comma-separated string of leaf otts that the caller already
+    holds details for (e.g. cached by the client from previous calls). These are not
+    looked up or returned when they only appear in the representative image columns of
+    the nodes, although they are still returned if the leaf or node itself is requested.
+
+    All the information is fetched in a single round trip to the database: the id lists
+    are expanded (via the representative image columns) into sets of otts and names using
+    common table expressions, and each of the lookups below is a separate "block" of a
+    single UNION ALL. Each block occupies its own range of columns in the (wide) result
+    rows, and is padded with NULLs elsewhere, so that column types are never coerced
+    between blocks. The rows are then sliced back into their original tuples in python.
     """
     if check_malicious:
         # For speed, we pass leafIDs_string and nodeIDs_string as comma-separated strings
         # straight to SQL, so we should check they don't contain malicious SQL commands
         if re.search("[^\d,]", leafIDs_string) or re.search("[^\d,]", nodeIDs_string):
             #list of ids must only consist of digits and commas
-            raise ValueError 
+            raise ValueError
         if re.search("^,|,$|,,", leafIDs_string) or re.search("^,|,$|,,", nodeIDs_string):
             #ban sequential commas, or commas at beginning or end
             raise ValueError
+        if re.search("[^\d,]|^,|,$|,,", exclude_rep_otts):
+            raise ValueError
     if image_type not in ("best_verified", "best_pd"):
         image_type = "best_any" #sanitize - only allowed 3 settings
 
     db = current.db
-    nodeOtts = set()
-    nodeNames = set()
-    leafOtts = set()
-    leafNames = set()
-    
-    
-    #Get nodes first and collect OTTs for looking up vernaculars. These contain leaf otts in the representative pictures
+
+    #Nodes contain leaf otts in the representative pictures, which also need looking up
     base_ncols = ["id","ott","popularity","age","name","iucnNE","iucnDD","iucnLC","iucnNT","iucnVU","iucnEN","iucnCR","iucnEW","iucnEX"]
     # TODO - there is a bug here where we don't actually substitute {pic} into the name
     pic_ncols = ["{pic}1","{pic}2","{pic}3","{pic}4","{pic}5","{pic}6","{pic}7","{pic}8"]
     pic_col_name = {"best_any": "rep", "best_verified":"rtr", "best_pd":"rpd"}[image_type]
     all_ncols = base_ncols + pic_ncols
-    node_cols = {nm:index for index, nm in enumerate(all_ncols)} 
-    if nodeIDs_string:
-        query1 = "SELECT " + ",".join(all_ncols) + " FROM ordered_nodes WHERE id IN ({user_input})"
-        # Must take extreme care here that user_input has been sanitized in the following
-        sql = query1.format(pic=pic_col_name, user_input=nodeIDs_string)
-        ordered_nodes_query_res = db.executesql(sql)
-        for row in ordered_nodes_query_res:
-            if row[node_cols['ott']]:
-                nodeOtts.add(str(row[node_cols['ott']]))
-            elif row[node_cols['name']]: #use name rather than ott if ott does not exist
-                nodeNames.add(row[node_cols['name']])
-
-            for i in range(len(base_ncols), len(base_ncols)+len(pic_ncols)):
-                if row[i]:
-                    leafOtts.add(str(row[i]))
-    else:
-        ordered_nodes_query_res = []
-    #Get leaves next, and add their otts to the leaf pool, for looking up vernaculars and images
+    node_cols = {nm:index for index, nm in enumerate(all_ncols)}
     all_lcols = ["id","ott","popularity","name","extinction_date","price"]
-    leaf_cols = {nm:index for index,nm in enumerate(all_lcols)} 
-    conditions = []
-    if leafIDs_string:
-        #  must take extreme care here that user_input has been sanitized
-        conditions.append("id IN ({user_input})".format(user_input=leafIDs_string)) 
-    if len(leafOtts):
-        conditions.append("ott IN ({otts_from_pics})".format(otts_from_pics=",".join(leafOtts)))
-    if len(conditions):
-        query2 = "SELECT " + ",".join(all_lcols) + " FROM ordered_leaves"
-        query2 += " WHERE " + " OR ".join(conditions)
-        sql = query2
-        ordered_leaves_query_res = db.executesql(sql)
-        for row in ordered_leaves_query_res:
-            if row[leaf_cols['ott']]:
-                leafOtts.add(str(row[leaf_cols['ott']]))
-            elif row[leaf_cols['name']]:
-                leafNames.add(row[leaf_cols['name']])
-    else:
-        ordered_leaves_query_res = []
-    
-    #find vernaculars (could be from leaves or nodes)
-    #the logic for finding *which* vernaculars to use is in javascript
-    #e.g. we probably want to return all 'en-XXX' values, even if the language is en-GB
-    #then choose en-GB, en (plain) and en-OTHER in that order
-    vernacular_name_query_res = []
-    vernacular_name_query_res2 = []
-    if include_names_in:
-        first_lang = include_names_in.split(',')[0]
-        lang_primary = first_lang.split("-")[0]
-        if len(nodeOtts) + len(leafOtts):
-            query3 = "SELECT ott,vernacular FROM vernacular_by_ott WHERE ott IN ({otts})"
-            query3 += " AND lang_primary={}".format(db.placeholder)
-            query3 += " AND preferred=TRUE ORDER BY src"
-            sql = query3.format(otts=",".join(nodeOtts | leafOtts))
-            vernacular_name_query_res = db.executesql(sql, (lang_primary,))
-        if len(nodeNames) + len(leafNames):
-            names = nodeNames | leafNames
-            query4 = "SELECT name,vernacular FROM vernacular_by_name WHERE lang_primary={}".format(db.placeholder)
-            query4 += " AND name IN (" + ','.join([db.placeholder]*len(names)) + ")"
-            query4 += " AND preferred=TRUE ORDER BY src"
-            sql = query4
-            vernacular_name_query_res2 = db.executesql(sql, [lang_primary]+list(names))
-    
-    #find pictures, iucn, and reservation details (only from leaves)
-    images_by_ott_query_res = iucn_query_res = reservations_res = None #don't bother getting images for nodes without otts
+    leaf_cols = {nm:index for index,nm in enumerate(all_lcols)}
     if include_pic_details:
         all_pcols = ["ott", "src_id", "src", "rating", "rights", "licence"]
     else:
         all_pcols = ["ott", "src_id", "src", "rating"]
     all_rcols = ["OTT_ID", "verified_kind", "verified_name", "verified_more_info", "verified_url"]
-    pic_cols = {nm:index for index,nm in enumerate(all_pcols)} 
-    res_cols = {nm:index for index,nm in enumerate(all_rcols)} 
-    if len(leafOtts):
-        ott_ids = ",".join(leafOtts) #must be sure there that these are all integers
-        if include_pics:
-            query5 = "SELECT " + ",".join(all_pcols)
-            query5 += " FROM images_by_ott WHERE ott in ({otts})"
-            query5 += " AND " + "overall_" + image_type + " = TRUE"
-            sql = query5.format(otts=ott_ids)
-            # a bit of python hacking here, so that the best src is returned - annoyingly hard to do in SQL
-            images_by_ott_query_res = db.executesql(sql)
-        if include_iucn:
-            query6 = "SELECT ott,status_code FROM iucn WHERE ott in ({otts})"
-            sql = query6.format(otts=ott_ids)
-            iucn_query_res = db.executesql(sql)
-        if include_sponsorship:
-            query7 = (
-                "SELECT "
-                + ",".join(all_rcols)
-                + " FROM (SELECT "
-                + ",".join(all_rcols)
-                + " FROM reservations"
-                + " WHERE OTT_ID in ({otts})"
-                +  " AND verified_time IS NOT NULL"
-                +  " AND (deactivated IS NULL OR deactivated = '')"
-                + ") AS t")
-            sql = query7.format(otts=ott_ids)
-            reservations_res = db.executesql(sql)
-
-    tours_res = []
-    if len(leafOtts) or len(nodeOtts):
-        if include_tours_by_ott:
-            for ott, tours in tours_related_to_ott(leafOtts | nodeOtts, full_meta=False).items():
-                tours_res.append([ott, [t.identifier for t in tours]])
+    pic_cols = {nm:index for index,nm in enumerate(all_pcols)}
+    res_cols = {nm:index for index,nm in enumerate(all_rcols)}
 
-    if leafIDs_string or nodeIDs_string:
-        return dict(
-            nodes=ordered_nodes_query_res or [],
-            leaves=ordered_leaves_query_res or [],
-            lang=include_names_in,
-            vernacular_by_ott=vernacular_name_query_res or [],
-            vernacular_by_name=vernacular_name_query_res2 or [], 
-            leafIucn=iucn_query_res or [],
-            leafPic=images_by_ott_query_res or [],
-            reservations=reservations_res or [],
-            tours_by_ott=tours_res,
-        )
-    else:
-        # We didn't pass any ids in, so we simply output a list of the column names for 
+    if not (leafIDs_string or nodeIDs_string):
+        # We didn't pass any ids in, so we simply output a list of the column names for
         # the various arrays. The client can thus make a blank call at the start of a
         # session, and get the column names for later use. We don't need e.g. vernacular
         # or IUCN col names, as these simply map ott or names to a string, as [ott, string]
@@ -535,20 +450,152 @@ def nodes_info_from_string(
         # we also pass out the same values as a call with no IDs, to avoid js errors if accidentally no ids are passed in
         return dict(
             colnames_nodes=node_cols,
-            colnames_leaves=leaf_cols, 
+            colnames_leaves=leaf_cols,
             colnames_images=pic_cols,
             colnames_reservations=res_cols,
             nodes=[],
             leaves=[],
             lang=include_names_in,
             vernacular_by_ott=[],
-            vernacular_by_name=[],   
+            vernacular_by_name=[],
             leafIucn=[],
             leafPic=[],
             reservations=[],
             tours_by_ott=[],
         )
 
+    # Must take extreme care here that the id strings have been sanitized: they are
+    # inserted into the SQL verbatim. An empty list of ids selects nothing.
+    no_rows = "1=0"
+    node_where = "id IN ({})".format(nodeIDs_string) if nodeIDs_string else no_rows
+    leaf_where = "id IN ({})".format(leafIDs_string) if leafIDs_string else no_rows
+    ctes = [
+        # n: the requested nodes
+        "n AS (SELECT {cols} FROM ordered_nodes WHERE {where})".format(
+            cols=",".join(c.format(pic=pic_col_name) for c in all_ncols), where=node_where),
+        # r: leaf otts in the representative image columns of those nodes
+        "r AS (SELECT ott FROM ({}) AS reps WHERE ott <> 0{})".format(" UNION ".join(
+            "SELECT {} AS ott FROM n".format(c.format(pic=pic_col_name)) for c in pic_ncols),
+            " AND ott NOT IN ({})".format(exclude_rep_otts) if exclude_rep_otts else ""),
+        # l: the requested leaves, plus the leaves used as representative images
+        "l AS (SELECT {cols} FROM ordered_leaves WHERE {where} OR ott IN (SELECT ott FROM r))".format(
+            cols=",".join(all_lcols), where=leaf_where),
+        # lo: all leaf otts (NB: includes representative otts that are not in the leaves table)
+        "lo AS (SELECT ott FROM r UNION SELECT ott FROM l WHERE ott <> 0)",
+        # o: all leaf and node otts
+        "o AS (SELECT ott FROM lo UNION SELECT ott FROM n WHERE ott <> 0)",
+        # nm: names of leaves and nodes that have no ott
+        "nm AS (SELECT name FROM n WHERE (ott IS NULL OR ott = 0) AND name <> ''"
+            " UNION SELECT name FROM l WHERE (ott IS NULL OR ott = 0) AND name <> '')",
+    ]
+
+    #Each block is (output key, list of columns, FROM/WHERE clause, sort columns, params)
+    blocks = [
+        ('nodes', all_ncols, "n", ["id"], []),
+        ('leaves', all_lcols, "l", ["id"], []),
+    ]
+    #find vernaculars (could be from leaves or nodes)
+    #the logic for finding *which* vernaculars to use is in javascript
+    #e.g. we probably want to return all 'en-XXX' values, even if the language is en-GB
+    #then choose en-GB, en (plain) and en-OTHER in that order
+    if include_names_in:
+        first_lang = include_names_in.split(',')[0]
+        lang_primary = first_lang.split("-")[0]
+        if use_ott_details:
+            blocks.append(('vernacular_by_ott', ["ott", "vernacular"],
+                "ott_details WHERE ott IN (SELECT ott FROM o)"
+                " AND lang_primary={}".format(db.placeholder),
+                ["ott"], [lang_primary]))
+        else:
+            blocks.append(('vernacular_by_ott', ["ott", "vernacular"],
+                "vernacular_by_ott WHERE ott IN (SELECT ott FROM o)"
+                " AND lang_primary={} AND preferred=TRUE".format(db.placeholder),
+                ["src"], [lang_primary]))
+        blocks.append(('vernacular_by_name', ["name", "vernacular"],
+            "vernacular_by_name WHERE name IN (SELECT name FROM nm)"
+            " AND lang_primary={} AND preferred=TRUE".format(db.placeholder),
+            ["src"], [lang_primary]))
+    #find pictures, iucn, and reservation details (only from leaves)
+    if include_pics and use_ott_details and not include_pic_details:
+        label = image_type.replace("best_", "")
+        blocks.append(('leafPic', ["ott"] + [label + "_" + c for c in all_pcols[1:]],
+            "ott_details WHERE ott IN (SELECT ott FROM lo)"
+            " AND lang_primary = '' AND " + label + "_src IS NOT NULL",
+            ["ott"], []))
+    elif include_pics:
+        blocks.append(('leafPic', all_pcols,
+            "images_by_ott WHERE ott IN (SELECT ott FROM lo)"
+            " AND overall_" + image_type + " = TRUE",
+            ["ott"], []))
+    if include_iucn and use_ott_details:
+        blocks.append(('leafIucn', ["ott", "status_code"],
+            "ott_details WHERE ott IN (SELECT ott FROM lo)"
+            " AND lang_primary = '' AND status_code IS NOT NULL",
+            ["ott"], []))
+    elif include_iucn:
+        blocks.append(('leafIucn', ["ott", "status_code"],
+            "iucn WHERE ott IN (SELECT ott FROM lo)",
+            ["ott"], []))
+    if include_sponsorship:
+        blocks.append(('reservations', all_rcols,
+            "reservations WHERE OTT_ID IN (SELECT ott FROM lo)"
+            " AND verified_time IS NOT NULL"
+            " AND (deactivated IS NULL OR deactivated = '')",
+            ["OTT_ID"], []))
+    if include_tours_by_ott:
+        blocks.append(('tours_by_ott', ["tourstop.ott", "tour.identifier"],
+            "tourstop INNER JOIN tour ON tour.id = tourstop.tour"
+            " WHERE tourstop.ott IN (SELECT ott FROM o)",
+            ["tourstop.ott", "tourstop.tour"], []))
+
+    #Lay the blocks side by side, so each has its own column range in the output rows
+    n_sort = max(len(b[3]) for b in blocks)
+    width = sum(len(b[1]) for b in blocks)
+    selects = []
+    params = []
+    offsets = []
+    offset = 0
+    for block_num, (key, cols, from_where, sort_cols, block_params) in enumerate(blocks):
+        cols_sql = ["NULL"] * offset + [c.format(pic=pic_col_name) for c in cols]
+        cols_sql += ["NULL"] * (width - len(cols_sql))
+        sort_sql = sort_cols + ["NULL"] * (n_sort - len(sort_cols))
+        if block_num == 0:
+            # Only the first SELECT of a UNION defines the column names
+            sort_sql = ["{} AS s{}".format(s, i) for i, s in enumerate(sort_sql)]
+            selects.append("SELECT {} AS blk,".format(block_num) + ",".join(sort_sql + cols_sql) + " FROM " + from_where)
+        else:
+            selects.append("SELECT {},".format(block_num) + ",".join(sort_sql + cols_sql) + " FROM " + from_where)
+        params += block_params
+        offsets.append(offset)
+        offset += len(cols)
+    sql = "WITH " + ", ".join(ctes) + " " + " UNION ALL ".join(selects)
+    sql += " ORDER BY blk," + ",".join("s{}".format(i) for i in range(n_sort))
+
+    results = {b[0]: [] for b in blocks}
+    start = 1 + n_sort  # skip the block number and sort columns
+    for row in db.executesql(sql, params):
+        key, cols = blocks[row[0]][0:2]
+        results[key].append(row[start + offsets[row[0]]: start + offsets[row[0]] + len(cols)])
+
+    #tours come back as (ott, identifier) rows, in ott order: group into [ott, [identifiers]]
+    tours_res = []
+    for ott, identifier in results.get('tours_by_ott', []):
+        if len(tours_res) == 0 or tours_res[-1][0] != ott:
+            tours_res.append([ott, []])
+        tours_res[-1][1].append(identifier)
+
+    return dict(
+        nodes=results['nodes'],
+        leaves=results['leaves'],
+        lang=include_names_in,
+        vernacular_by_ott=results.get('vernacular_by_ott', []),
+        vernacular_by_name=results.get('vernacular_by_name', []),
+        leafIucn=results.get('leafIucn', []),
+        leafPic=results.get('leafPic', []),
+        reservations=results.get('reservations', []),
+        tours_by_ott=tours_res,
+    )
+
 
 def query_val_to_ints(CommaSepString):
     return [int(id) for id in CommaSepString.split(",") if id.isdigit()]
@@ -556,10 +603,29 @@ def query_val_to_ints(CommaSepString):
 
 def otts2ids(ottIntegers):
     """
-    Pass in an array of ott ints
+    Pass in an array of ott ints. The ids are found in the in-memory tree topology if
+    available (with the names looked up by id), otherwise by searching on ott
     """
+    import tree_topology  # Not imported at the top, as tree_topology imports this module
     try:
         db = current.db
+        topology = tree_topology.get()
+        if topology is not None:
+            nodes, leaves = {}, {}
+            for ott, ozid in topology.matching('ott', ottIntegers):
+                if ozid > 0:
+                    nodes[ott] = ozid
+                else:
+                    leaves[ott] = -ozid
+            names = {}
+            # As for the database, leaf names take precedence over node names
+            for table, found in (("ordered_nodes", nodes), ("ordered_leaves", leaves)):
+                if found:
+                    ids = list(found.values())
+                    name_of = dict(db.executesql("SELECT id, name FROM {} WHERE id IN ({})".format(
+                        table, ",".join([db.placeholder] * len(ids))), ids))
+                    names.update((ott, name_of.get(id)) for ott, id in found.items())
+            return {"nodes": nodes, "leaves": leaves, "names": names}
         query = db.ordered_nodes.ott.belongs(ottIntegers)
         nodes = db(query).select(db.ordered_nodes.id, db.ordered_nodes.ott, db.ordered_nodes.name)
         query = db.ordered_leaves.ott.belongs(ottIntegers)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Lookup of API keys, and accounting of API use, for the keyed APIs (e.g. popularity/list).
+
+To avoid adding database round trips to every API call, details of API keys are cached
+for a short time (api.key_cache_secs), and usage counts are buffered in memory and
+added to the API_use table in batches (see buffered_counts.py), and when the worker
+process exits. As with other in-process caches, each web2py worker process has its own
+copy.
+"""
+import datetime
+
+from gluon import current
+
+from buffered_counts import CountBuffer, flush_at_exit, logger, remember_db
+from tree_cache import LRUCache
+
+
+def api_usage_config():
+    """
+    Return dict of API key caching and usage accounting options, returning defaults if
+    not available
+    """
+    myconf = current.globalenv['myconf']
+    out = dict()
+    try:
+        # How long a change to API_users (e.g. deactivating a key) can take to be noticed
+        out['key_cache_secs'] = float(myconf.take('api.key_cache_secs'))
+    except:
+        out['key_cache_secs'] = 60.0
+    try:
+        # Write buffered usage counts once the oldest is this old (0 to write on every call)
+        out['usage_flush_secs'] = float(myconf.take('api.usage_flush_secs'))
+    except:
+        out['usage_flush_secs'] = 60.0
+    try:
+        out['usage_max_buffered'] = int(myconf.take('api.usage_max_buffered'))
+    except:
+        out['usage_max_buffered'] = 1000
+    return out
+
+
+_api_users = None
+
+
+def api_user(API_key):
+    """
+    Return a dict of the API_users row for this key, or None if the key is not recognised.
+    Deactivated keys (with no max_taxa_per_query) are returned: it is up to the caller to
+    reject them.
+    """
+    global _api_users
+    if _api_users is None:
+        _api_users = LRUCache(1000, max_age=api_usage_config()['key_cache_secs'])
+    API_key = API_key or ""
+    user = _api_users.get(API_key)
+    if user is None:
+        db = current.db
+        row = db(db.API_users.APIkey == API_key).select(
+            db.API_users.APIkey,
+            db.API_users.API_user_name,
+            db.API_users.max_taxa_per_query,
+            db.API_users.max_returns_per_taxon,
+        ).first()
+        # Also cache unrecognised keys (as False), so they can't be used to flood the db
+        user = row.as_dict() if row else False
+        _api_users.set(API_key, user)
+    return user or None
+
+
+# Counts of (n_calls, n_taxa, n_returns), keyed by (API key, API name)
+usage_counts = CountBuffer(3, max_keys=10000)
+
+
+def _write_usage(items):
+    db = current.db
+    for (API_key, API_name), (n_calls, n_taxa, n_returns) in items:
+        # There may be multiple entries in API_use for a given API key,
+        # but should only be one where the end_date is None
+        updated = db(
+            (db.API_use.APIkey == API_key) &
+            (db.API_use.API == API_name) &
+            (db.API_use.end_date == None)
+        ).update(
+            n_calls=db.API_use.n_calls + n_calls,
+            n_taxa=db.API_use.n_taxa + n_taxa,
+            n_returns=db.API_use.n_returns + n_returns)
+        if not updated:
+            # could be a race condition causing 2 identical rows here, but if so, both will simply be updated
+            db.API_use.insert(
+                APIkey=API_key, API=API_name, start_date=datetime.datetime.now(), end_date=None,
+                n_calls=n_calls, n_taxa=n_taxa, n_returns=n_returns)
+
+
+flush_at_exit(usage_counts, _write_usage, tables=('API_use', ))
+
+
+def record_usage(API_key, API_name, n_taxa, n_returns):
+    """
+    Record a call to the API_name API (e.g. popularity/list) using API_key, which asked
+    for n_taxa taxa and returned n_returns. The usage is buffered, and written to API_use
+    if due (see flush_usage).
+    """
+    usage_counts.add((API_key, API_name), [1, n_taxa, n_returns])
+    try:
+        flush_usage()
+    except Exception:
+        # The counts remain buffered, and will be written on a later call
+        logger.exception("Could not write API usage counts")
+
+
+def flush_usage(force=False):
+    """
+    Write buffered usage counts to the API_use table, if due according to
+    api_usage_config() (or always, if force is True), and commit.
+    If writing fails, the counts stay buffered and the error is re-raised.
+    """
+    config = api_usage_config()
+    db = current.db
+    remember_db(db)
+    if not (force or usage_counts.flush_due(config['usage_flush_secs'], config['usage_max_buffered'])):
+        return
+    try:
+        if usage_counts.flush(_write_usage):
+            db.commit()
+    except:
+        db.rollback()
+        raise
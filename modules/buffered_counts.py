@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffering for frequently-incremented counters in the database.
+
+Rather than issuing an UPDATE for every hit, counts are accumulated in memory and
+written out in batches. Web2py keeps imported modules for the lifetime of a worker
+process, so each worker has its own buffer. Buffers are normally written by later
+requests, once due (see CountBuffer.flush_due()), and anything left is written when the
+worker process exits (see flush_at_exit()). Only if a worker is killed outright are the
+counts buffered by that worker since its last flush lost.
+
+So that a database outage can't use up all the memory, each buffer holds at most
+max_keys keys: counts for further keys are dropped (and logged) until it is written.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from gluon import current
+
+logger = logging.getLogger("web2py.app.OZtree")
+
+
+class CountBuffer:
+    """
+    A thread-safe accumulator of n_counts integer counters per key, for at most max_keys
+    keys (if given)
+    """
+    def __init__(self, n_counts, max_keys=None):
+        self.n_counts = n_counts
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._started = None  # When the oldest unflushed count was added
+        self._dropped = 0  # Counts dropped since the buffer was last emptied
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, counts):
+        """
+        Add the sequence of counts to those already buffered for key
+        """
+        with self._lock:
+            existing = self._pending.get(key)
+            if existing is None:
+                if self.max_keys is not None and len(self._pending) >= self.max_keys:
+                    if self._dropped == 0:
+                        logger.warning(
+                            "Buffer of counts is full (%d keys): dropping new counts until it is written",
+                            self.max_keys)
+                    self._dropped += 1
+                    return
+                self._pending[key] = list(counts)
+            else:
+                for i, c in enumerate(counts):
+                    existing[i] += c
+            if self._started is None:
+                self._started = time.monotonic()
+
+    def get(self, key):
+        """
+        Return the counts buffered (but not yet flushed) for key
+        """
+        with self._lock:
+            return tuple(self._pending.get(key, (0, ) * self.n_counts))
+
+    def flush_due(self, flush_secs, max_keys):
+        """
+        True if the oldest buffered count is at least flush_secs old, or at least
+        max_keys keys are buffered
+        """
+        with self._lock:
+            if self._started is None:
+                return False
+            return (len(self._pending) >= max_keys or
+                    time.monotonic() - self._started >= flush_secs)
+
+    def take(self):
+        """
+        Remove and return all buffered counts, as a list of (key, counts) tuples sorted
+        by key. Writing rows in a consistent order stops concurrent flushes (from
+        different workers) deadlocking each other.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._started = None
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.warning("Dropped %d counts while the buffer of counts was full", dropped)
+        return sorted(pending.items())
+
+    def restore(self, items):
+        """
+        Put back counts returned by take(), e.g. if writing them to the database failed.
+        Counts for keys beyond max_keys are dropped.
+        """
+        for key, counts in items:
+            self.add(key, counts)
+
+    def flush(self, write_func, batch_size=1000):
+        """
+        Pass all buffered counts to write_func, batch_size keys at a time. If writing
+        fails, all the counts are kept for the next flush and the error re-raised, so
+        the caller should roll back anything already written.
+        Returns the number of keys written.
+        """
+        items = self.take()
+        try:
+            for start in range(0, len(items), batch_size):
+                write_func(items[start:start + batch_size])
+        except:
+            self.restore(items)
+            raise
+        return len(items)
+
+
+_exit_flushes = []  # (CountBuffer, write function, table names) to write on exit
+_exit_db = {}  # How to connect to the database, and the table definitions, once known
+
+
+def flush_at_exit(buffer, write_func, tables=()):
+    """
+    Register a buffer to be written (as by buffer.flush(write_func)) when the worker
+    process exits. Requests no longer run then, so remember_db() should be called from a
+    request first, to note how to connect to the database and define the named tables.
+    """
+    _exit_flushes.append((buffer, write_func, tables))
+
+
+def remember_db(db):
+    """
+    Note the connection details and table definitions of this (request's) DAL, so that
+    the buffers can be written when the worker exits. Only done once per process.
+    """
+    if _exit_db:
+        return
+    tables = {}
+    for _, _, names in _exit_flushes:
+        for name in names:
+            tables[name] = [f.clone() for f in db[name] if f.name != 'id']
+    _exit_db.update(
+        uri=db._uri, placeholder=db.placeholder, tables=tables,
+        driver_args=getattr(db, '_driver_args', None) or {})
+
+
+@atexit.register
+def _flush_all_at_exit():
+    if not _exit_db or not any(len(buffer) for buffer, _, _ in _exit_flushes):
+        return
+    from gluon.dal import DAL
+    try:
+        db = DAL(_exit_db['uri'], pool_size=0, migrate_enabled=False, driver_args=_exit_db['driver_args'])
+        db.placeholder = _exit_db['placeholder']
+        for name, fields in _exit_db['tables'].items():
+            db.define_table(name, *fields, migrate=False)
+    except Exception:
+        logger.exception("Could not connect to the database to write buffered counts on exit")
+        return
+    current.db = db
+    for buffer, write_func, _ in _exit_flushes:
+        try:
+            if buffer.flush(write_func):
+                db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Could not write %d buffered keys of counts on exit", len(buffer))
+    db.close()
+
+
+def visit_count_config():
+    """
+    Return dict of visit count buffering options, returning defaults if not available
+    """
+    myconf = current.globalenv['myconf']
+    out = dict()
+    try:
+        # Write buffered counts once the oldest is this old (0 to write on every call)
+        out['flush_secs'] = float(myconf.take('visit_count.flush_secs'))
+    except:
+        out['flush_secs'] = 60.0
+    try:
+        # ... or once this many distinct otts are buffered
+        out['max_buffered_otts'] = int(myconf.take('visit_count.max_buffered_otts'))
+    except:
+        out['max_buffered_otts'] = 10000
+    return out
+
+
+visit_count_columns = ('detail_fetch_count', 'search_count', 'leaf_click_count')
+# Up to 10 times the default max_buffered_otts, in case writing fails
+visit_counts = CountBuffer(len(visit_count_columns), max_keys=100000)
+
+
+def _write_visit_counts(items):
+    db = current.db
+    row = "(" + ",".join([db.placeholder] * (len(visit_count_columns) + 1)) + ")"
+    sql = "INSERT INTO visit_count (ott, {cols}) VALUES {rows} ON DUPLICATE KEY UPDATE {updates};".format(
+        cols=", ".join(visit_count_columns),
+        rows=",".join([row] * len(items)),
+        updates=", ".join("{0} = {0} + VALUES({0})".format(c) for c in visit_count_columns))
+    db.executesql(sql, [v for ott, counts in items for v in [ott] + list(counts)])
+
+
+flush_at_exit(visit_counts, _write_visit_counts)
+
+
+def record_visits(api_hits="", search_hits="", leaf_clicks=""):
+    """
+    Buffer visit counts, given as comma-separated strings of otts (an ott may be repeated,
+    each occurrence counting as a hit). Call flush_visits() to write them to the database.
+    Raises ValueError if any of the otts are not integers, in which case nothing is counted.
+    """
+    hits = []
+    for i, otts in enumerate((api_hits, search_hits, leaf_clicks)):
+        if otts:
+            hits += [(int(ott), i) for ott in otts.split(",")]
+    for ott, i in hits:
+        counts = [0] * len(visit_count_columns)
+        counts[i] = 1
+        visit_counts.add(ott, counts)
+
+
+def flush_visits(force=False):
+    """
+    Write buffered visit counts to the visit_count table, if due according to
+    visit_count_config() (or always, if force is True). This commits the current
+    transaction, so that row locks on visit_count are held as briefly as possible.
+    If writing fails, the counts stay buffered and the error is re-raised.
+    """
+    config = visit_count_config()
+    db = current.db
+    remember_db(db)
+    if not (force or visit_counts.flush_due(config['flush_secs'], config['max_buffered_otts'])):
+        return
+    try:
+        if visit_counts.flush(_write_visit_counts):
+            db.commit()
+    except:
+        db.rollback()
+        raise
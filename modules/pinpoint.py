@@ -2,12 +2,30 @@ import re
 
 from gluon import current
 
+import tree_topology
+
 
 def common_ancestor_of_otts(otts):
     """
     Given a list of otts, return their common ancestor as ozid
     NB: We don't consider the case where all of otts are identical (or just one)
     """
+    topology = tree_topology.get()
+    if topology is None:
+        return _common_ancestor_of_otts_in_db(otts)
+    ozids = []
+    for ott in otts:
+        found = topology.ozids_for_ott(ott)
+        if len(found) == 0:
+            raise ValueError("Cannot find OTTs: %s" % ",".join(str(x) for x in otts))
+        ozids.extend(found)
+    return topology.common_ancestor(ozids)
+
+
+def _common_ancestor_of_otts_in_db(otts):
+    """
+    As common_ancestor_of_otts, but walk up the real_parent chain in the database
+    """
     db = current.db
 
     rs = db.executesql("""
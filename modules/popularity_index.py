@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory ordering of the leaves by popularity, so that the most popular species
+within any set of clades (popularity/list with expand_taxa) can be found without
+asking the database to sort every leaf in every clade.
+
+Each clade is a range of leaf ids (leaf_lft..leaf_rgt). Every leaf is given its
+position in the order "popularity DESC, ott" (as used by popularity/list), and a
+range-minimum lookup over those positions (see tree_topology.RangeMinimum) finds the
+most popular leaf in any range. The next most popular leaves come from splitting the
+range either side of the leaf just returned, so finding the top N in a set of ranges
+takes time proportional to N plus the number of ranges, however large the clades.
+
+Sorting all the leaves by popularity takes a while for a large tree, so as with
+search_index.py, the index is never built by the web server. Instead
+private/build_tree_snapshots.py saves it as a snapshot in tree_cache.snapshot_dir once
+per tree version (reading the leaf popularities from the tree topology snapshot), which
+every worker memory-maps. Until then, requests use the database.
+
+The most popular leaves of large clades can also be precomputed offline into the
+popular_leaves table, which is used when the in-memory index is unavailable.
+"""
+import heapq
+import json
+import math
+import os
+import time
+from array import array
+
+from gluon import current
+
+import tree_cache
+from search_index import fetch_all
+import tree_snapshots
+import tree_topology
+from tree_topology import RangeMinimum
+
+
+def merge_intervals(intervals):
+    """
+    Return a sorted list of the (lo, hi) ranges (inclusive) covered by a list of
+    possibly overlapping or nested (lo, hi) ranges
+    """
+    out = []
+    for lo, hi in sorted(intervals):
+        if out and lo <= out[-1][1] + 1:
+            if hi > out[-1][1]:
+                out[-1] = (out[-1][0], hi)
+        else:
+            out.append((lo, hi))
+    return out
+
+
+def precomputed_most_popular(nodes, n):
+    """
+    Look up the ids of the n most popular leaves of each node in the popular_leaves table
+    (see OZprivate/ServerScripts/Utilities/build_popular_leaves.py), most popular first.
+    nodes is a dict of node id => (leaf_lft, leaf_rgt). Returns a dict of node id => leaf
+    ids, which omits nodes without a long enough list (e.g. those with few leaves, which
+    are quick to sort in the database), or whose list doesn't match the current tree. The
+    table is not used at all unless it was built for the current tree version.
+    """
+    db = current.db
+    if len(nodes) == 0 or tree_cache.precomputed_table_built('popular_leaves') is None:
+        return {}
+    found = {}
+    for node_id, leaf_id in db.executesql(
+        "SELECT node_id, leaf_id FROM popular_leaves WHERE node_id IN ({}) AND position < {} "
+        "ORDER BY node_id, position".format(",".join([db.placeholder] * len(nodes)), db.placeholder),
+        [node_id for node_id in nodes] + [n]
+    ):
+        found.setdefault(node_id, []).append(leaf_id)
+    # Guard against a node id reused by a different clade
+    return {
+        node_id: leaf_ids for node_id, leaf_ids in found.items()
+        if len(leaf_ids) == n and all(nodes[node_id][0] <= i <= nodes[node_id][1] for i in leaf_ids)}
+
+
+def _leaves_in_topology(topology):
+    for id in range(1, len(topology.leaf_parent)):
+        if topology.leaf_parent[id]:
+            pop = topology.leaf_popularity[id]
+            yield id, topology.leaf_ott[id] or None, None if math.isnan(pop) else pop
+
+
+class PopularityIndex:
+    columns = dict(position='i')
+
+    def __init__(self, topology=None, columns=None, levels=None, missing=None):
+        """
+        Build the index from the leaves in a tree_topology.TreeTopology, or from the
+        database if topology is None, or (if columns is given) use the arrays, range
+        minimum levels and missing position stored in a snapshot
+        """
+        if columns is not None:
+            self.position = columns['position']
+            self.missing = missing
+            self._most_popular = RangeMinimum(self.position, levels)
+            return
+        ids = array('i')
+        otts = array('i')
+        popularity = array('d')
+        flags = array('b')  # 1 if popularity is NULL, 2 if ott is NULL
+        if topology is None:
+            leaves = fetch_all("SELECT id, ott, popularity FROM ordered_leaves WHERE {}")
+        else:
+            leaves = _leaves_in_topology(topology)
+        for id, ott, pop in leaves:
+            ids.append(id)
+            otts.append(ott or 0)
+            popularity.append(pop or 0)
+            flags.append((pop is None) + 2 * (ott is None))
+
+        # As ORDER BY popularity DESC, ott in MySQL: NULL popularity last, NULL ott first
+        def sort_key(i):
+            return (flags[i] & 1, -popularity[i], not flags[i] & 2, otts[i])
+        order = sorted(range(len(ids)), key=sort_key)
+        self.missing = len(order)  # The position given to gaps in the leaf ids
+        self.position = array('i', [self.missing]) * ((max(ids) if ids else 0) + 1)
+        for pos, i in enumerate(order):
+            self.position[ids[i]] = pos
+        self._most_popular = RangeMinimum(self.position)
+
+    def save(self, path, size):
+        """
+        Save as a snapshot in path, for a tree of the given size (see tree_snapshots.tree_size)
+        """
+        for name in self.columns:
+            with open(os.path.join(path, name), "wb") as f:
+                f.write(getattr(self, name))
+        for k, level in enumerate(self._most_popular.levels):
+            with open(os.path.join(path, "position_levels_{}".format(k)), "wb") as f:
+                f.write(level)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(dict(
+                columns=self.columns, n_levels=len(self._most_popular.levels), missing=self.missing,
+                size=size), f)
+
+    @classmethod
+    def load(cls, path, size):
+        """
+        Return the index saved in path, memory-mapped, checking it is of a tree of this size
+        """
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest['columns'] != cls.columns or manifest['size'] != size:
+            raise ValueError("Popularity index snapshot in {} is out of date".format(path))
+        columns = {
+            name: tree_snapshots.map_file(os.path.join(path, name), typecode)
+            for name, typecode in cls.columns.items()}
+        levels = [
+            tree_snapshots.map_file(os.path.join(path, "position_levels_{}".format(k)), 'i')
+            for k in range(manifest['n_levels'])]
+        return cls(columns=columns, levels=levels, missing=manifest['missing'])
+
+    def most_popular(self, intervals, n):
+        """
+        Return the ids of up to n of the most popular leaves with ids in any of the
+        (lo, hi) ranges (inclusive), most popular first. The ranges should not overlap.
+        """
+        position = self.position
+        argmin = self._most_popular.argmin
+        heap = []
+        for lo, hi in intervals:
+            lo, hi = max(lo, 1), min(hi, len(position) - 1)
+            if lo <= hi:
+                i = argmin(lo, hi)
+                heap.append((position[i], i, lo, hi))
+        heapq.heapify(heap)
+        out = []
+        while heap and len(out) < n:
+            pos, i, lo, hi = heapq.heappop(heap)
+            if pos == self.missing:
+                break
+            out.append(i)
+            for a, b in ((lo, i - 1), (i + 1, hi)):
+                if a <= b:
+                    j = argmin(a, b)
+                    heapq.heappush(heap, (position[j], j, a, b))
+        return out
+
+
+_popularity = dict(version=None, value=None, tried_at=None)
+
+
+def build_snapshot(version):
+    """
+    Build the snapshot of the popularity index for this tree version, unless it already
+    exists. This sorts every leaf, so should not be called by the web server (see
+    private/build_tree_snapshots.py). Returns None if another process is building it.
+    """
+    size = tree_snapshots.tree_size()
+    return tree_snapshots.build(
+        'popularity_index', version, lambda path: PopularityIndex(tree_topology.get()).save(path, size),
+        lambda path: PopularityIndex.load(path, size))
+
+
+def get():
+    """
+    Return the PopularityIndex for the current tree, or None if it is turned off, or its
+    snapshot has not yet been built (in which case this is only looked for again every
+    tree_cache.version_check_secs)
+    """
+    config = tree_cache.tree_cache_config()
+    if not config['popularity_index']:
+        return None
+    version = tree_cache.tree_version()
+    if version is None:
+        return None
+    if _popularity['version'] == version:
+        return _popularity['value']
+    if _popularity['tried_at'] is not None and time.monotonic() - _popularity['tried_at'] < config['version_check_secs']:
+        return None
+    size = tree_snapshots.tree_size()
+    index = tree_snapshots.load('popularity_index', version, lambda path: PopularityIndex.load(path, size))
+    if index is None:
+        _popularity['tried_at'] = time.monotonic()
+        return None
+    _popularity.update(version=version, value=index, tried_at=None)
+    return _popularity['value']
+
+
+def reset():
+    """
+    Forget the loaded snapshot (see tree_cache.reset())
+    """
+    _popularity.update(version=None, value=None, tried_at=None)
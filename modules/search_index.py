@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory index of the scientific and vernacular names in the tree, used by the
+API/search_by_name call instead of FULLTEXT and LIKE queries in the database.
+
+MySQL full text indexes ignore words shorter than innodb_ft_min_token_size (usually 3), so
+one and two letter searches have to scan entire tables, which can take tens of seconds.
+Here, each name is instead indexed by the start of each of its words (or by every
+character, for logographic languages such as chinese), in a sorted array which can be
+binary searched for any prefix. For the very common case of a single one or two letter
+search word, the most popular hits for each possible prefix are also precomputed.
+
+A name matches a search if every search word is the start of a word in the name (ignoring
+case). Hits are returned in order of popularity.
+
+Building the indexes for a large tree takes minutes, so this is never done by the web
+server. Instead, private/build_tree_snapshots.py builds them once per tree version
+(scientific names, plus the vernacular names of each language) as snapshots in
+tree_cache.snapshot_dir (see tree_snapshots.py). The names and index entries are held in
+flat arrays and UTF-8 encoded blobs, which every worker process memory-maps, so loading a
+snapshot is quick, and all the workers share a single copy. Until the snapshots for the
+current tree have been built, searches use the database.
+"""
+import heapq
+import json
+import os
+import re
+import time
+from array import array
+
+from gluon import current
+
+import OZfunc
+import tree_cache
+import tree_snapshots
+
+# Sort index entries on this many bytes of (UTF-8 encoded) text: longer search words are
+# checked one by one
+key_bytes = 24
+# How many of the most popular hits to precompute for each one or two letter prefix
+n_short_hits = 500
+# How many rows to fetch from the database at a time when building
+fetch_chunk = 100000
+# Increase when the layout of the snapshots changes
+snapshot_format = 1
+
+logographic_languages = ("zh", "cnm", "ja", "ko")
+
+
+def word_matches(string, word, logographic=False):
+    """
+    Does the (lowercase) search word match the start of a word in the string?
+    """
+    string = string.lower()
+    if logographic:
+        return word in string
+    return any(w.startswith(word) for w in OZfunc.punctuation_to_space(string).split())
+
+
+def fetch_all(sql, params=None):
+    """
+    Yield the rows of "SELECT id, ..." without holding the whole table in memory. The sql
+    should have a {} in place of a condition on the id, and no ORDER BY or LIMIT
+    """
+    db = current.db
+    last_id = -1
+    while True:
+        rows = db.executesql(
+            sql.format("id > {}".format(db.placeholder)) + " ORDER BY id LIMIT " + str(fetch_chunk),
+            (params or []) + [last_id])
+        yield from rows
+        if len(rows) < fetch_chunk:
+            return
+        last_id = rows[-1][0]
+
+
+def _save_arrays(path, arrays):
+    """
+    Save a dict of name => array (or bytes) in path, one file each
+    """
+    for name, values in arrays.items():
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(values)
+
+
+def _load_arrays(path, typecodes):
+    return {
+        name: tree_snapshots.map_file(os.path.join(path, name), typecode)
+        for name, typecode in typecodes.items()}
+
+
+class PackedStrings:
+    """
+    A list of strings, stored as a single UTF-8 encoded blob with a NUL byte after each
+    string, and the position in the blob of the start of each string
+    """
+    def __init__(self, blob, starts):
+        self.blob = blob
+        self.starts = starts  # One more than the number of strings
+
+    @classmethod
+    def from_list(cls, strings):
+        starts = array('q', [0])
+        parts = []
+        for s in strings:
+            encoded = (s or "").encode("utf-8") + b"\0"
+            parts.append(encoded)
+            starts.append(starts[-1] + len(encoded))
+        return cls(b"".join(parts), starts)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.starts[i]:self.starts[i + 1] - 1].decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def arrays(self, name):
+        return {name: self.blob, name + "_starts": self.starts}
+
+    @staticmethod
+    def typecodes(name):
+        return {name: 'B', name + "_starts": 'q'}
+
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        return cls(arrays[name], arrays[name + "_starts"])
+
+
+class WordPrefixIndex:
+    """
+    A sorted array of the positions at which words start in the lowercased strings, which
+    allows all the strings with a word beginning with a given prefix to be found by binary
+    search. The lowercased strings are held as a PackedStrings: UTF-8 sorts in the same
+    order as the characters it encodes, so entries are sorted and searched as bytes.
+    """
+    def __init__(self, strings, logographic=False, arrays=None):
+        self.strings = strings
+        self.logographic = logographic
+        if arrays is not None:
+            self.lowered = PackedStrings.from_arrays(arrays, "lowered")
+            self.positions = arrays["positions"]
+            self.str_num = arrays["str_num"]
+            return
+        lowered = [(s or "").lower() for s in strings]
+        self.lowered = PackedStrings.from_list(lowered)
+        positions = array('q')
+        str_num = array('i')
+        for i, s in enumerate(lowered):
+            if not s:
+                continue
+            start = self.lowered.starts[i]
+            ascii = s.isascii()
+            for m in re.finditer(r'\S' if logographic else r'\S+', OZfunc.punctuation_to_space(s)):
+                positions.append(start + (m.start() if ascii else len(s[:m.start()].encode("utf-8"))))
+                str_num.append(i)
+        blob = self.lowered.blob
+        order = sorted(range(len(positions)), key=lambda j: blob[positions[j]:positions[j] + key_bytes])
+        self.positions = array('q', (positions[j] for j in order))
+        self.str_num = array('i', (str_num[j] for j in order))
+
+    def arrays(self):
+        return dict(self.lowered.arrays("lowered"), positions=self.positions, str_num=self.str_num)
+
+    @staticmethod
+    def typecodes():
+        return dict(PackedStrings.typecodes("lowered"), positions='q', str_num='i')
+
+    def __len__(self):
+        return len(self.str_num)
+
+    def key(self, j, n_bytes=key_bytes):
+        pos = self.positions[j]
+        return self.lowered.blob[pos:pos + n_bytes]
+
+    def prefix_range(self, prefix):
+        """
+        Return the (lo, hi) range of entries starting with (the first key_bytes of) prefix
+        """
+        prefix = prefix.encode("utf-8")[:key_bytes]
+        n = len(prefix)
+        lo, hi = 0, len(self.positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid, n) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start, hi = lo, len(self.positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid, n) <= prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def matching(self, words):
+        """
+        Return the set of numbers of the strings matching all the (lowercase) words
+        """
+        # Use the word with fewest entries, and check the others
+        ranges = [self.prefix_range(w) for w in words]
+        best = min(range(len(words)), key=lambda i: ranges[i][1] - ranges[i][0])
+        lo, hi = ranges[best]
+        hits = set(self.str_num[lo:hi])
+        check = [w for i, w in enumerate(words) if i != best or len(w.encode("utf-8")) > key_bytes]
+        if check:
+            hits = {
+                i for i in hits
+                if all(word_matches(self.strings[i], w, self.logographic) for w in check)}
+        return hits
+
+    def top_by_prefix(self, popularity_of, n_hits=n_short_hits):
+        """
+        Return a dict mapping each one and two character prefix to up to n_hits
+        (popularity, row) pairs, most popular first. popularity_of(string number)
+        should return a list of (popularity, row) pairs for the rows with that name.
+        """
+        best = {}  # prefix -> {row: popularity}
+        for j in range(len(self.positions)):
+            pop_rows = popularity_of(self.str_num[j])
+            if not pop_rows:
+                continue
+            # 8 bytes hold at least two characters, unless the string ends first
+            start = self.key(j, 8).decode("utf-8", "ignore").split("\0")[0]
+            for n_chars in (1, 2):
+                prefix = start[:n_chars]
+                if len(prefix) < n_chars or prefix[-1].isspace():
+                    continue  # Search words never contain spaces
+                pops = best.setdefault(prefix, {})
+                for pop, row in pop_rows:
+                    pops[row] = pop
+                if len(pops) > 4 * n_hits:  # Don't let these grow too big
+                    best[prefix] = dict(heapq.nlargest(n_hits, pops.items(), key=lambda x: x[1]))
+        return {
+            prefix: sorted(((p, r) for r, p in pops.items()), key=lambda x: (-x[0], x[1]))[:n_hits]
+            for prefix, pops in best.items()}
+
+
+class TopHits:
+    """
+    The precomputed most popular hits for each one or two character prefix, as returned
+    by WordPrefixIndex.top_by_prefix(), held in arrays so that they can be memory-mapped
+    """
+    def __init__(self, top=None, arrays=None):
+        if arrays is not None:
+            self.prefixes = PackedStrings.from_arrays(arrays, "top_prefixes")
+            self.starts = arrays["top_starts"]
+            self.popularity = arrays["top_popularity"]
+            self.rows = arrays["top_rows"]
+            return
+        prefixes = sorted(top)
+        self.prefixes = PackedStrings.from_list(prefixes)
+        self.starts = array('q', [0])
+        self.popularity = array('d')
+        self.rows = array('i')
+        for prefix in prefixes:
+            for pop, row in top[prefix]:
+                self.popularity.append(pop)
+                self.rows.append(row)
+            self.starts.append(len(self.rows))
+
+    def arrays(self):
+        return dict(
+            self.prefixes.arrays("top_prefixes"),
+            top_starts=self.starts, top_popularity=self.popularity, top_rows=self.rows)
+
+    @staticmethod
+    def typecodes():
+        return dict(PackedStrings.typecodes("top_prefixes"), top_starts='q', top_popularity='d', top_rows='i')
+
+    def get(self, prefix, default=None):
+        """
+        Return the list of (popularity, row) for this prefix, most popular first
+        """
+        i = bisect_left(self.prefixes, prefix)
+        if i == len(self.prefixes) or self.prefixes[i] != prefix:
+            return default
+        lo, hi = self.starts[i], self.starts[i + 1]
+        return list(zip(self.popularity[lo:hi], self.rows[lo:hi]))
+
+
+class TaxonNames:
+    """
+    The scientific names of all the leaves and nodes in a tree. Leaves and nodes are
+    numbered together as "rows": leaf rows come first, followed by node rows.
+    """
+    columns = dict(ids='i', otts='i', popularity='d', price='i', ott_sorted='i', ott_rows='i')
+
+    def __init__(self, arrays=None, manifest=None):
+        """
+        Build the names from the database, or (if arrays is given) from the arrays and
+        manifest of a snapshot
+        """
+        if arrays is not None:
+            for name in self.columns:
+                setattr(self, name, arrays[name])
+            self.names = PackedStrings.from_arrays(arrays, "names")
+            self.index = WordPrefixIndex(self.names, arrays=arrays)
+            self.top = TopHits(arrays=arrays)
+            self.n_leaves = manifest['n_leaves']
+            self.languages = manifest['languages']
+            return
+        self.ids = array('i')
+        self.otts = array('i')  # 0 if no ott
+        self.popularity = array('d')
+        self.price = array('i')  # -1 if no price
+        names = []
+        for row in fetch_all("SELECT id, ott, name, popularity, price FROM ordered_leaves WHERE {}"):
+            self._add(names, *row)
+        self.n_leaves = len(self.ids)
+        for row in fetch_all("SELECT id, ott, name, popularity FROM ordered_nodes WHERE {}"):
+            self._add(names, *row)
+        self.names = PackedStrings.from_list(names)
+        # Sorted otts, to look up rows by ott
+        order = sorted((ott, r) for r, ott in enumerate(self.otts) if ott)
+        self.ott_sorted = array('i', (o for o, r in order))
+        self.ott_rows = array('i', (r for o, r in order))
+        self.index = WordPrefixIndex(names)
+        self.top = TopHits(self.index.top_by_prefix(lambda r: [(self.popularity[r], r)]))
+        self.index.strings = self.names
+        # Languages with vernacular names (each saved as a separate snapshot)
+        db = current.db
+        self.languages = sorted(set(r[0] for r in db.executesql(
+            "SELECT DISTINCT lang_primary FROM vernacular_by_ott UNION SELECT DISTINCT lang_primary FROM vernacular_by_name"
+        ) if r[0]))
+
+    def _add(self, names, id, ott, name, popularity, price=None):
+        self.ids.append(id)
+        self.otts.append(ott or 0)
+        names.append(name or "")
+        self.popularity.append(popularity or 0.0)
+        self.price.append(-1 if price is None else price)
+
+    def save(self, path, size):
+        """
+        Save as a snapshot in path, for a tree of the given size (see tree_snapshots.tree_size)
+        """
+        arrays = {name: getattr(self, name) for name in self.columns}
+        arrays.update(self.names.arrays("names"), **self.index.arrays())
+        arrays.update(self.top.arrays())
+        _save_arrays(path, arrays)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(dict(
+                format=snapshot_format, size=size, n_rows=len(self.ids), n_leaves=self.n_leaves,
+                languages=self.languages), f)
+
+    @classmethod
+    def load(cls, path, size):
+        """
+        Return the names saved in path, memory-mapped, checking they are of a tree of this size
+        """
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest['format'] != snapshot_format or manifest['size'] != size:
+            raise ValueError("Search index snapshot in {} is out of date".format(path))
+        typecodes = dict(cls.columns, **PackedStrings.typecodes("names"))
+        typecodes.update(WordPrefixIndex.typecodes(), **TopHits.typecodes())
+        return cls(_load_arrays(path, typecodes), manifest)
+
+    def rows_for_ott(self, ott):
+        lo = bisect_left(self.ott_sorted, ott)
+        hi = bisect_right(self.ott_sorted, ott)
+        return self.ott_rows[lo:hi]
+
+    def is_leaf(self, row):
+        return row < self.n_leaves
+
+    def output_row(self, row, include_price):
+        ret = [self.ids[row], self.otts[row] or None, self.names[row] or None, self.popularity[row]]
+        if include_price:
+            ret.append((None if self.price[row] < 0 else self.price[row]) if self.is_leaf(row) else None)
+        return ret
+
+
+class VernacularNames:
+    """
+    The vernacular names in a single language, for the taxa in a TaxonNames instance.
+    Names are ordered by ott (or scientific name), then preferred first, then by src.
+    """
+    columns = dict(otts='i', preferred='b')
+
+    def __init__(self, taxa, lang_primary, by_ott=(), by_name=(), arrays=None, manifest=None):
+        """
+        Index the rows (id, ott or name, vernacular, preferred, src) from the
+        vernacular_by_ott and vernacular_by_name tables, or (if arrays is given) load the
+        arrays and manifest of a snapshot
+        """
+        self.taxa = taxa
+        self.logographic = lang_primary in logographic_languages
+        if arrays is not None:
+            for name in self.columns:
+                setattr(self, name, arrays[name])
+            self.vernaculars = PackedStrings.from_arrays(arrays, "vernaculars")
+            self.index = WordPrefixIndex(self.vernaculars, self.logographic, arrays=arrays)
+            self.top = TopHits(arrays=arrays)
+            # Names without otts are rare, so these are just kept in the manifest
+            self.by_name = {k: [tuple(v) for v in vs] for k, vs in manifest['by_name'].items()}
+            self.name_of = {int(k): v for k, v in manifest['name_of'].items()}
+            self.name_rows = manifest['name_rows']
+            return
+        by_ott = sorted(by_ott, key=lambda r: (r[1], not r[3], r[4], r[0]))
+        self.otts = array('i', (r[1] for r in by_ott))
+        vernaculars = [r[2] for r in by_ott]
+        self.preferred = array('b', (bool(r[3]) for r in by_ott))
+        # Names without otts are rare, so just use a dict: name -> [(vernacular, preferred)]
+        self.by_name = {}
+        self.name_of = {}
+        for r in sorted(by_name, key=lambda r: (not r[3], r[4], r[0])):
+            self.name_of[len(vernaculars)] = r[1]
+            self.by_name.setdefault(r[1], []).append((r[2], bool(r[3])))
+            vernaculars.append(r[2])
+        # Rows for each scientific name in vernacular_by_name
+        self.name_rows = {}
+        if self.by_name:
+            for row, name in enumerate(taxa.names):
+                if name in self.by_name:
+                    self.name_rows.setdefault(name, []).append(row)
+        self.vernaculars = PackedStrings.from_list(vernaculars)
+        self.index = WordPrefixIndex(vernaculars, self.logographic)
+        self.top = TopHits(self.index.top_by_prefix(
+            lambda v: [(taxa.popularity[r], r) for r in self.rows_for_vernacular(v)]))
+        self.index.strings = self.vernaculars
+
+    @classmethod
+    def from_db(cls, taxa, lang_primary):
+        db = current.db
+        return cls(
+            taxa, lang_primary,
+            fetch_all(
+                "SELECT id, ott, vernacular, preferred, src FROM vernacular_by_ott"
+                " WHERE lang_primary = {} AND {{}}".format(db.placeholder),
+                [lang_primary]),
+            fetch_all(
+                "SELECT id, name, vernacular, preferred, src FROM vernacular_by_name"
+                " WHERE lang_primary = {} AND {{}}".format(db.placeholder),
+                [lang_primary]))
+
+    def save(self, path):
+        arrays = {name: getattr(self, name) for name in self.columns}
+        arrays.update(self.vernaculars.arrays("vernaculars"), **self.index.arrays())
+        arrays.update(self.top.arrays())
+        _save_arrays(path, arrays)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(dict(
+                format=snapshot_format, n_rows=len(self.taxa.ids),
+                by_name=self.by_name, name_of=self.name_of, name_rows=self.name_rows), f)
+
+    @classmethod
+    def load(cls, path, taxa, lang_primary):
+        """
+        Return the vernaculars saved in path, memory-mapped, checking that they are for taxa
+        """
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest['format'] != snapshot_format or manifest['n_rows'] != len(taxa.ids):
+            raise ValueError("Search index snapshot in {} is out of date".format(path))
+        typecodes = dict(cls.columns, **PackedStrings.typecodes("vernaculars"))
+        typecodes.update(WordPrefixIndex.typecodes(), **TopHits.typecodes())
+        return cls(taxa, lang_primary, arrays=_load_arrays(path, typecodes), manifest=manifest)
+
+    def rows_for_vernacular(self, v):
+        if v < len(self.otts):
+            return self.taxa.rows_for_ott(self.otts[v])
+        return self.name_rows.get(self.name_of[v], [])
+
+    def for_ott(self, ott):
+        lo = bisect_left(self.otts, ott)
+        hi = bisect_right(self.otts, ott)
+        return [(self.vernaculars[v], self.preferred[v]) for v in range(lo, hi)]
+
+    def extra_cols(self, row, words):
+        """
+        The 'vernacular' and 'extra_vernaculars' values for a hit: the preferred name,
+        and (if that doesn't match) a list of the non-preferred names which do
+        """
+        ott = self.taxa.otts[row]
+        names = self.for_ott(ott) if ott else []
+        if not names:
+            names = self.by_name.get(self.taxa.names[row], [])
+        ret = []
+        for vernacular, preferred in names:
+            match = all(word_matches(vernacular, w, self.logographic) for w in words)
+            if len(ret) == 0:
+                if preferred:
+                    ret = [vernacular] if match else [vernacular, []]
+                elif match:
+                    ret = [None, [vernacular]]
+            elif match and len(ret) == 2:
+                ret[1].append(vernacular)
+        return ret
+
+
+def bisect_left(a, x):
+    lo, hi = 0, len(a)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if a[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def bisect_right(a, x):
+    lo, hi = 0, len(a)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _vernaculars_kind(lang_primary):
+    return "search_vernaculars_" + lang_primary
+
+
+def build_snapshots(version, log=None):
+    """
+    Build the snapshots of the scientific names, and of the vernacular names in each
+    language, for this tree version, unless they already exist. This takes a while, so
+    should not be called by the web server (see private/build_tree_snapshots.py).
+    Returns False if some were being built by another process.
+    """
+    log = log or (lambda s: None)
+    size = tree_snapshots.tree_size()
+
+    def build_taxa(path):
+        log("Indexing the scientific names")
+        TaxonNames().save(path, size)
+
+    taxa = tree_snapshots.build(
+        "search_names", version, build_taxa, lambda path: TaxonNames.load(path, size))
+    if taxa is None:
+        return False
+    complete = True
+    for lang_primary in taxa.languages:
+        if not re.fullmatch(r"\w+", lang_primary):
+            continue
+
+        def build_vernaculars(path):
+            log("Indexing the vernacular names in '{}'".format(lang_primary))
+            VernacularNames.from_db(taxa, lang_primary).save(path)
+
+        complete &= tree_snapshots.build(
+            _vernaculars_kind(lang_primary), version, build_vernaculars,
+            lambda path: VernacularNames.load(path, taxa, lang_primary)) is not None
+    return complete
+
+
+_taxa = dict(version=None, value=None)
+_vernaculars = None
+_missing = {}  # (kind, version) => when a snapshot was last found missing
+
+
+def _load(kind, version, loader):
+    """
+    Load a snapshot, but if it is missing, don't look again for version_check_secs
+    """
+    tried_at = _missing.get((kind, version))
+    if tried_at is not None and time.monotonic() - tried_at < tree_cache.tree_cache_config()['version_check_secs']:
+        return None
+    value = tree_snapshots.load(kind, version, loader)
+    if value is None:
+        _missing[(kind, version)] = time.monotonic()
+    else:
+        _missing.pop((kind, version), None)
+    return value
+
+
+def _get_index(lang_primary):
+    """
+    Return the (TaxonNames, VernacularNames) for the current tree and this language,
+    or None if the index is turned off, or its snapshots have not yet been built
+    """
+    global _vernaculars
+    config = tree_cache.tree_cache_config()
+    if not config['search_index']:
+        return None
+    version = tree_cache.tree_version()
+    if version is None:
+        return None
+    if _vernaculars is None:
+        _vernaculars = tree_cache.LRUCache(config['search_index_languages'])
+    if _taxa['version'] != version:
+        size = tree_snapshots.tree_size()
+        taxa = _load("search_names", version, lambda path: TaxonNames.load(path, size))
+        if taxa is None:
+            return None
+        _vernaculars.clear()
+        _missing.clear()
+        _taxa.update(version=version, value=taxa)
+    taxa = _taxa['value']
+    vernaculars = _vernaculars.get((version, lang_primary))
+    if vernaculars is None:
+        if lang_primary in taxa.languages and re.fullmatch(r"\w+", lang_primary):
+            vernaculars = _load(
+                _vernaculars_kind(lang_primary), version,
+                lambda path: VernacularNames.load(path, taxa, lang_primary))
+            if vernaculars is None:
+                return None
+        else:
+            vernaculars = VernacularNames(taxa, lang_primary)  # No names in this language
+        _vernaculars.set((version, lang_primary), vernaculars)
+    return taxa, vernaculars
+
+
+def reset():
+    """
+    Forget the loaded indexes, and which snapshots were missing (see tree_cache.reset())
+    """
+    global _vernaculars
+    _taxa.update(version=None, value=None)
+    _vernaculars = None
+    _missing.clear()
+
+
+def search(words, lang_primary, limit=None, start=0, restrict_tables=None, include_price=False):
+    """
+    Search for the list of words in the scientific and vernacular names in this language.
+    Returns a dict of table name ('ordered_leaves' and/or 'ordered_nodes') to a list of
+    hits, most popular first, in the format returned by API/search_by_name. At most
+    limit hits are returned for each table, starting at hit number start. Returns None if
+    the index is not available, in which case the database should be searched instead.
+    """
+    index = _get_index(lang_primary)
+    if index is None:
+        return None
+    taxa, vernaculars = index
+    words = [w.lower() for w in words]
+    start = int(start or 0)
+    limit = int(limit) if limit else None
+    if restrict_tables == "leaves":
+        tables = ('ordered_leaves', )
+    elif restrict_tables == "nodes":
+        tables = ('ordered_nodes', )
+    else:
+        tables = ('ordered_leaves', 'ordered_nodes')
+
+    def table(row):
+        return 'ordered_leaves' if taxa.is_leaf(row) else 'ordered_nodes'
+
+    hits = None
+    if len(words) == 1 and len(words[0]) <= 2 and limit and start + limit <= n_short_hits:
+        # Use the precomputed most popular hits for this prefix, if there are enough
+        sources = [taxa.top.get(words[0], []), vernaculars.top.get(words[0], [])]
+        hits = {t: [] for t in tables}
+        seen = set()
+        for pop, row in heapq.merge(*sources, key=lambda x: (-x[0], x[1])):
+            if row in seen:
+                continue
+            seen.add(row)
+            if table(row) in hits:
+                hits[table(row)].append(row)
+            if all(len(h) >= start + limit for h in hits.values()):
+                break
+        else:
+            if any(len(s) >= n_short_hits for s in sources):
+                hits = None  # Ran out of precomputed hits: there may be more
+    if hits is None:
+        rows = set()
+        for i in taxa.index.matching(words):
+            rows.add(i)
+        for v in vernaculars.index.matching(words):
+            rows.update(vernaculars.rows_for_vernacular(v))
+        hits = {t: [] for t in tables}
+        for row in sorted(rows, key=lambda r: (-taxa.popularity[r], r)):
+            if table(row) in hits:
+                hits[table(row)].append(row)
+    results = {}
+    for t, rows in hits.items():
+        rows = rows[start:(start + limit) if limit else None]
+        results[t] = [
+            taxa.output_row(r, include_price) + vernaculars.extra_cols(r, words) for r in rows]
+    return results
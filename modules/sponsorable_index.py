@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory indexes for listing the sponsorable leaves of a clade alphabetically
+(default/list_sponsorable_children), without asking the database to sort the whole clade
+by name, and exclude sponsored leaves, for every page.
+
+SponsorableNames holds the leaves which could be sponsored (those with an ott and a
+space in their name) in the order "ORDER BY name, id", as given by the database, and the
+position of each leaf in that order. The leaves of a clade (a range of leaf ids) are then
+listed in name order either by walking through this order from a given position, skipping
+leaves outside the clade, or for smaller clades, by sorting the positions of the clade's
+leaves. Either way, a page takes time proportional to the page size, or to the clade size
+for small clades, rather than to the whole clade for each page.
+
+The sponsored leaves are kept as a sorted array of otts, which is rebuilt when the
+reservations change (see tree_cache.watch_table), at most once every
+sponsored_rebuild_secs, so that these leaves can be skipped without a join on the
+reservations table.
+
+Reading the leaves of a large tree in name order takes a while, so as with
+search_index.py, SponsorableNames is never built by the web server. Instead
+private/build_tree_snapshots.py saves it as a snapshot in tree_cache.snapshot_dir once per
+tree version, which every worker memory-maps. Until then, requests use the database.
+"""
+import json
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from gluon import current
+
+import tree_cache
+import tree_snapshots
+
+# Walk through the leaves in name order for clades with at least this fraction of all the
+# leaves (so at most 1/walk_fraction leaves are checked per leaf listed). Smaller clades
+# are sorted instead.
+walk_fraction = 1 / 32
+# How many rows to fetch from the database at a time when building
+fetch_chunk = 100000
+# Don't rebuild the sponsored otts more often than this, however often reservations change
+sponsored_rebuild_secs = 5
+
+
+class SponsorableNames:
+    columns = dict(order='i', order_ott='i', position='i')
+
+    def __init__(self, columns=None):
+        """
+        Read the leaves in name order from the database, or (if columns is given) use the
+        arrays of a snapshot
+        """
+        self.missing = -1  # The position of leaves which can't be sponsored
+        if columns is not None:
+            for name in self.columns:
+                setattr(self, name, columns[name])
+            return
+        db = current.db
+        self.order = array('i')  # Leaf ids in name order
+        self.order_ott = array('i')
+        last = None
+        while True:
+            sql = "SELECT id, ott, name FROM ordered_leaves WHERE ott IS NOT NULL AND name LIKE {}".format(
+                db.placeholder)
+            params = ["% %"]
+            if last is not None:
+                # A row value comparison, which can be answered by a range on the name index
+                sql += " AND (name, id) > ({0}, {0})".format(db.placeholder)
+                params += [last[2], last[0]]
+            rows = db.executesql(sql + " ORDER BY name, id LIMIT " + str(fetch_chunk), params)
+            for id, ott, name in rows:
+                self.order.append(id)
+                self.order_ott.append(ott)
+            if len(rows) < fetch_chunk:
+                break
+            last = rows[-1]
+        self.position = array('i', [self.missing]) * ((max(self.order) if self.order else 0) + 1)
+        for pos, id in enumerate(self.order):
+            self.position[id] = pos
+
+    def save(self, path, size):
+        """
+        Save as a snapshot in path, for a tree of the given size (see tree_snapshots.tree_size)
+        """
+        for name in self.columns:
+            with open(os.path.join(path, name), "wb") as f:
+                f.write(getattr(self, name))
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(dict(columns=self.columns, size=size), f)
+
+    @classmethod
+    def load(cls, path, size):
+        """
+        Return the leaves saved in path, memory-mapped, checking they are of a tree of this size
+        """
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest['columns'] != cls.columns or manifest['size'] != size:
+            raise ValueError("Sponsorable leaves snapshot in {} is out of date".format(path))
+        return cls({
+            name: tree_snapshots.map_file(os.path.join(path, name), typecode)
+            for name, typecode in cls.columns.items()})
+
+    def positions(self, lft, rgt, after=-1):
+        """
+        Yield the positions in name order (greater than after) of the leaves with ids in the
+        range lft..rgt, in order
+        """
+        order, position = self.order, self.position
+        lft, rgt = max(lft, 1), min(rgt, len(position) - 1)
+        if rgt < lft:
+            return
+        if rgt - lft + 1 >= walk_fraction * len(order):
+            for pos in range(after + 1, len(order)):
+                if lft <= order[pos] <= rgt:
+                    yield pos
+        else:
+            yield from sorted(p for p in position[lft:rgt + 1] if p > after)
+
+    def page(self, lft, rgt, n, skip=0, after=-1, unavailable=()):
+        """
+        Return the positions and ids of up to n sponsorable leaves with ids in lft..rgt, in
+        name order, starting after the leaf at position 'after' (if given) and skipping the
+        first 'skip'. unavailable is a sorted array of otts to leave out.
+        """
+        out = []
+        for pos in self.positions(lft, rgt, after):
+            ott = self.order_ott[pos]
+            i = bisect_left(unavailable, ott)
+            if i < len(unavailable) and unavailable[i] == ott:
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            out.append((pos, self.order[pos]))
+            if len(out) >= n:
+                break
+        return out
+
+
+def _sponsored_otts():
+    db = current.db
+    return array('i', sorted(r[0] for r in db.executesql(
+        "SELECT DISTINCT OTT_ID FROM reservations WHERE verified_time IS NOT NULL AND OTT_ID IS NOT NULL")))
+
+
+_sponsored_lock = threading.Lock()
+_names = dict(version=None, value=None, tried_at=None)
+_sponsored = dict(stamp=None, value=None, built_at=None)
+
+
+def sponsored_otts():
+    """
+    Return a sorted array of the otts with a verified reservation. This is rebuilt when
+    the reservations change, or are more than tree_cache.homepage_max_age_secs old, but
+    no more than once every sponsored_rebuild_secs. While a change may not yet be
+    committed (see tree_cache.content_settle_secs), it is rebuilt again after that.
+    """
+    stamp = tree_cache.content_stamp('reservations')
+    with _sponsored_lock:
+        now = time.time()
+        built_at = _sponsored['built_at']
+        if built_at is not None:
+            if (_sponsored['stamp'] == stamp and
+                    now - built_at <= tree_cache.tree_cache_config()['homepage_max_age_secs']):
+                return _sponsored['value']
+            if now - built_at < sponsored_rebuild_secs:
+                return _sponsored['value']
+        settled = now - stamp >= tree_cache.content_settle_secs
+        _sponsored.update(value=_sponsored_otts(), stamp=stamp if settled else None, built_at=now)
+        return _sponsored['value']
+
+
+def build_snapshot(version):
+    """
+    Build the snapshot of the sponsorable leaves for this tree version, unless it already
+    exists. This takes a while, so should not be called by the web server (see
+    private/build_tree_snapshots.py). Returns None if another process is building it.
+    """
+    size = tree_snapshots.tree_size()
+    return tree_snapshots.build(
+        'sponsorable_names', version, lambda path: SponsorableNames().save(path, size),
+        lambda path: SponsorableNames.load(path, size))
+
+
+def get():
+    """
+    Return the SponsorableNames for the current tree, or None if it is turned off, or its
+    snapshot has not yet been built (in which case this is only looked for again every
+    tree_cache.version_check_secs)
+    """
+    config = tree_cache.tree_cache_config()
+    if not config['sponsorable_index']:
+        return None
+    version = tree_cache.tree_version()
+    if version is None:
+        return None
+    if _names['version'] == version:
+        return _names['value']
+    if _names['tried_at'] is not None and time.monotonic() - _names['tried_at'] < config['version_check_secs']:
+        return None
+    size = tree_snapshots.tree_size()
+    names = tree_snapshots.load('sponsorable_names', version, lambda path: SponsorableNames.load(path, size))
+    if names is None:
+        _names['tried_at'] = time.monotonic()
+        return None
+    _names.update(version=version, value=names, tried_at=None)
+    return _names['value']
+
+
+def reset():
+    """
+    Forget the loaded snapshot and the sponsored otts (see tree_cache.reset())
+    """
+    _names.update(version=None, value=None, tried_at=None)
+    with _sponsored_lock:
+        _sponsored.update(stamp=None, value=None, built_at=None)
@@ -5,6 +5,7 @@ from gluon import current
 from gluon.utils import web2py_uuid
 
 import ozmail
+import tree_cache
 import usernames
 from OZfunc import (
     child_leaf_query, nice_name_from_otts
@@ -135,15 +136,21 @@ def reservation_total_counts(count_type):
     raise ValueError("Unknown count_type: %s" % count_type)
 
 
-def clear_reservation(reservations_table_id):
+def _cleared_reservation_fields():
+    """Fields to blank when clearing a reservation, i.e. everything bar view accounting"""
     db = current.db
     # NB: We intentionally clear name, deactivated here, and let lt get repopulated
     #     in new rows.
     keep_fields = ('id', 'OTT_ID', 'num_views', 'last_view')
     del_fields = {f: None for f in db.reservations.fields if f not in keep_fields}
     assert len(keep_fields) + len(del_fields) == len(db.reservations.fields)
+    return del_fields
+
+
+def clear_reservation(reservations_table_id):
+    db = current.db
     assert reservations_table_id is not None
-    db(db.reservations.OTT_ID == reservations_table_id).update(**del_fields)
+    db(db.reservations.OTT_ID == reservations_table_id).update(**_cleared_reservation_fields())
 
 
 def reservation_get_all_expired():
@@ -174,6 +181,44 @@ def reservation_expire(r):
     return expired_id
 
 
+def reservation_expire_all(batch_size=1000):
+    """
+    Move all reservations that should be expired (see reservation_get_all_expired) into
+    expired_reservations, batch_size rows at a time, with a fixed number of statements per
+    batch: select the ids, copy the rows with INSERT ... SELECT, then blank them as
+    clear_reservation. Rows are picked out by primary key, so only they are locked. Nothing
+    is committed, so the caller can commit the lot in one transaction.
+
+    Returns a list of the OTT_IDs expired
+    """
+    db = current.db
+    request = current.request
+
+    expired_query = (db.reservations.verified_time != None) & (db.reservations.sponsorship_ends < request.now)
+    copy_fields = ", ".join(f for f in db.reservations.fields if f != 'id')
+    del_fields = _cleared_reservation_fields()
+    expired_otts = []
+    while True:
+        rows = db(expired_query).select(
+            db.reservations.id, db.reservations.OTT_ID,
+            orderby=db.reservations.id, limitby=(0, batch_size))
+        if len(rows) == 0:
+            break
+        ids = [r.id for r in rows]
+        db.executesql(
+            "INSERT INTO expired_reservations ({0}) SELECT {0} FROM reservations"
+            " WHERE id IN ({1}) AND verified_time IS NOT NULL AND sponsorship_ends < {2}".format(
+                copy_fields, ", ".join([db.placeholder] * len(ids)), db.placeholder),
+            ids + [request.now])
+        # Blank everything in current reservation DB records bar view accounting. This
+        # also means they no longer match expired_query for the next batch
+        db(db.reservations.id.belongs(ids) & expired_query).update(**del_fields)
+        expired_otts.extend(r.OTT_ID for r in rows)
+        if len(rows) < batch_size:
+            break
+    return expired_otts
+
+
 def reservation_validate_basket_fields(basket_fields):
     """
     Validate any user input in (basket_fields), return a dict of errors if any.
@@ -468,6 +513,31 @@ def sponsorship_get_leaf_status(OTT_ID_Varin):
     return status, status_param, leaf_entry
 
 
+def sponsorship_get_leaf_statuses(otts, batch_size=1000):
+    """
+    Get the sponsorship status of many leaves at once, as sponsorship_get_leaf_status.
+    Returns a dict of OTT_ID => status (maintenance / invalid / banned / "")
+    """
+    db = current.db
+    maintenance_mode = bool(sponsorship_config()['maintenance_mins'])
+    otts = list(set(ott for ott in otts if ott is not None))
+    valid, banned = set(), set()
+    for i in range(0, len(otts), batch_size):
+        batch = otts[i:i + batch_size]
+        valid.update(r.ott for r in db(db.ordered_leaves.ott.belongs(batch)).select(
+            db.ordered_leaves.ott, db.ordered_leaves.name) if ' ' in (r.name or ""))
+        banned.update(r.ott for r in db(db.banned.ott.belongs(batch)).select(db.banned.ott))
+    out = {}
+    for ott in otts:
+        if ott not in valid:
+            out[ott] = "invalid"
+        elif ott in banned:
+            out[ott] = "banned"
+        else:
+            out[ott] = "maintenance" if maintenance_mode else ""
+    return out
+
+
 def get_reservation(OTT_ID_Varin, form_reservation_code, update_view_count=False):
     """
     Try and add a reservation for OTT_ID_Varin
@@ -700,7 +770,50 @@ def sponsorable_children(target_id, qtype="ott", limit=None, in_reservations=Non
             limitby=limitby,
             orderby="NULL",  # Suppress ordering, as otherwise we try to order on a joined index
         )
-    
+
+
+def precomputed_sponsorable_children(target_id, qtype, price_pence, n):
+    """
+    Return the first n sponsorable children of a node in a price band (price_pence=None
+    for the "contact us" band) from the sponsor_leaves table, as filled out by
+    OZprivate/ServerScripts/Utilities/build_sponsor_leaves.py, in the order shown by
+    default/sponsor_node_price. Leaves which have been sponsored, or have changed price or
+    position in the tree, since the table was built are skipped.
+
+    Returns a list of (ott, scientific name), or None if there is no list for this node, or
+    too few of the listed leaves are still available, or the table was built for a different
+    tree, in which case the leaves should be looked up with sponsorable_children_query()
+    instead.
+    """
+    db = current.db
+    if tree_cache.precomputed_table_built('sponsor_leaves') is None:
+        return None
+    node = db(
+        (db.ordered_nodes.id if qtype == "id" else db.ordered_nodes.ott) == target_id
+    ).select(db.ordered_nodes.id, db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt).first()
+    if node is None:
+        return None
+    listed = db(
+        (db.sponsor_leaves.node_id == node.id) & (db.sponsor_leaves.price == price_pence)
+    ).select(db.sponsor_leaves.leaf_ott, db.sponsor_leaves.band_size, orderby=db.sponsor_leaves.position)
+    if len(listed) == 0:
+        # Either the band is empty, or this node has no lists at all
+        return None if db(db.sponsor_leaves.node_id == node.id).isempty() else []
+    otts = [r.leaf_ott for r in listed]
+    leaves = {
+        r.ott: r for r in db(db.ordered_leaves.ott.belongs(otts)).select(
+            db.ordered_leaves.id, db.ordered_leaves.ott, db.ordered_leaves.name, db.ordered_leaves.price)}
+    sponsored = set(r.OTT_ID for r in db(
+        db.reservations.OTT_ID.belongs(otts) & (db.reservations.verified_time != None)
+    ).select(db.reservations.OTT_ID))
+    available = [
+        (ott, leaves[ott].name) for ott in otts
+        if ott in leaves and ott not in sponsored and leaves[ott].price == price_pence
+        and node.leaf_lft <= leaves[ott].id <= node.leaf_rgt and ' ' in (leaves[ott].name or "")]
+    if len(available) < n and len(listed) < listed.first().band_size:
+        return None  # More leaves exist beyond the end of the list
+    return available[:n]
+
 
 def sponsor_hmac_key():
     """Get hmac_key, or error informatively"""
@@ -778,17 +891,23 @@ def sponsorship_email_reminders(for_usernames=None):
         query &= (db.reservations.restrict_all_contact == None)
 
     for_usernames = set(for_usernames or [])
+    rows = db(query).select(db.reservations.ALL, orderby=db.reservations.username|db.reservations.sponsorship_ends)
+    # Look up leaf statuses & e-mail addresses for everyone at once, rather than per row
+    statuses = sponsorship_get_leaf_statuses(r.OTT_ID for r in rows)
+    email_addresses = usernames.emails_for_usernames(r.username for r in rows)
     cur_username = None
     out = {}
     send_to = False
-    for r in db(query).select(db.reservations.ALL, orderby=db.reservations.username|db.reservations.sponsorship_ends):
+    for r in rows:
         if r.username != cur_username:
             if send_to:
                 yield (cur_username, out)
             # Start new user entry
             cur_username = r.username
+            if r.username not in email_addresses:
+                raise ValueError("No e-mail address found for username %s" % r.username)
             out = dict(
-                email_address = usernames.email_for_username(r.username),
+                email_address = email_addresses[r.username],
                 full_name=None,
                 pp_name=None,
                 username=r.username,
@@ -805,7 +924,7 @@ def sponsorship_email_reminders(for_usernames=None):
             )
             send_to = r.username in for_usernames
 
-        status, _, _ = sponsorship_get_leaf_status(r.OTT_ID)
+        status = statuses.get(r.OTT_ID, "invalid")
 
         if (r.verified_donor_name):
             # replace with the most recent
@@ -911,13 +1030,21 @@ def sponsor_renew_request_logic(user_identifier, mailer=None, reveal_private_dat
             )
     return info
 
-def sponsorship_email_reminders_post(reminder_row):
-    """Log the fact that the e-mails sent so we don't do it again"""
+def sponsorship_email_reminders_post(*reminder_rows, batch_size=1000):
+    """
+    Log the fact that the e-mails sent so we don't do it again. Several reminder rows
+    (e.g. a group of users e-mailed since the last commit) can be given at once.
+    """
     db = current.db
     request = current.request
 
-    db(db.reservations.OTT_ID.belongs(reminder_row['initial_reminders'])).update(emailed_re_renewal_initial=request.now)
-    db(db.reservations.OTT_ID.belongs(reminder_row['final_reminders'])).update(emailed_re_renewal_final=request.now)
+    for key, field in (
+        ('initial_reminders', 'emailed_re_renewal_initial'),
+        ('final_reminders', 'emailed_re_renewal_final'),
+    ):
+        otts = [ott for reminder_row in reminder_rows for ott in reminder_row[key]]
+        for i in range(0, len(otts), batch_size):
+            db(db.reservations.OTT_ID.belongs(otts[i:i + batch_size])).update(**{field: request.now})
 
 
 def sponsorship_restrict_contact(user_name):
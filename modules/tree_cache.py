@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+In-process caches for data that (mostly) only changes when a new tree is loaded.
+
+Web2py keeps imported modules for the lifetime of a worker process, so the caches here
+are shared by all the requests handled by a single worker (but not between workers).
+Everything cached is tied to the tree version, as returned by OZfunc.__check_version(),
+so loading a new tree into the database invalidates the caches automatically.
+"""
+import datetime
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from gluon import current
+
+import OZfunc
+
+
+def tree_cache_config():
+    """
+    Return dict of tree cache config options, returning defaults if not available
+    """
+    myconf = current.globalenv['myconf']
+    out = dict()
+    try:
+        # How often to re-check the tree version in the database
+        out['version_check_secs'] = float(myconf.take('tree_cache.version_check_secs'))
+    except:
+        out['version_check_secs'] = 60.0
+    try:
+        out['node_details_entries'] = int(myconf.take('tree_cache.node_details_entries'))
+    except:
+        out['node_details_entries'] = 5000
+    try:
+        # Sponsorship and tour details can change without a new tree, so don't keep forever
+        out['node_details_max_age_secs'] = float(myconf.take('tree_cache.node_details_max_age_secs'))
+    except:
+        out['node_details_max_age_secs'] = 600.0
+    try:
+        # The ott_details table is not used if it was built longer ago than this
+        out['ott_details_max_age_hours'] = float(myconf.take('tree_cache.ott_details_max_age_hours'))
+    except:
+        out['ott_details_max_age_hours'] = 48.0
+    try:
+        # Use an in-memory index for API/search_by_name (see search_index.py)
+        out['search_index'] = myconf.take('tree_cache.search_index') in ['true', '1', 't', 'y', 'yes', 'True']
+    except:
+        out['search_index'] = True
+    try:
+        # How many languages of vernacular names to keep indexed at once
+        out['search_index_languages'] = int(myconf.take('tree_cache.search_index_languages'))
+    except:
+        out['search_index_languages'] = 4
+    try:
+        # Use an in-memory copy of the tree shape for ancestry queries (see tree_topology.py)
+        out['tree_topology'] = myconf.take('tree_cache.tree_topology') in ['true', '1', 't', 'y', 'yes', 'True']
+    except:
+        out['tree_topology'] = True
+    try:
+        # Where to save snapshots of the tree topology shared by all worker processes
+        # (see tree_topology.py). Empty for each worker to keep its own copy
+        out['snapshot_dir'] = myconf.take('tree_cache.snapshot_dir')
+    except:
+        out['snapshot_dir'] = os.path.join(current.request.folder, 'cache', 'tree_snapshots')
+    try:
+        # Find the most popular leaves in clades using an in-memory index (see popularity_index.py)
+        out['popularity_index'] = myconf.take('tree_cache.popularity_index') in ['true', '1', 't', 'y', 'yes', 'True']
+    except:
+        out['popularity_index'] = True
+    try:
+        # List the sponsorable leaves of clades using in-memory indexes (see sponsorable_index.py)
+        out['sponsorable_index'] = myconf.take('tree_cache.sponsorable_index') in ['true', '1', 't', 'y', 'yes', 'True']
+    except:
+        out['sponsorable_index'] = True
+    try:
+        # Blocks of the home page (counts, news, etc.) are also rebuilt after this long
+        out['homepage_max_age_secs'] = float(myconf.take('tree_cache.homepage_max_age_secs'))
+    except:
+        out['homepage_max_age_secs'] = 3600.0
+    return out
+
+
+_version_lock = threading.Lock()
+_version = dict(value=None, checked_at=None)
+
+
+def tree_version(recheck=False):
+    """
+    Return the currently installed tree version (an int), or None if there is no valid
+    tree. To avoid hitting the database on each call, the version is only re-checked
+    every tree_cache.version_check_secs seconds, or if recheck is True.
+    """
+    now = time.monotonic()
+    with _version_lock:
+        checked_at = _version['checked_at']
+        if (recheck or checked_at is None or
+                now - checked_at >= tree_cache_config()['version_check_secs']):
+            v = OZfunc.__check_version()
+            _version['value'] = v if isinstance(v, int) else None
+            _version['checked_at'] = now
+        return _version['value']
+
+
+class LRUCache:
+    """
+    A thread-safe mapping holding at most max_entries items, discarding the least
+    recently used item when full. If max_age is given (in seconds), items older than
+    this are treated as missing.
+    """
+    def __init__(self, max_entries, max_age=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored_at = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.max_age is not None and time.monotonic() - stored_at > self.max_age:
+                del self._items[key]
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class TreeVersionedCache(LRUCache):
+    """
+    An LRUCache whose keys are implicitly prefixed by the tree version. It is emptied
+    whenever a change in tree version is noticed. If there is no valid tree, nothing
+    is cached.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = None
+
+    def _current_version(self):
+        version = tree_version()
+        if version is not None and version != self.version:
+            self.clear()
+            self.version = version
+        return version
+
+    def get_current(self, key):
+        """
+        Return the value cached for key in the current tree version, or None
+        """
+        version = self._current_version()
+        if version is None:
+            return None
+        return self.get((version, key))
+
+    def get_or_set(self, key, func):
+        """
+        Return the cached value for key, or call func() to create it and cache the result
+        """
+        version = self._current_version()
+        if version is None:
+            return func()
+        value = self.get((version, key))
+        if value is None:
+            value = func()
+            self.set((version, key), value)
+        return value
+
+
+_precomputed_lock = threading.Lock()
+_precomputed = {}  # table name => (checked_at, tree version, build time)
+
+
+def precomputed_table_built(name):
+    """
+    Return when a table precomputed offline (e.g. ott_details) was built, as a datetime,
+    if it was built for the tree version currently loaded, otherwise None, in which case
+    the table should not be used. As for tree_version(), this is only re-checked in the
+    precomputed_tables table every tree_cache.version_check_secs seconds.
+    """
+    version = tree_version()
+    now = time.monotonic()
+    with _precomputed_lock:
+        cached = _precomputed.get(name)
+        if cached is None or now - cached[0] >= tree_cache_config()['version_check_secs']:
+            db = current.db
+            try:
+                row = db(db.precomputed_tables.name == name).select(
+                    db.precomputed_tables.tree_version, db.precomputed_tables.built).first()
+            except Exception:  # E.g. the table has not been created
+                row = None
+            cached = _precomputed[name] = (now, row.tree_version, row.built) if row else (now, None, None)
+    if version is None or cached[1] != version:
+        return None
+    return cached[2]
+
+
+def ott_details_available():
+    """
+    Whether to use the ott_details table: only if it was built for the current tree, and
+    less than tree_cache.ott_details_max_age_hours ago, so that changes to the images and
+    names (which are made outside web2py) are never hidden for longer than that
+    """
+    built = precomputed_table_built('ott_details')
+    if built is None:
+        return False
+    age = (datetime.datetime.now() - built).total_seconds()
+    return age < tree_cache_config()['ott_details_max_age_hours'] * 60 * 60
+
+
+# Don't accept an unreasonable number of otts that the client claims to already hold
+max_exclude_rep_otts = 5000
+
+
+def _without_rep_otts(info, leaf_ids, exclude):
+    """
+    Remove the details of the leaves in the set of otts to exclude from a (complete)
+    node_details response, unless the leaf or node was requested. This gives the same
+    output as passing exclude_rep_otts to OZfunc.nodes_info_from_string().
+    """
+    colnames = OZfunc.nodes_info_from_string("", "")  # No ids: just returns column names
+    leaf_id, leaf_ott = colnames['colnames_leaves']['id'], colnames['colnames_leaves']['ott']
+    node_ott = colnames['colnames_nodes']['ott']
+    # Otts of requested leaves or nodes are always returned
+    skip_leaf = exclude - set(r[leaf_ott] for r in info['leaves'] if r[leaf_id] in leaf_ids)
+    skip_any = skip_leaf - set(r[node_ott] for r in info['nodes'])
+    out = dict(info)
+    out['leaves'] = [r for r in info['leaves'] if r[leaf_id] in leaf_ids or r[leaf_ott] not in skip_leaf]
+    for k in ('leafPic', 'leafIucn', 'reservations'):
+        out[k] = [r for r in info[k] if r[0] not in skip_leaf]
+    for k in ('vernacular_by_ott', 'tours_by_ott'):
+        out[k] = [r for r in info[k] if r[0] not in skip_any]
+    return out
+
+
+_node_details_cache = None
+
+
+def node_details(
+    leafIDs_string, nodeIDs_string, include_names_in="", image_type='best_any', exclude_rep_otts=""
+):
+    """
+    A cached version of OZfunc.nodes_info_from_string() with its default options, as
+    used by API/node_details. The same chunks of ids (e.g. from the top of the tree) are
+    requested over and over by every visitor, so hot chunks can skip the database.
+
+    If the denormalized ott_details table has been built, it is used in preference to
+    looking up the original vernacular, image and IUCN tables.
+
+    Entries are keyed by the set of ids, the primary language (the only part of
+    include_names_in that changes the vernaculars returned) and the image type.
+
+    exclude_rep_otts is an optional comma-separated list of the representative leaf otts
+    that the client already holds. If the response is cached, these are filtered out of
+    it, otherwise they are excluded from the database lookup (and the result, which is
+    specific to this client, is not cached).
+    """
+    global _node_details_cache
+    if _node_details_cache is None:
+        config = tree_cache_config()
+        _node_details_cache = TreeVersionedCache(
+            config['node_details_entries'], config['node_details_max_age_secs'])
+
+    def id_set(ids_string):
+        if re.search(r"[^\d,]|^,|,$|,,", ids_string):
+            raise ValueError
+        return tuple(sorted(set(int(i) for i in ids_string.split(",")))) if ids_string else ()
+
+    if image_type not in ("best_verified", "best_pd"):
+        image_type = "best_any"
+    lang = include_names_in.split(',')[0].split("-")[0] if include_names_in else ""
+    leaf_ids = id_set(leafIDs_string)
+    key = (leaf_ids, id_set(nodeIDs_string), lang, image_type)
+    exclude = set(id_set(exclude_rep_otts))
+    if len(exclude) > max_exclude_rep_otts:
+        exclude = set()
+
+    def lookup(exclude_rep_otts=""):
+        return OZfunc.nodes_info_from_string(
+            leafIDs_string, nodeIDs_string, include_names_in=include_names_in,
+            image_type=image_type, use_ott_details=ott_details_available(),
+            exclude_rep_otts=exclude_rep_otts)
+
+    if exclude:
+        out = _node_details_cache.get_current(key)
+        if out is None:
+            out = lookup(",".join(str(o) for o in exclude))
+        else:
+            out = _without_rep_otts(out, set(leaf_ids), exclude)
+    else:
+        out = _node_details_cache.get_or_set(key, lookup)
+    # Return a shallow copy, with the language string as requested
+    return dict(out, lang=include_names_in)
+
+
+# Wait this long after content changes before caching it, so that the change has been
+# committed to the database (the DAL callbacks in watch_table() run before the commit)
+content_settle_secs = 30
+
+
+def _content_stamp_path(name):
+    if not current.request.folder:
+        return None  # E.g. a request faked in a script
+    return os.path.join(current.request.folder, 'cache', 'content_stamps', name)
+
+
+def content_changed(name):
+    """
+    Note that some content (e.g. 'news') has changed, so that anything cached using its
+    content_stamp() is rebuilt, by all the worker processes on this server
+    """
+    path = _content_stamp_path(name)
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a"):
+        os.utime(path)
+
+
+def content_stamp(name):
+    """
+    Return the time content_changed(name) was last called, or 0 if never. This only
+    needs a stat() of a file, rather than a database query.
+    """
+    try:
+        return os.stat(_content_stamp_path(name)).st_mtime
+    except (OSError, TypeError):
+        return 0
+
+
+def _sets_any(values, fields):
+    for f in fields:
+        try:
+            values[f]
+            return True
+        except Exception:
+            pass
+    return False
+
+
+def watch_table(table, name=None, fields=None):
+    """
+    Call content_changed(name) (by default, the table name) when rows of a DAL table
+    are inserted, updated or deleted. If fields is given, only inserts which set, and
+    updates which change, one of these fields count. This should be called from the
+    models, as tables are redefined on each request. Changes made in raw SQL (e.g.
+    db.executesql) or outside web2py are not noticed.
+    """
+    name = name or table._tablename
+
+    def inserted(values, id):
+        if fields is None or any(_sets_any(values, [f]) and values[f] is not None for f in fields):
+            content_changed(name)
+
+    def updated(dbset, values):
+        if fields is None or _sets_any(values, fields):
+            content_changed(name)
+
+    def deleted(dbset):
+        content_changed(name)
+
+    table._after_insert.append(inserted)
+    table._after_update.append(updated)
+    table._after_delete.append(deleted)
+
+
+_homepage_cache = None
+
+
+def homepage_block(name, func, stamps=()):
+    """
+    Return func(), the data for a block of the home page, cached for the current tree
+    version and until any of the named content stamps change (see watch_table()). Blocks
+    are also rebuilt every tree_cache.homepage_max_age_secs, to pick up other changes.
+    """
+    global _homepage_cache
+    if _homepage_cache is None:
+        _homepage_cache = TreeVersionedCache(100, tree_cache_config()['homepage_max_age_secs'])
+    key = (name, ) + tuple(content_stamp(s) for s in stamps)
+    if any(time.time() - t < content_settle_secs for t in key[1:]):
+        return func()
+    return _homepage_cache.get_or_set(key, func)
+
+
+def reset():
+    """
+    Forget the tree version, and everything cached for it by this worker process, e.g.
+    after switching current.db to another database
+    """
+    global _node_details_cache, _homepage_cache
+    with _version_lock:
+        _version.update(value=None, checked_at=None)
+    with _precomputed_lock:
+        _precomputed.clear()
+    _node_details_cache = None
+    _homepage_cache = None
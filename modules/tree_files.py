@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Content hashes and precompressed variants of the tree data files
+(completetree_<version>.js, cut_position_map_<version>.js, dates_<version>.js) in
+static/FinalOutputs/data, so that they can be cached forever.
+
+The files for each tree version are processed offline by
+OZprivate/ServerScripts/Utilities/precompress_tree_files.py, which writes gzip and
+(if available) brotli versions of each file, and a manifest, tree_files_<version>.json, like:
+
+    {"version": 123, "files": {"completetree_123.js": {
+        "sha256": "...", "size": 3564120, "encodings": {
+            "gzip": {"file": "completetree_123.js.gz", "size": 411292},
+            "br": {"file": "completetree_123.js.br", "size": 305117}}}, ...}}
+
+API/version gives the tree viewer the static URL of each file with its hash added (see
+hashed_names), so a changed file always has a new URL. The files are then served by
+nginx, which sends the .gz or .br variants (gzip_static and brotli_static, see
+install-nginx.sh), with an expiry far in the future.
+
+For servers without such static file handling, API/tree_file serves the files listed
+in a manifest (see serve()), using the hash of a file as its ETag, so that a request
+with a matching If-None-Match is answered with a 304 from the (cached) manifest alone.
+"""
+import json
+import os
+import re
+
+from gluon import current
+from gluon.contenttype import contenttype
+from gluon.http import HTTP
+
+# Preferred first
+encodings = ('br', 'gzip')
+cache_control = "public, max-age=31536000, immutable"
+
+_manifests = {}  # path => (mtime, manifest)
+
+
+def data_folder():
+    return os.path.join(current.request.folder, "static", "FinalOutputs", "data")
+
+
+def manifest(version, folder=None):
+    """
+    Return the manifest for a tree version as a dict, or None if there isn't one. The
+    manifest is only re-read from disk if the file has changed.
+    """
+    path = os.path.join(folder or data_folder(), "tree_files_{}.json".format(int(version)))
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rt") as f:
+            cached = (mtime, json.load(f))
+        _manifests[path] = cached
+    return cached[1]
+
+
+def hashed_names(version, folder=None):
+    """
+    Return a dict of the name of each .js file in the manifest for a tree version to
+    (the start of) its hash, to add to its URL, or an empty dict if there is no manifest
+    """
+    files = (manifest(version, folder) or {}).get('files') or {}
+    return {name: entry['sha256'][:16] for name, entry in files.items() if name.endswith(".js")}
+
+
+def choose_encoding(accept_encoding, available):
+    """
+    Return the preferred content-coding in 'available' which is acceptable according to
+    an Accept-Encoding header, or None to send the file uncompressed
+    """
+    accepted = set()
+    for coding in (accept_encoding or "").split(","):
+        coding, _, params = coding.partition(";")
+        q = re.search(r'q\s*=\s*([\d.]+)', params)
+        try:
+            if q and float(q.group(1)) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    for coding in encodings:
+        if coding in available and (coding in accepted or "*" in accepted):
+            return coding
+    return None
+
+
+def etag(entry, coding=None):
+    return '"{}{}"'.format(entry['sha256'], "-" + coding if coding else "")
+
+
+def serve(filename, folder=None):
+    """
+    Respond with a tree data file listed in a manifest, compressed if the client accepts
+    it, or with a 304 if the client already has it. Raises HTTP(404) for unknown files.
+    """
+    request, response = current.request, current.response
+    match = re.match(r'^[a-z_]+_(\d+)\.(js|json)$', filename)
+    if not match:
+        raise HTTP(404)
+    folder = folder or data_folder()
+    entry = ((manifest(match.group(1), folder) or {}).get('files') or {}).get(filename)
+    if entry is None:
+        raise HTTP(404)
+    coding = choose_encoding(request.env.http_accept_encoding, entry.get('encodings') or {})
+    tag = etag(entry, coding)
+    headers = {
+        'ETag': tag,
+        'Cache-Control': cache_control,
+        'Vary': 'Accept-Encoding',
+        'Content-Type': contenttype(filename),
+    }
+    if_none_match = request.env.http_if_none_match
+    if if_none_match and (if_none_match.strip() == "*" or tag in [
+            t.strip().replace("W/", "", 1) for t in if_none_match.split(",")]):
+        raise HTTP(304, **headers)
+    if coding:
+        headers['Content-Encoding'] = coding
+        path = os.path.join(folder, entry['encodings'][coding]['file'])
+    else:
+        path = os.path.join(folder, filename)
+    response.headers.update(headers)
+    return response.stream(path)
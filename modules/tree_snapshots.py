@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of the in-memory indexes of a tree (see tree_topology.py and search_index.py),
+saved as directories of binary files in tree_cache.snapshot_dir, and memory-mapped by
+every worker process, so that the operating system holds a single copy shared by all of
+them.
+
+Each snapshot is of a "kind" (e.g. tree_topology) and is saved in <kind>_<tree version>.
+It is built by a single process at a time: the builder holds an exclusive lock on the file
+.<kind>_<tree version>.lock while it builds, and other processes wanting the same snapshot
+don't wait for it, but carry on using the database. The snapshot is built in a temporary
+directory and moved into place with a single rename. A snapshot which loads is never
+removed, other than those of previous tree versions, once they have been replaced for a
+day (processes still using them keep their mapping). Snapshots can also be built outside the
+web server, by private/build_tree_snapshots.py.
+"""
+import errno
+import fcntl
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from gluon import current
+
+import tree_cache
+
+# Remove snapshots (and leftover partial builds) of previous tree versions after this long
+keep_old_secs = 24 * 60 * 60
+
+
+def snapshot_path(kind, version):
+    """
+    Return the directory for the snapshot of this kind and tree version, or None if
+    snapshots are turned off
+    """
+    snapshot_dir = tree_cache.tree_cache_config()['snapshot_dir']
+    if not snapshot_dir:
+        return None
+    return os.path.join(snapshot_dir, "{}_{}".format(kind, version))
+
+
+def map_file(path, typecode):
+    """
+    Memory-map a file of packed values as a read-only sequence. Files of bytes (typecode
+    'B') are returned as the mmap itself, whose slices are bytes which can be compared.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b"" if typecode == 'B' else memoryview(b"").cast(typecode)  # Can't map an empty file
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped if typecode == 'B' else memoryview(mapped).cast(typecode)
+
+
+def tree_size():
+    """
+    Return [max node id, max leaf id] of the tree in the database, which a snapshot
+    should match (there can be different trees with the same version, e.g. in testing)
+    """
+    db = current.db
+    return [db.executesql("SELECT MAX(id) FROM {}".format(table))[0][0] or 0
+            for table in ("ordered_nodes", "ordered_leaves")]
+
+
+def load(kind, version, loader):
+    """
+    Return loader(path) for the snapshot of this kind and tree version, or None if there
+    is no snapshot, or loader raises an OSError or ValueError (e.g. it is of a different tree)
+    """
+    path = snapshot_path(kind, version)
+    if path is None or not os.path.isdir(path):
+        return None
+    try:
+        value = loader(path)
+    except (OSError, ValueError):
+        return None
+    replaced = os.path.join(os.path.dirname(path), ".{}_{}.replaced".format(kind, version))
+    if os.path.exists(replaced):
+        try:
+            os.remove(replaced)  # In use again, e.g. after going back to an earlier tree
+        except OSError:
+            pass
+    return value
+
+
+def build(kind, version, save, loader):
+    """
+    Build the snapshot of this kind and tree version, by calling save(path) to fill an
+    empty directory, unless a usable one already exists, and return loader(path) for it.
+    Returns None straight away if another process is already building it, or if
+    snapshots are turned off.
+    """
+    path = snapshot_path(kind, version)
+    if path is None:
+        return None
+    snapshot_dir = os.path.dirname(path)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, ".{}_{}.lock".format(kind, version)), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return None  # Another process is building it
+            raise
+        try:
+            value = load(kind, version, loader)
+            if value is not None:
+                return value  # Built by another process since we last looked
+            building = tempfile.mkdtemp(prefix=".{}_{}_".format(kind, version), dir=snapshot_dir)
+            try:
+                save(building)
+                if os.path.exists(path):
+                    # Not usable (checked above, and only replaced while holding the lock)
+                    discard = tempfile.mkdtemp(prefix=".{}_{}_".format(kind, version), dir=snapshot_dir)
+                    os.rename(path, os.path.join(discard, "old"))
+                    shutil.rmtree(discard, ignore_errors=True)
+                os.rename(building, path)
+            except BaseException:
+                shutil.rmtree(building, ignore_errors=True)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    _remove_old(kind, version, snapshot_dir)
+    return load(kind, version, loader)
+
+
+def _remove_old(kind, version, snapshot_dir):
+    """
+    Remove snapshots of this kind for other tree versions, along with their locks, once
+    they have been replaced for more than keep_old_secs, and any partial builds more than
+    keep_old_secs old. The time a snapshot was replaced is the mtime of the file
+    .<kind>_<tree version>.replaced, created the first time it is seen here.
+    """
+    pattern = re.compile(r"^\.?{}_(-?\d+)(\.lock|\.replaced|_\w+)?$".format(re.escape(kind)))
+    other_versions = set()
+    for name in os.listdir(snapshot_dir):
+        match = pattern.match(name)
+        if not match:
+            continue
+        old = os.path.join(snapshot_dir, name)
+        if match.group(2) not in (None, ".lock", ".replaced"):
+            # A partial build
+            try:
+                if time.time() - os.path.getmtime(old) >= keep_old_secs:
+                    shutil.rmtree(old, ignore_errors=True)
+            except OSError:
+                pass
+        elif int(match.group(1)) != version:
+            other_versions.add(int(match.group(1)))
+    for v in other_versions:
+        replaced = os.path.join(snapshot_dir, ".{}_{}.replaced".format(kind, v))
+        try:
+            if not os.path.exists(replaced):
+                open(replaced, "a").close()
+            elif time.time() - os.path.getmtime(replaced) >= keep_old_secs:
+                shutil.rmtree(os.path.join(snapshot_dir, "{}_{}".format(kind, v)), ignore_errors=True)
+                for suffix in (".lock", ".replaced"):
+                    path = os.path.join(snapshot_dir, ".{}_{}{}".format(kind, v, suffix))
+                    if os.path.exists(path):
+                        os.remove(path)
+        except OSError:
+            pass
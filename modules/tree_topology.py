@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory copy of the shape of the tree, so that questions about ancestry (such as
+the common ancestor of a set of taxa, or whether one taxon lies within another) can be
+answered without walking up the parent chain in the database. It also holds sorted
+arrays of the ott, eol, gbif, ncbi and iucn identifiers of the taxa, so that any number
+of identifiers can be mapped to OneZoom ids by binary search.
+
+Node ids in ordered_nodes are numbered in preorder, so the nested set indexes
+(node_rgt, leaf_lft and leaf_rgt) answer "is X within Y" directly. For the lowest
+common ancestor of two nodes a < b, where a is not an ancestor of b, the shallowest
+node with an id in (a, b] is a child of the common ancestor. That is found with a
+range-minimum lookup over the node depths: a sparse table over blocks of
+block_size nodes, plus a scan of at most two partial blocks.
+
+The topology is built on first use after a new tree is loaded, and requests fall back
+to the database until it is ready. It is saved as a snapshot of the arrays (including the
+otts and leaf popularities) in tree_cache.snapshot_dir, which every worker memory-maps,
+so the operating system holds one copy of the tree shared by all the worker processes.
+Only one process at a time builds the snapshot (see tree_snapshots.py), so the tree is
+read from the database once per version, and private/build_tree_snapshots.py can build it
+in advance. Ids returned are ozids: positive for nodes, negative for leaves.
+"""
+import json
+import math
+import os
+import re
+import threading
+import time
+from array import array
+
+from gluon import current
+
+import tree_cache
+import tree_snapshots
+from search_index import bisect_left, bisect_right, fetch_all
+
+block_size = 64
+# Identifier columns that can be looked up, and the typecodes for their values
+identifiers = dict(ott='i', eol='q', gbif='q', ncbi='q', iucn='q')
+
+
+class RangeMinimum:
+    """
+    Find the position of the smallest value in any range of an array, using a sparse
+    table over blocks of block_size values plus a scan of at most two partial blocks
+    """
+    def __init__(self, values, levels=None):
+        self.values = values
+        if levels is not None:
+            self.levels = levels
+            return
+        n = len(values)
+        blocks = array('i', (self._scan(lo, min(lo + block_size, n) - 1) for lo in range(0, n, block_size)))
+        # levels[k][b] is the position of the smallest value in blocks b..b + 2**k - 1
+        self.levels = [blocks]
+        k = 1
+        while (1 << k) <= len(blocks):
+            prev = self.levels[-1]
+            half = 1 << (k - 1)
+            self.levels.append(array('i', (
+                self._smaller(prev[b], prev[b + half]) for b in range(len(blocks) - (1 << k) + 1))))
+            k += 1
+
+    def _scan(self, lo, hi):
+        return min(range(lo, hi + 1), key=self.values.__getitem__)
+
+    def _smaller(self, a, b):
+        return a if self.values[a] <= self.values[b] else b
+
+    def argmin(self, lo, hi):
+        """
+        Return the position of the smallest value in lo..hi (inclusive)
+        """
+        lo_block, hi_block = lo // block_size, hi // block_size
+        if hi_block - lo_block <= 1:
+            return self._scan(lo, hi)
+        best = self._smaller(
+            self._scan(lo, (lo_block + 1) * block_size - 1),
+            self._scan(hi_block * block_size, hi))
+        b1, b2 = lo_block + 1, hi_block - 1
+        k = (b2 - b1 + 1).bit_length() - 1
+        level = self.levels[k]
+        return self._smaller(best, self._smaller(level[b1], level[b2 - (1 << k) + 1]))
+
+
+class TreeTopology:
+    # The arrays making up a topology, and their typecodes. Node arrays are indexed by
+    # node id, and leaf arrays by leaf id (entry 0 is unused). Missing otts are 0 and
+    # missing popularities are NaN.
+    columns = dict(
+        parent='i', real_parent='i', node_rgt='i', leaf_lft='i', leaf_rgt='i', depth='i', ott='i',
+        leaf_parent='i', leaf_ott='i', leaf_popularity='d',
+        # For each identifier, the sorted values and the ozids of the taxa with each value
+        ott_sorted='i', ott_ozids='i', eol_sorted='q', eol_ozids='i', gbif_sorted='q', gbif_ozids='i',
+        ncbi_sorted='q', ncbi_ozids='i', iucn_sorted='q', iucn_ozids='i',
+        # By leaf id, 0 where the iucn text is more than just a number (e.g. "123|456")
+        leaf_iucn_plain='b')
+
+    def __init__(self, columns=None, levels=None):
+        """
+        Build the topology from the database, or (if columns is given) from a dict of
+        name => array, and the depth sparse table levels, as stored in a snapshot
+        """
+        if columns is not None:
+            for name in self.columns:
+                setattr(self, name, columns[name])
+            self._shallowest = RangeMinimum(self.depth, levels)
+            return
+        for name, typecode in self.columns.items():
+            setattr(self, name, array(typecode, [0]))
+        # Sort keys of value * 2**32 + (ozid + 2**31), which take less memory than tuples
+        keys = {src: [] for src in identifiers}
+        for id, parent, real_parent, node_rgt, leaf_lft, leaf_rgt, ott, eol, gbif, ncbi in fetch_all(
+            "SELECT id, parent, real_parent, node_rgt, leaf_lft, leaf_rgt, ott, eol, gbif, ncbi FROM ordered_nodes WHERE {}"
+        ):
+            self._extend_to(self.parent, id, (
+                self.real_parent, self.node_rgt, self.leaf_lft, self.leaf_rgt, self.depth, self.ott))
+            self.parent[id] = parent
+            self.real_parent[id] = real_parent
+            self.node_rgt[id] = node_rgt
+            self.leaf_lft[id] = leaf_lft
+            self.leaf_rgt[id] = leaf_rgt
+            # Parents always come before their children
+            self.depth[id] = self.depth[parent] + 1 if parent > 0 else 0
+            if ott:
+                self.ott[id] = ott
+            for src, value in (('ott', ott), ('eol', eol), ('gbif', gbif), ('ncbi', ncbi)):
+                if value:
+                    keys[src].append((value << 32) + id + (1 << 31))
+        for id, parent, ott, popularity, eol, gbif, ncbi, iucn in fetch_all(
+            "SELECT id, parent, ott, popularity, eol, gbif, ncbi, iucn FROM ordered_leaves WHERE {}"
+        ):
+            self._extend_to(self.leaf_parent, id, (self.leaf_ott, self.leaf_iucn_plain))
+            self._extend_to(self.leaf_popularity, id)
+            self.leaf_parent[id] = parent
+            self.leaf_popularity[id] = math.nan if popularity is None else popularity
+            if ott:
+                self.leaf_ott[id] = ott
+            if iucn:
+                # As MySQL does when comparing text with a number
+                match = re.match(r"\s*(\d+)", iucn)
+                if match:
+                    self.leaf_iucn_plain[id] = str(int(match.group(1))) == iucn
+                    iucn = int(match.group(1))
+                else:
+                    iucn = None
+            for src, value in (('ott', ott), ('eol', eol), ('gbif', gbif), ('ncbi', ncbi), ('iucn', iucn)):
+                if value:
+                    keys[src].append((value << 32) - id + (1 << 31))
+        for src, typecode in identifiers.items():
+            src_keys = keys.pop(src)
+            src_keys.sort()
+            setattr(self, src + "_sorted", array(typecode, (k >> 32 for k in src_keys)))
+            setattr(self, src + "_ozids", array('i', ((k & 0xFFFFFFFF) - (1 << 31) for k in src_keys)))
+            del src_keys
+        self._shallowest = RangeMinimum(self.depth)
+
+    def save(self, path):
+        """
+        Save a snapshot of the topology as a directory of binary files, one per array
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.columns:
+            with open(os.path.join(path, name), "wb") as f:
+                f.write(getattr(self, name))
+        for k, level in enumerate(self._shallowest.levels):
+            with open(os.path.join(path, "depth_levels_{}".format(k)), "wb") as f:
+                f.write(level)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(dict(
+                columns=self.columns, n_levels=len(self._shallowest.levels),
+                size=[len(self.parent) - 1, len(self.leaf_parent) - 1]), f)
+
+    @classmethod
+    def load(cls, path, size=None):
+        """
+        Return the topology saved in path, with the arrays memory-mapped read-only, so
+        that worker processes loading the same snapshot share a single copy. If given,
+        size is the [max node id, max leaf id] that the snapshot should have.
+        """
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest['columns'] != cls.columns or (size is not None and manifest['size'] != size):
+            raise ValueError("Tree topology snapshot in {} is out of date".format(path))
+        columns = {name: tree_snapshots.map_file(os.path.join(path, name), typecode) for name, typecode in cls.columns.items()}
+        levels = [tree_snapshots.map_file(os.path.join(path, "depth_levels_{}".format(k)), 'i') for k in range(manifest['n_levels'])]
+        return cls(columns, levels)
+
+    @staticmethod
+    def _extend_to(arr, id, others=()):
+        if id >= len(arr):
+            extra = id + 1 - len(arr)
+            for a in (arr, ) + tuple(others):
+                a.extend([0] * extra)
+
+    def shallowest(self, lo, hi):
+        """
+        Return the id of the shallowest node with an id in lo..hi (inclusive)
+        """
+        return self._shallowest.argmin(lo, hi)
+
+    def is_node(self, id):
+        return 0 < id < len(self.node_rgt) and self.node_rgt[id] != 0
+
+    def is_leaf(self, id):
+        return 0 < id < len(self.leaf_parent) and self.leaf_parent[id] != 0
+
+    def ozids_for(self, src, value):
+        """
+        Return the ozids with this value of the src identifier, in increasing order
+        """
+        values = getattr(self, src + "_sorted")
+        lo = bisect_left(values, value)
+        hi = bisect_right(values, value)
+        return getattr(self, src + "_ozids")[lo:hi]
+
+    def ozids_for_ott(self, ott):
+        return self.ozids_for('ott', ott)
+
+    def ott_of(self, ozid):
+        return (self.ott[ozid] if ozid > 0 else self.leaf_ott[-ozid]) or None
+
+    def matching(self, src, values):
+        """
+        Return a list of (value, ozid) for the taxa with any of the values of the src
+        identifier, in the order the database would return them from the leaves and then
+        the nodes table: by increasing leaf id, then by increasing node id
+        """
+        found = []
+        for value in set(values):
+            found.extend((value, ozid) for ozid in self.ozids_for(src, value))
+        found.sort(key=lambda f: (f[1] > 0, abs(f[1])))
+        return found
+
+    def ott_map(self, src, values):
+        """
+        As API/getOTT, return a dict of value => ott for the taxa with any of the values
+        of the src identifier (eol, gbif, ncbi or iucn). Where taxa share a value, the last
+        in database order wins, so nodes take precedence over leaves. For iucn, the keys
+        are the iucn text of each leaf, as stored in the database.
+        """
+        found = self.matching(src, values)
+        if src != 'iucn':
+            return {value: self.ott_of(ozid) for value, ozid in found}
+        # The text is usually just the number: look up the few leaves where it isn't
+        ids = [-ozid for value, ozid in found if not self.leaf_iucn_plain[-ozid]]
+        texts = {}
+        if ids:
+            db = current.db
+            texts = dict(db.executesql("SELECT id, iucn FROM ordered_leaves WHERE id IN ({})".format(
+                ",".join([db.placeholder] * len(ids))), ids))
+        return {texts.get(-ozid, str(value)): self.ott_of(ozid) for value, ozid in found}
+
+    def is_within(self, ozid, ancestor_ozid):
+        """
+        Is ozid the same as, or a descendant of, ancestor_ozid? Uses the tree with
+        polytomies broken, so nodes created to break polytomies count as ancestors.
+        """
+        if ancestor_ozid < 0:
+            return ozid == ancestor_ozid
+        if ozid < 0:
+            return self.leaf_lft[ancestor_ozid] <= -ozid <= self.leaf_rgt[ancestor_ozid]
+        return ancestor_ozid <= ozid <= self.node_rgt[ancestor_ozid]
+
+    def lineage(self, node_id):
+        """
+        Return the list of node_id and its ancestors, nearest first, following real_parent
+        (so skipping nodes created to break polytomies) up to the root
+        """
+        out = []
+        while self.is_node(node_id) and len(out) < len(self.real_parent):  # Guard against loops
+            out.append(node_id)
+            node_id = abs(self.real_parent[node_id])
+        return out
+
+    def common_ancestor(self, ozids):
+        """
+        Return the ozid of the lowest common ancestor of a list of ozids, skipping over
+        nodes created to break polytomies (with a negative real_parent) as does
+        following the real_parent chain in the database. If all the ozids are the same,
+        that ozid is returned.
+        """
+        ozids = set(ozids)
+        if len(ozids) == 1:
+            return ozids.pop()
+        # A leaf's ancestors are those of its parent
+        nodes = [id if id > 0 else self.leaf_parent[-id] for id in ozids]
+        a, b = min(nodes), max(nodes)
+        if a == b or b <= self.node_rgt[a]:
+            lca = a
+        else:
+            lca = self.parent[self.shallowest(a + 1, b)]
+        if self.real_parent[lca] < 0:
+            lca = -self.real_parent[lca]
+        return lca
+
+
+_build_lock = threading.Lock()
+_topology = dict(version=None, value=None, tried_at=None)
+
+
+def get():
+    """
+    Return the TreeTopology for the current tree, or None if it is turned off, or is
+    being built by another thread or process
+    """
+    if not tree_cache.tree_cache_config()['tree_topology']:
+        return None
+    version = tree_cache.tree_version()
+    if version is None:
+        return None
+    if _topology['version'] == version:
+        return _topology['value']
+    if (_topology['tried_at'] is not None and
+            time.monotonic() - _topology['tried_at'] < tree_cache.tree_cache_config()['version_check_secs']):
+        return None  # Don't keep trying while another process builds the snapshot
+    if not _build_lock.acquire(blocking=False):
+        return None
+    try:
+        if _topology['version'] != version:
+            _topology['value'] = None  # Release the memory before building the new one
+            topology = _load_or_build(version)
+            if topology is None:
+                _topology['tried_at'] = time.monotonic()
+                return None
+            _topology.update(value=topology, version=version, tried_at=None)
+        return _topology['value']
+    finally:
+        _build_lock.release()
+
+
+def reset():
+    """
+    Forget the loaded topology (see tree_cache.reset())
+    """
+    with _build_lock:
+        _topology.update(version=None, value=None, tried_at=None)
+
+
+def _tree_size():
+    return tree_snapshots.tree_size()
+
+
+def _load_or_build(version):
+    """
+    Load the snapshot of the topology for this tree version, building and saving one
+    first if no other process has, or build a private copy if snapshots are turned off.
+    Returns None if another process is building the snapshot.
+    """
+    if not tree_cache.tree_cache_config()['snapshot_dir']:
+        return TreeTopology()
+    size = _tree_size()
+    return (tree_snapshots.load('tree_topology', version, lambda path: TreeTopology.load(path, size)) or
+            build_snapshot(version, size))
+
+
+def build_snapshot(version, size=None):
+    """
+    Build the snapshot of the topology for this tree version, unless it already exists
+    (also done by private/build_tree_snapshots.py, so that the first request after a new
+    tree is loaded doesn't have to). Returns None if another process is building it.
+    """
+    size = size or _tree_size()
+    return tree_snapshots.build(
+        'tree_topology', version, lambda path: TreeTopology().save(path),
+        lambda path: TreeTopology.load(path, size))
+
+
+def lineage(node_id):
+    """
+    Return the list of node_id and its ancestors up to the root, nearest first, skipping
+    nodes created to break polytomies. Uses the in-memory topology if available,
+    otherwise a single recursive query up the real_parent chain in the database.
+    """
+    topology = get()
+    if topology is not None:
+        return topology.lineage(node_id)
+    return _lineage_in_db(node_id)
+
+
+def _lineage_in_db(node_id):
+    db = current.db
+    return [r[0] for r in db.executesql("""
+        WITH RECURSIVE cte (id, real_parent, lvl) AS (
+            SELECT id, real_parent, 0 FROM ordered_nodes WHERE id = {0}
+                UNION ALL
+            SELECT n.id, n.real_parent, cte.lvl + 1
+              FROM ordered_nodes n
+        INNER JOIN cte ON n.id = ABS(cte.real_parent)
+             WHERE cte.lvl < {0}  -- Guard against loops
+        ) SELECT id FROM cte ORDER BY lvl
+    """.format(db.placeholder), (node_id, 5000))]
@@ -147,6 +147,32 @@ def email_for_username(username):
     raise ValueError("No e-mail address found for username %s" % username)
 
 
+def emails_for_usernames(usernames, batch_size=1000):
+    """
+    Return a dict of username => the most up to date e-mail address, as email_for_username,
+    for many usernames at once. Usernames with no e-mail address are left out.
+    """
+    db = current.db
+    usernames = list(set(usernames))
+    out, pp_e_mails = {}, {}
+    for i in range(0, len(usernames), batch_size):
+        for r in db(db.reservations.username.belongs(usernames[i:i + batch_size])).iterselect(
+            db.reservations.username,
+            db.reservations.e_mail,
+            db.reservations.PP_e_mail,
+            orderby=db.reservations.username | ~db.reservations.verified_time
+        ):
+            if r.username in out:
+                continue
+            if r.e_mail:
+                out[r.username] = r.e_mail
+            elif r.PP_e_mail and r.username not in pp_e_mails:
+                pp_e_mails[r.username] = r.PP_e_mail
+    for username, pp_e_mail in pp_e_mails.items():
+        out.setdefault(username, pp_e_mail)
+    return out
+
+
 def usernames_associated_to_email(email):
     """Given an e-mail address, return a tuple of usernames that have used it"""
     db = current.db
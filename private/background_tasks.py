@@ -25,7 +25,7 @@ from gluon.globals import Request
 
 import ozmail
 from sponsorship import (
-    reservation_expire,
+    reservation_expire_all,
     reservation_get_all_expired,
     sponsorship_email_reminders,
     sponsorship_email_reminders_post,
@@ -66,43 +66,62 @@ else:
     if not mail:
         raise ValueError(reason)
 
-for (username, user_reminders) in sponsorship_email_reminders():
-    email = user_reminders['email_address']
-    verbose("-" * 80)
-    verbose("* Sending e-mail to %s" % email)
-    user_reminders['nice_names'] = nice_name_from_otts(
-        user_reminders['unsponsorable'] + user_reminders['not_yet_due'] +
-        user_reminders['initial_reminders'] + user_reminders['final_reminders'],
-        lang=user_reminders['user_sponsor_lang'], leaf_only=True,
-        html=False, first_upper=True,
-    )
-    user_reminders['automated'] = True
-    mailargs = ozmail.template_mail(
-        'sponsor_renew_reminder',
-        user_reminders,
-        to=email,
-    )
-    verbose(mailargs['message'])
-
-    # Actually try sending
-    if run_dryrun:
-        verbose("    ... (dry run)")
-    else:
-        if not mail.send(**mailargs):
-            raise ValueError("Failed to send e-mail")
-        # Register as sent
-        verbose("    ... Success")
-        # Write back sent status and commit, so we don't do it again
-        sponsorship_email_reminders_post(user_reminders)
+# Reminders sent since the last commit. These are written back and committed in groups,
+# rather than per user, and always before stopping so we don't send them again
+reminders_sent = []
+reminders_commit_every = 100
+
+def commit_reminders_sent():
+    if reminders_sent:
+        sponsorship_email_reminders_post(*reminders_sent)
         db.commit()
+        verbose("* Recorded %d reminders as sent" % len(reminders_sent))
+        del reminders_sent[:]
+
+try:
+    for (username, user_reminders) in sponsorship_email_reminders():
+        email = user_reminders['email_address']
+        verbose("-" * 80)
+        verbose("* Sending e-mail to %s" % email)
+        user_reminders['nice_names'] = nice_name_from_otts(
+            user_reminders['unsponsorable'] + user_reminders['not_yet_due'] +
+            user_reminders['initial_reminders'] + user_reminders['final_reminders'],
+            lang=user_reminders['user_sponsor_lang'], leaf_only=True,
+            html=False, first_upper=True,
+        )
+        user_reminders['automated'] = True
+        mailargs = ozmail.template_mail(
+            'sponsor_renew_reminder',
+            user_reminders,
+            to=email,
+        )
+        verbose(mailargs['message'])
+
+        # Actually try sending
+        if run_dryrun:
+            verbose("    ... (dry run)")
+        else:
+            if not mail.send(**mailargs):
+                raise ValueError("Failed to send e-mail")
+            # Register as sent
+            verbose("    ... Success")
+            reminders_sent.append(user_reminders)
+            if len(reminders_sent) >= reminders_commit_every:
+                commit_reminders_sent()
+finally:
+    # Write back sent status and commit, so we don't do it again, even if a later send failed
+    commit_reminders_sent()
 
 verbose("-" * 80)
 verbose("* Expire any old sponsorships")
-for r in reservation_get_all_expired():
+if run_dryrun:
+    expired_otts = [r.OTT_ID for r in reservation_get_all_expired()]
+else:
+    # Expire in bulk, and commit all in one go
+    expired_otts = reservation_expire_all()
+for ott in expired_otts:
     print("Expiring sponsorship for OTT %d %s" % (
-        r.OTT_ID,
+        ott,
         "(dry-run)" if run_dryrun else "",
     ))
-    if not run_dryrun:
-        reservation_expire(r)
 db.commit()
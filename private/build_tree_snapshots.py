@@ -0,0 +1,70 @@
+"""
+OneZoom tree snapshot builder
+=============================
+
+Builds the snapshots of the in-memory indexes of the current tree (the tree topology,
+the search index of scientific and vernacular names, the leaves in popularity order, and
+the sponsorable leaves in name order) in tree_cache.snapshot_dir, which the web server's
+worker processes then memory-map. Run this after loading a new tree: until the search
+index, popularity and sponsorable leaves snapshots exist, the web server uses the
+database instead.
+
+Usage::
+
+    grunt exec:build_tree_snapshots[:verbose]
+
+* ``verbose`` will print out what is being done to stdout.
+
+"""
+import os.path
+import sys
+
+from gluon.globals import Request
+
+import popularity_index
+import search_index
+import sponsorable_index
+import tree_cache
+import tree_topology
+
+run_verbose = 'verbose' in sys.argv
+
+def verbose(s):
+    if run_verbose:
+        print(s)
+
+# Regenerate request for current time
+current.request = Request(dict())
+
+# Application directory
+current.request.folder = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+current.request.application = os.path.basename(current.request.folder)
+
+if not tree_cache.tree_cache_config()['snapshot_dir']:
+    print("No tree_cache.snapshot_dir is set in appconfig.ini: nothing to build", file=sys.stderr)
+    exit(1)
+version = tree_cache.tree_version(recheck=True)
+if version is None:
+    print("No valid tree is installed", file=sys.stderr)
+    exit(1)
+
+complete = True
+verbose("Building the snapshots for tree version {}".format(version))
+if tree_topology.build_snapshot(version) is None:
+    print("The tree topology is being built by another process", file=sys.stderr)
+    complete = False
+if not search_index.build_snapshots(version, verbose):
+    print("Some of the search index is being built by another process", file=sys.stderr)
+    complete = False
+verbose("Sorting the leaves by popularity")
+if popularity_index.build_snapshot(version) is None:
+    print("The leaves are being sorted by popularity by another process", file=sys.stderr)
+    complete = False
+verbose("Listing the sponsorable leaves in name order")
+if sponsorable_index.build_snapshot(version) is None:
+    print("The sponsorable leaves are being listed by another process", file=sys.stderr)
+    complete = False
+db.commit()  # Don't leave the transaction open
+if not complete:
+    exit(1)
+verbose("Done")
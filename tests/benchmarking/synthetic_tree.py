@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Generate a synthetic tree of life, so that the server code can be benchmarked without
+production data. The tree tables (ordered_nodes and ordered_leaves) are filled out with
+consistent nested-set indexes, along with images, vernacular names and IUCN statuses
+for a proportion of the taxa, and representative images for each node.
+
+Everything is generated from a seeded random number generator, so the same arguments
+always give the same tree.
+"""
+import bisect
+import random
+
+syllables = [
+    "ab", "ac", "al", "an", "ar", "ba", "ca", "ce", "da", "de", "di", "el", "en", "er",
+    "fa", "ga", "gi", "ha", "il", "in", "la", "li", "lo", "ma", "me", "mi", "mo", "na",
+    "ni", "no", "or", "pa", "pe", "po", "ra", "re", "ri", "ro", "sa", "se", "si", "ta",
+    "te", "ti", "to", "us", "va", "ve", "vi", "xa", "ze"]
+latin_endings = ["us", "a", "um", "is", "ensis", "oides", "ata", "ii"]
+node_endings = ["idae", "inae", "ales", "acea", "ini", "oidea", "ia"]
+vernacular_words = [
+    "common", "greater", "lesser", "spotted", "striped", "red", "blue", "golden", "black",
+    "white", "giant", "dwarf", "crested", "long-tailed", "mountain", "river", "desert",
+    "forest", "grey", "horned"]
+vernacular_nouns = [
+    "frog", "beetle", "finch", "moth", "fern", "lily", "shrew", "bat", "snail", "crab",
+    "eel", "owl", "oak", "grass", "orchid", "newt", "wasp", "ant", "lizard", "mouse"]
+iucn_codes = ["LC", "NT", "VU", "EN", "CR", "DD", "EX"]
+image_types = ("any", "verified", "pd")
+rep_prefixes = dict(any="rep", verified="rtr", pd="rpd")
+
+
+def word(rnd, n_syllables):
+    return "".join(rnd.choice(syllables) for _ in range(n_syllables))
+
+
+def vernacular(rnd):
+    return " ".join([rnd.choice(vernacular_words), rnd.choice(vernacular_nouns)]).capitalize()
+
+
+def insert_rows(db, table, cols, rows, batch_size=500):
+    """
+    Insert a list of tuples into table using multi-row INSERTs
+    """
+    row_sql = "(" + ",".join([db.placeholder] * len(cols)) + ")"
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        db.executesql("INSERT INTO {} ({}) VALUES {};".format(
+            table, ",".join(cols), ",".join([row_sql] * len(batch))),
+            [v for row in batch for v in row])
+
+
+def make_synthetic_tree(
+    db,
+    n_leaves=10000,
+    max_depth=25,
+    max_children=6,
+    seed=1,
+    image_prob=0.6,
+    vernacular_prob=0.3,
+    iucn_prob=0.3,
+    languages=("en", "fr"),
+):
+    """
+    Replace the contents of the tree tables in db (a DAL with the OneZoom tables defined,
+    and a db.placeholder attribute) with a random tree of n_leaves leaves, no more than
+    max_depth nodes deep, with each node having between 2 and max_children children
+    (more at the maximum depth). The tree version (minus the parent of the root) is 0.
+
+    Returns a dict of the number of rows created in each table.
+    """
+    rnd = random.Random(seed)
+    nodes = []  # [id, parent, node_rgt, leaf_lft, leaf_rgt, name, ott, popularity]
+    leaves = []  # [id, parent, name, ott, popularity, price]
+    ott = [0]
+
+    def next_ott():
+        ott[0] += 1
+        return ott[0]
+
+    def build(parent, n, depth):
+        node_id = len(nodes) + 1
+        node = [node_id, parent, None, len(leaves) + 1, None, None, None, None]
+        nodes.append(node)
+        if rnd.random() < 0.7:
+            node[5] = word(rnd, 3).capitalize() + rnd.choice(node_endings)
+        if rnd.random() < 0.95:
+            node[6] = next_ott()
+        if depth >= max_depth - 1 or n <= 2:
+            sizes = [1] * n
+        else:
+            # Uneven splits, as in real trees
+            k = min(n, rnd.randint(2, max_children))
+            cuts = sorted(rnd.sample(range(1, n), k - 1))
+            sizes = [b - a for a, b in zip([0] + cuts, cuts + [n])]
+        genus = word(rnd, 2).capitalize()
+        for size in sizes:
+            if size == 1:
+                leaf_id = len(leaves) + 1
+                leaves.append([
+                    leaf_id, node_id, genus + " " + word(rnd, 2) + rnd.choice(latin_endings),
+                    next_ott(), rnd.paretovariate(1.5),
+                    rnd.choice([None, 2000, 5000, 7500, 10000, 15000])])
+            else:
+                build(node_id, size, depth + 1)
+        node[2] = len(nodes)
+        node[4] = len(leaves)
+        node[7] = sum(l[4] for l in leaves[node[3] - 1:node[4]]) / 10
+
+    build(0, n_leaves, 0)
+
+    images = []
+    best = {t: [] for t in image_types}  # sorted leaf ids with a best image of each type
+    for leaf in leaves:
+        if rnd.random() < image_prob:
+            is_verified = rnd.random() < 0.5
+            is_pd = rnd.random() < 0.2
+            for t, flag in zip(image_types, (True, is_verified, is_pd)):
+                if flag:
+                    best[t].append(leaf[0])
+            images.append((
+                leaf[3], 2, len(images) + 1, rnd.randint(25000, 50000),
+                "© Synthetic", "public domain" if is_pd else "cc-by",
+                1, int(is_verified), int(is_pd), 1, int(is_verified), int(is_pd)))
+
+    vernaculars = []
+    for ott_value in [l[3] for l in leaves] + [n[6] for n in nodes if n[6]]:
+        for lang in languages:
+            if rnd.random() < vernacular_prob:
+                vernaculars.append((ott_value, vernacular(rnd), lang, lang, 1, 1))
+    vernaculars_by_name = []
+    for n in nodes:
+        if n[5] and not n[6]:
+            vernaculars_by_name.append((n[5], vernacular(rnd), languages[0], languages[0], 1, 1))
+
+    iucn = [(l[3], rnd.randint(1, 10**6), rnd.choice(iucn_codes)) for l in leaves if rnd.random() < iucn_prob]
+
+    # Representative images: up to 8 best images spread evenly through each node's leaves
+    leaf_otts = [None] + [l[3] for l in leaves]
+    rep_cols = ["{}{}".format(rep_prefixes[t], i) for t in image_types for i in range(1, 9)]
+    node_rows = []
+    for n in nodes:
+        reps = []
+        for t in image_types:
+            lo = bisect.bisect_left(best[t], n[3])
+            hi = bisect.bisect_right(best[t], n[4])
+            picks = [best[t][lo + (i * (hi - lo)) // 8] for i in range(8)] if hi - lo >= 8 else best[t][lo:hi]
+            reps += [leaf_otts[i] for i in picks] + [None] * (8 - len(picks))
+        node_rows.append([n[0], n[1], n[1], n[2], n[3], n[4], n[5], n[6], n[7]] + reps)
+
+    for table in ("ordered_nodes", "ordered_leaves", "images_by_ott", "vernacular_by_ott",
+                  "vernacular_by_name", "iucn", "ott_details"):
+        db.executesql("DELETE FROM {};".format(table))
+    insert_rows(
+        db, "ordered_nodes",
+        ["id", "parent", "real_parent", "node_rgt", "leaf_lft", "leaf_rgt", "name", "ott", "popularity"] + rep_cols,
+        node_rows)
+    insert_rows(
+        db, "ordered_leaves",
+        ["id", "parent", "real_parent", "name", "ott", "popularity", "price"],
+        [(l[0], l[1], l[1], l[2], l[3], l[4], l[5]) for l in leaves])
+    insert_rows(
+        db, "images_by_ott",
+        ["ott", "src", "src_id", "rating", "rights", "licence", "best_any", "best_verified", "best_pd",
+         "overall_best_any", "overall_best_verified", "overall_best_pd"],
+        images)
+    insert_rows(
+        db, "vernacular_by_ott",
+        ["ott", "vernacular", "lang_primary", "lang_full", "preferred", "src"],
+        vernaculars)
+    insert_rows(
+        db, "vernacular_by_name",
+        ["name", "vernacular", "lang_primary", "lang_full", "preferred", "src"],
+        vernaculars_by_name)
+    insert_rows(db, "iucn", ["ott", "iucn", "status_code"], iucn)
+    db.commit()
+    return dict(
+        ordered_nodes=len(nodes), ordered_leaves=len(leaves), images_by_ott=len(images),
+        vernacular_by_ott=len(vernaculars), vernacular_by_name=len(vernaculars_by_name),
+        iucn=len(iucn))
@@ -0,0 +1,169 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_OZprivate_EoLQueryPicsNames.py
+
+Runs the EoL harvest in OZprivate/ServerScripts/Utilities/EoLQueryPicsNames.py against a
+stub of the EoL API, saving into a temporary sqlite database.
+"""
+import argparse
+import http.server
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+from itertools import islice
+
+from applications.OZtree.tests.util import web2py_app_dir
+
+sys.path.append(os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'Utilities'))
+import EoLQueryPicsNames
+
+
+class StubEoLAPI(http.server.BaseHTTPRequestHandler):
+    """
+    Answer calls to /api/pages/1.0.json with a vernacular name for each EoL id, noting the
+    time of each call for each id in server.calls. Ids in server.busy get a 503 (asking
+    for a retry after 1 second) the first time, and ids in server.broken always get a 500
+    """
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        ids = [int(i) for i in params['id'][0].split(",")]
+        with self.server.lock:
+            for i in ids:
+                self.server.calls.setdefault(i, []).append(time.monotonic())
+            busy = [i for i in ids if i in self.server.busy]
+            self.server.busy.difference_update(busy)
+        if url.path != "/api/pages/1.0.json":
+            return self.send_error(404)
+        if any(i in self.server.broken for i in ids):
+            return self.send_error(500)
+        if busy:
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return
+        body = json.dumps({str(i): {
+            'identifier': i,
+            'scientificName': "Taxon {}".format(i),
+            'vernacularNames': [{'vernacularName': "Name {}".format(i), 'language': "en-GB", 'eol_preferred': True}],
+        } for i in ids}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestEoLHarvest(unittest.TestCase):
+    maxDiff = None
+    eols = {101 + i: 1 + i for i in range(6)}  # EoL id => ott
+    tables = {'ordered_nodes': None}  # Names only, so no images are downloaded
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubEoLAPI)
+        self.server.lock = threading.Lock()
+        self.server.calls = {}
+        self.server.busy = set()
+        self.server.broken = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.dir = tempfile.mkdtemp()
+        self.db = sqlite3.connect(os.path.join(self.dir, "test.sqlite"))
+        self.db.executescript("""
+            CREATE TABLE ordered_nodes (ott INTEGER, eol INTEGER, popularity REAL);
+            CREATE TABLE eol_updated (id INTEGER PRIMARY KEY, eol INTEGER NOT NULL UNIQUE, updated TIMESTAMP NOT NULL, real_eol_id INTEGER);
+            CREATE TABLE eol_inspected (id INTEGER PRIMARY KEY, ott INTEGER, name TEXT, eol INTEGER, via INTEGER NOT NULL, inspected TIMESTAMP NOT NULL);
+            CREATE TABLE vernacular_by_ott (id INTEGER PRIMARY KEY, ott INTEGER NOT NULL, vernacular TEXT NOT NULL, lang_primary TEXT NOT NULL, lang_full TEXT NOT NULL, preferred INTEGER NOT NULL, src INTEGER NOT NULL, src_id INTEGER, updated TIMESTAMP);
+        """)
+        self.db.executemany(
+            "INSERT INTO ordered_nodes (ott, eol, popularity) VALUES (?, ?, ?)",
+            [(ott, eol, 1000 - ott) for eol, ott in self.eols.items()])
+        self.db.commit()
+
+        # Globals set up by the script when run from the command line
+        EoLQueryPicsNames.args = argparse.Namespace(
+            api_url="http://127.0.0.1:{}/api".format(self.server.server_address[1]),
+            retries=1, threads=3, output_dir=self.dir, thumbnail_size=150, add_percent=12.5,
+            save_names_table="vernacular_by_ott", save_update_times_table="eol_updated")
+        EoLQueryPicsNames.subs = "?"
+        EoLQueryPicsNames.datetime_now = "datetime('now')"
+        EoLQueryPicsNames.diff_minutes = lambda a, b: '((julianday({1}) - julianday({0})) * 24 * 60)'.format(a, b)
+        EoLQueryPicsNames.on_duplicate = lambda key: 'ON CONFLICT({}) DO UPDATE SET'.format(key)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def harvest(self, jobs, rate=20):
+        EoLQueryPicsNames.harvest(
+            jobs, "API_KEY", self.db, EoLQueryPicsNames.TokenBucket(rate), threads=3)
+
+    def updated(self):
+        return {r[0]: r[1] for r in self.db.execute("SELECT eol, real_eol_id FROM eol_updated")}
+
+    def test_harvest(self):
+        rate = 10
+        self.harvest([({eol: ott}, None, None) for eol, ott in self.eols.items()], rate)
+        self.assertEqual(self.updated(), {eol: eol for eol in self.eols})
+        self.assertEqual(
+            sorted(self.db.execute("SELECT ott, vernacular, lang_primary, preferred FROM vernacular_by_ott")),
+            [(ott, "Name {}".format(eol), "en", 1) for eol, ott in self.eols.items()])
+
+        # Although 3 threads call the API at once, the calls are limited to the rate
+        calls = sorted(t for times in self.server.calls.values() for t in times)
+        self.assertEqual(len(calls), len(self.eols))
+        for prev, t in zip(calls, calls[1:]):
+            self.assertGreater(t - prev, 0.8 / rate)
+
+        # Harvesting again replaces the names, rather than adding to them
+        self.harvest([(self.eols, None, None)])
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM vernacular_by_ott").fetchone()[0], len(self.eols))
+        self.assertEqual(self.updated(), {eol: eol for eol in self.eols})
+
+    def test_harvest_retry(self):
+        """A call which the API is too busy to answer is retried after the time asked for"""
+        self.server.busy.add(103)
+        self.harvest(EoLQueryPicsNames.OTT_jobs(list(self.eols.values()), self.db, 2, self.tables))
+        self.assertEqual(self.updated(), {eol: eol for eol in self.eols})
+        self.assertEqual(len(self.server.calls[103]), 2)
+        self.assertGreaterEqual(self.server.calls[103][1] - self.server.calls[103][0], 0.9)
+        self.assertEqual(len(self.server.calls[101]), 1)
+
+    def test_harvest_resume(self):
+        """A batch which fails is not recorded as done, so a later harvest picks it up"""
+        self.server.broken.add(105)
+        self.harvest(islice(EoLQueryPicsNames.auto_jobs(self.db, 2, self.tables, "eol_inspected"), 3))
+        self.assertEqual(len(self.server.calls[105]), 2)  # Tried, and retried
+        self.assertEqual(self.updated(), {eol: eol for eol in self.eols if eol not in (105, 106)})
+
+        # Restarting only looks up the ids not yet done
+        self.server.broken.clear()
+        self.server.calls.clear()
+        self.harvest(islice(EoLQueryPicsNames.auto_jobs(self.db, 2, self.tables, "eol_inspected"), 1))
+        self.assertEqual(sorted(self.server.calls), [105, 106])
+        self.assertEqual(self.updated(), {eol: eol for eol in self.eols})
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestEoLHarvest))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -0,0 +1,132 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_OZprivate_getEOL_crops.py
+
+Checks the cropping in OZprivate/ServerScripts/Utilities/getEOL_crops.py against
+synthetic images, to match what ImageMagick's convert used to do.
+"""
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+from PIL import Image
+from PIL.JpegImagePlugin import JpegImageFile
+
+from applications.OZtree.tests.util import web2py_app_dir
+
+sys.path.append(os.path.join(web2py_app_dir, 'OZprivate', 'ServerScripts', 'Utilities'))
+import getEOL_crops
+
+RED, GREEN, BLUE, WHITE = (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)
+
+
+def image_file(width, height, blocks, format='PNG'):
+    """
+    Return a file of a width x height image, with the (left, top, right, bottom)
+    rectangles in blocks filled in their colours, and the rest white
+    """
+    image = Image.new('RGB', (width, height), WHITE)
+    for box, colour in blocks.items():
+        image.paste(colour, box)
+    f = io.BytesIO()
+    image.save(f, format, quality=95)
+    f.seek(0)
+    return f
+
+
+class TestGetEOLCrops(unittest.TestCase):
+    maxDiff = None
+
+    def assertColour(self, image, xy, colour):
+        self.assertTrue(
+            all(abs(a - b) < 16 for a, b in zip(image.getpixel(xy), colour)),
+            "{} at {} is not {}".format(image.getpixel(xy), xy, colour))
+
+    def test_crop_box(self):
+        d = dict(width=1000, height=800, crop_x=400, crop_y=300, crop_width=200)
+        # Expanded by add_percent on each side
+        self.assertEqual(getEOL_crops.crop_box(d, 12.5, "1"), (375, 275, 250))
+        self.assertEqual(getEOL_crops.crop_box(d, 0, "1"), (400, 300, 200))
+        # ... but no further than the nearest edge
+        d.update(crop_x=10)
+        self.assertEqual(getEOL_crops.crop_box(d, 12.5, "1"), (0, 290, 220))
+        # Not expanded at all if the crop overlaps the edge
+        d.update(crop_x=900)
+        self.assertEqual(getEOL_crops.crop_box(d, 12.5, "1"), (900, 300, 200))
+        # No (valid) crop
+        self.assertEqual(getEOL_crops.crop_box(dict(d, crop_width=0), 12.5, "1"), None)
+        self.assertEqual(getEOL_crops.crop_box(dict(width=1000, height=800), 12.5, "1"), None)
+
+    def test_make_thumbnail(self):
+        f = image_file(400, 400, {(100, 100, 300, 300): RED})
+        thumbnail = getEOL_crops.make_thumbnail(f, (100, 100, 200), 150)
+        self.assertEqual(thumbnail.mode, 'RGB')
+        self.assertEqual(thumbnail.size, (150, 150))
+        for xy in [(0, 0), (75, 75), (149, 149)]:
+            self.assertColour(thumbnail, xy, RED)
+
+    def test_make_thumbnail_edge(self):
+        """As with convert -crop 150x150+150+0, a crop overlapping the edge is trimmed"""
+        f = image_file(200, 150, {(0, 0, 150, 150): RED, (150, 0, 200, 150): BLUE})
+        thumbnail = getEOL_crops.make_thumbnail(f, (150, 0, 150), 150)
+        self.assertEqual(thumbnail.size, (50, 150))
+        self.assertColour(thumbnail, (25, 75), BLUE)
+        # Then resized to fit the thumbnail size (convert -resize 150x150)
+        f.seek(0)
+        thumbnail = getEOL_crops.make_thumbnail(f, (150, 0, 100), 150)
+        self.assertEqual(thumbnail.size, (75, 150))
+        with self.assertRaises(ValueError):
+            f.seek(0)
+            getEOL_crops.make_thumbnail(f, (300, 0, 100), 150)
+
+    def test_make_thumbnail_default(self):
+        """Without a crop, the central square fills the thumbnail (convert -gravity Center -extent)"""
+        f = image_file(300, 150, {(0, 0, 75, 150): RED, (75, 0, 225, 150): GREEN, (225, 0, 300, 150): BLUE})
+        thumbnail = getEOL_crops.make_thumbnail(f, None, 100)
+        self.assertEqual(thumbnail.size, (100, 100))
+        for xy in [(2, 2), (50, 50), (97, 97)]:
+            self.assertColour(thumbnail, xy, GREEN)
+        # Small images are enlarged
+        f = image_file(60, 40, {(10, 0, 50, 40): GREEN})
+        self.assertEqual(getEOL_crops.make_thumbnail(f, None, 100).size, (100, 100))
+
+    def test_make_thumbnail_draft(self):
+        """Large jpegs are decoded at a reduced scale, keeping enough pixels for the thumbnail"""
+        f = image_file(1600, 1600, {(800, 800, 1600, 1600): BLUE}, 'JPEG')
+        drafted = []
+        draft = JpegImageFile.draft
+
+        def spy(image, mode, size):
+            result = draft(image, mode, size)
+            drafted.append(image.size)
+            return result
+        with mock.patch.object(JpegImageFile, 'draft', spy):
+            thumbnail = getEOL_crops.make_thumbnail(f, (800, 800, 800), 150)
+        self.assertEqual(len(drafted), 1)
+        self.assertLess(drafted[0][0], 1600)
+        self.assertGreaterEqual(drafted[0][0] * 800 / 1600, 150)
+        self.assertEqual(thumbnail.size, (150, 150))
+        for xy in [(2, 2), (75, 75), (147, 147)]:
+            self.assertColour(thumbnail, xy, BLUE)
+
+        # No need to reduce the scale if the crop is already small
+        f = image_file(1600, 1600, {}, 'JPEG')
+        drafted.clear()
+        with mock.patch.object(JpegImageFile, 'draft', spy):
+            getEOL_crops.make_thumbnail(f, (800, 800, 100), 150)
+        self.assertEqual(drafted, [])
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestGetEOLCrops))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
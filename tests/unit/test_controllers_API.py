@@ -132,6 +132,41 @@ class TestControllersAPI(unittest.TestCase):
             iucn_leaves[0].iucn : iucn_leaves[0].ott,
         }, 'errors': []})
 
+    def test_children_of_OTT_after(self):
+        """Paging through with a cursor should give every leaf once, in order"""
+        node = db(
+            (db.ordered_nodes.ott != None) &
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 20) &
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft < 500)
+        ).select(db.ordered_nodes.ALL, limitby=(0, 1)).first()
+        if node is None:
+            self.skipTest("No suitably sized clades in the tree")
+        for sort, orderby in (
+            ('id', db.ordered_leaves.id),
+            ('popularity', db.ordered_leaves.popularity | db.ordered_leaves.id),
+            ('POPULARITY', ~db.ordered_leaves.popularity | ~db.ordered_leaves.id),
+        ):
+            expected = db(
+                (db.ordered_leaves.id >= node.leaf_lft) &
+                (db.ordered_leaves.id <= node.leaf_rgt) &
+                (db.ordered_leaves.eol != None)
+            ).select(db.ordered_leaves.ott, orderby=orderby)
+            otts, after, pages = [], "", 0
+            while after is not None:
+                out = util.call_controller(API, 'children_of_OTT', args=[node.ott], vars=dict(
+                    after=after, max=7, sort=sort))
+                self.assertLessEqual(len(out['data']['rows']), 7)
+                otts += [r['ott'] for r in out['data']['rows']]
+                after = out['data']['next']
+                pages += 1
+            self.assertEqual(otts, [r.ott for r in expected], sort)
+            self.assertGreaterEqual(pages, len(expected) // 7)
+
+        out = util.call_controller(API, 'children_of_OTT', args=[node.ott], vars=dict(after="x", sort='popularity'))
+        self.assertEqual(out['data'], None)
+        out = util.call_controller(API, 'children_of_OTT', args=[node.ott], vars=dict(after="", sort='name'))
+        self.assertEqual(out['data'], None)
+
 
 if __name__ == '__main__':
     import sys
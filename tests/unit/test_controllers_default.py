@@ -3,6 +3,7 @@ Run with::
 
     grunt exec:test_server:test_controllers_default.py
 """
+import datetime
 import unittest
 from inspect import getmembers, isfunction, getfullargspec
 
@@ -13,6 +14,7 @@ from gluon.http import HTTP  # This is the error code
 import applications.OZtree.controllers.default as default
 from applications.OZtree.tests.unit import util
 import img
+import tree_cache
 
 def dummy(*args, **kwargs):
     "Pass-through function used e.g. to replace built-in 'redirect'"
@@ -84,6 +86,91 @@ class TestControllersDefault(unittest.TestCase):
                 else:
                     f()
 
+    def test_text_tree(self):
+        """
+        The text tree should match a walk down the real parents, 4 levels deep
+        """
+        def reference(node_id, depth):
+            out = {}
+            if depth < 4:
+                for r in db(db.ordered_nodes.real_parent == node_id).select(db.ordered_nodes.id):
+                    out[r.id] = reference(r.id, depth + 1)
+                for r in db(db.ordered_leaves.real_parent == node_id).select(db.ordered_leaves.id):
+                    out[-r.id] = None
+            return out
+
+        def as_dicts(tree):
+            return {k: (None if v is None else as_dicts(v)) for k, v in tree.items()}
+
+        default.is_testing = True
+        db = current.db
+        root = db(db.ordered_nodes.parent < 1).select(db.ordered_nodes.id).first()
+        node = db((db.ordered_nodes.real_parent == root.id) & (db.ordered_nodes.ott != None)).select(
+            db.ordered_nodes.id, db.ordered_nodes.ott, orderby=db.ordered_nodes.id).last()
+        for base_id, pinpoint_string in ((root.id, None), (node.id, str(node.ott))):
+            tt = default.text_tree(pinpoint_string)
+            self.assertEqual(list(tt['bases'].keys()), [base_id])
+            self.assertEqual(as_dicts(tt['bases'][base_id]), reference(base_id, 0))
+            for k, v in tt['bases'][base_id].items():
+                self.assertIn(k, tt['info'])
+                self.assertIn('htmlname', tt['info'][k])
+            # Nodes are listed before leaves, in descending order of id
+            keys = list(tt['bases'][base_id].keys())
+            nodes = [k for k in keys if k > 0]
+            self.assertEqual(keys[:len(nodes)], sorted(nodes, reverse=True))
+
+    def test_sponsor_node_price__precomputed(self):
+        """
+        The sponsor_leaves lists should give the same leaves, in the same order, as the live
+        queries, for each price band and page. Uses the lists made by build_sponsor_leaves.py
+        if it has been run for this tree, otherwise a small list made here.
+        """
+        db = current.db
+        version = tree_cache.tree_version(recheck=True)
+        tree_cache._precomputed.clear()
+        built = tree_cache.precomputed_table_built('sponsor_leaves') is not None
+        bands = [r.price for r in db().select(db.prices.price)] + [None]
+
+        def sponsor_node_otts(node_id, price, n, start=0, use_lists=True):
+            # Turn the lists on or off, without rechecking precomputed_tables
+            tree_cache._precomputed['sponsor_leaves'] = (
+                float('inf'), version if use_lists else None, datetime.datetime.now())
+            default.request.vars.clear()
+            default.request.vars.update(
+                id=str(node_id), price="" if price is None else str(price), n=str(n), start=str(start))
+            return default.sponsor_node_price()['otts']
+
+        try:
+            if built:
+                row = db(db.sponsor_leaves).select(db.sponsor_leaves.node_id, limitby=(0, 1)).first()
+                if row is None:
+                    self.skipTest("No nodes are large enough to have sponsor_leaves lists")
+                node_id = row.node_id
+            else:
+                node = db(
+                    (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 20) &
+                    (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft < 2000)
+                ).select(db.ordered_nodes.id, orderby=~db.ordered_nodes.id, limitby=(0, 1)).first()
+                if node is None:
+                    self.skipTest("No suitably sized clades in the tree")
+                node_id = node.id
+                # A small list for each band, as build_sponsor_leaves.py would make
+                db(db.sponsor_leaves.node_id == node_id).delete()
+                for price in bands:
+                    live = sponsor_node_otts(node_id, price, 20, use_lists=False)
+                    for pos, ott in enumerate(live[:20]):
+                        db.sponsor_leaves.insert(
+                            node_id=node_id, price=price, position=pos, leaf_ott=ott,
+                            band_size=len(live) if len(live) <= 20 else 1000000)
+            for price in bands:
+                for start in (0, 6, 12):
+                    self.assertEqual(
+                        sponsor_node_otts(node_id, price, 6, start),
+                        sponsor_node_otts(node_id, price, 6, start, use_lists=False),
+                        "price band {}, start {}".format(price, start))
+        finally:
+            tree_cache._precomputed.clear()
+
 if __name__ == '__main__':
     import sys
 
@@ -122,6 +122,41 @@ class TestNodeInfo(unittest.TestCase):
             sorted(expected_tours_by_ott, key=lambda x: x[0]),
         )
 
+    def test_nodes_info_from_string_representative_leaves(self):
+        db = current.db
+        node = db(db.ordered_nodes.rep1 > 0).select(db.ordered_nodes.ALL, limitby=(0, 1)).first()
+        rep_otts = set(node['rep%d' % i] for i in range(1, 9)) - set([None, 0])
+
+        out = self.ni([], [node.id], include_names_in="en")
+        # Only the requested node is returned, but the leaves in its representative images are too
+        self.assertEqual([x[0] for x in out['nodes']], [node.id])
+        leaf_otts = set(x[1] for x in out['leaves'])
+        self.assertEqual(
+            leaf_otts,
+            set(r.ott for r in db(db.ordered_leaves.ott.belongs(rep_otts)).select(db.ordered_leaves.ott)),
+        )
+        # Pictures only come from representative leaves
+        self.assertTrue(set(x[0] for x in out['leafPic']) <= rep_otts)
+        # Vernaculars can be for the node or its representative leaves
+        self.assertTrue(set(x[0] for x in out['vernacular_by_ott']) <= rep_otts | set([node.ott]))
+
+    def test_nodes_info_from_string_ott_details(self):
+        db = current.db
+        leaves = [db(db.ordered_leaves.ott == ott).select(db.ordered_leaves.ALL)[0] for ott in util.find_unsponsored_otts(2)]
+        db(db.ott_details.ott.belongs([l.ott for l in leaves])).delete()
+        db.ott_details.insert(ott=leaves[0].ott, lang_primary='', status_code='XX',
+            any_src=99, any_src_id=12345, any_rating=55555)
+        db.ott_details.insert(ott=leaves[0].ott, lang_primary='en', vernacular="Unit test name")
+        db.ott_details.insert(ott=leaves[1].ott, lang_primary='fr', vernacular="Nom de test")
+
+        out = self.ni([l.id for l in leaves], [], include_names_in="en-gb", use_ott_details=True)
+        self.assertEqual(out['vernacular_by_ott'], [(leaves[0].ott, "Unit test name")])
+        self.assertEqual(out['leafIucn'], [(leaves[0].ott, "XX")])
+        self.assertEqual(out['leafPic'], [(leaves[0].ott, 12345, 99, 55555)])
+        # The verified image is not set
+        out = self.ni([l.id for l in leaves], [], image_type="best_verified", use_ott_details=True)
+        self.assertEqual(out['leafPic'], [])
+
 if __name__ == '__main__':
     import sys
 
@@ -0,0 +1,87 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_api_usage.py
+"""
+import unittest
+
+import api_usage
+
+
+class TestApiUsage(unittest.TestCase):
+    maxDiff = None
+    key = "UNITTEST_0123456789abcdef0123456"
+
+    def setUp(self):
+        api_usage.api_user("")  # Make sure the key cache exists
+        api_usage._api_users.clear()
+
+    def tearDown(self):
+        db = current.db
+        api_usage.usage_counts.take()
+        api_usage._api_users.clear()
+        db.rollback()
+        db(db.API_users.APIkey == self.key).delete()
+        db(db.API_use.APIkey == self.key).delete()
+        db.commit()
+
+    def test_api_user(self):
+        db = current.db
+        self.assertEqual(api_usage.api_user(self.key), None)
+        db.API_users.insert(APIkey=self.key, API_user_name="Unit test", max_taxa_per_query=10, max_returns_per_taxon=2)
+        # Unrecognised key is cached
+        self.assertEqual(api_usage.api_user(self.key), None)
+        api_usage._api_users.clear()
+        user = api_usage.api_user(self.key)
+        self.assertEqual(user['max_taxa_per_query'], 10)
+        self.assertEqual(user['max_returns_per_taxon'], 2)
+        self.assertEqual(user['API_user_name'], "Unit test")
+
+        # Deactivated keys are noticed once the cached details expire
+        db(db.API_users.APIkey == self.key).update(max_taxa_per_query=None)
+        self.assertEqual(api_usage.api_user(self.key)['max_taxa_per_query'], 10)
+        api_usage._api_users.clear()
+        self.assertEqual(api_usage.api_user(self.key)['max_taxa_per_query'], None)
+
+    def test_record_usage(self):
+        db = current.db
+        api_usage.usage_counts.add((self.key, "popularity/list"), [1, 5, 10])
+        api_usage.usage_counts.add((self.key, "popularity/list"), [1, 2, 3])
+        api_usage.flush_usage(force=True)
+        row = db(db.API_use.APIkey == self.key).select().first()
+        self.assertEqual((row.API, row.n_calls, row.n_taxa, row.n_returns), ("popularity/list", 2, 7, 13))
+        self.assertEqual(row.end_date, None)
+
+        # Added to the existing row
+        api_usage.record_usage(self.key, "popularity/list", 1, 1)
+        api_usage.flush_usage(force=True)
+        rows = db(db.API_use.APIkey == self.key).select()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0].n_calls, rows[0].n_taxa, rows[0].n_returns), (3, 8, 14))
+
+    def test_flush_at_exit(self):
+        """Buffered usage is written when the worker exits, using its own connection"""
+        import buffered_counts
+        db = current.db
+        api_usage.flush_usage()  # Note how to connect, as a request would
+        api_usage.usage_counts.add((self.key, "popularity/list"), [1, 5, 10])
+        try:
+            buffered_counts._flush_all_at_exit()
+        finally:
+            current.db = db
+        self.assertEqual(len(api_usage.usage_counts), 0)
+        db.commit()  # Start a new transaction, to see the rows written
+        row = db(db.API_use.APIkey == self.key).select().first()
+        self.assertEqual((row.n_calls, row.n_taxa, row.n_returns), (1, 5, 10))
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestApiUsage))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -0,0 +1,114 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_buffered_counts.py
+"""
+import unittest
+
+import buffered_counts
+from buffered_counts import CountBuffer
+
+
+class TestBufferedCounts(unittest.TestCase):
+    maxDiff = None
+
+    def tearDown(self):
+        buffered_counts.visit_counts.take()
+        db.rollback()
+
+    def test_count_buffer(self):
+        b = CountBuffer(2)
+        self.assertFalse(b.flush_due(0, 10))
+        b.add(5, [1, 0])
+        b.add(3, [0, 1])
+        b.add(5, [2, 1])
+        self.assertEqual(b.get(5), (3, 1))
+        self.assertEqual(b.get(99), (0, 0))
+        self.assertTrue(b.flush_due(0, 10))
+        self.assertFalse(b.flush_due(1000, 10))
+        self.assertTrue(b.flush_due(1000, 2))
+
+        written = []
+        self.assertEqual(b.flush(written.append, batch_size=1), 2)
+        self.assertEqual(written, [[(3, [0, 1])], [(5, [3, 1])]])
+        self.assertEqual(len(b), 0)
+        self.assertFalse(b.flush_due(0, 10))
+
+    def test_count_buffer_failed_flush(self):
+        b = CountBuffer(1)
+        b.add(1, [1])
+        b.add(2, [1])
+
+        def fail(items):
+            raise IOError("Database unavailable")
+        with self.assertRaises(IOError):
+            b.flush(fail)
+        b.add(1, [1])
+        self.assertEqual(b.take(), [(1, [2]), (2, [1])])
+
+    def test_count_buffer_max_keys(self):
+        """Counts for new keys are dropped once the buffer is full, e.g. if writes fail"""
+        b = CountBuffer(1, max_keys=2)
+        b.add(1, [1])
+        b.add(2, [1])
+        with self.assertLogs(buffered_counts.logger, level='WARNING'):
+            b.add(3, [1])
+        b.add(1, [1])  # Existing keys are still counted
+        b.restore([(4, [1])])
+        self.assertEqual(b.take(), [(1, [2]), (2, [1])])
+        b.add(3, [1])
+        self.assertEqual(b.take(), [(3, [1])])
+
+    def test_flush_at_exit(self):
+        """Buffered counts are written by the worker when it exits, using its own connection"""
+        db = current.db
+        ott = 999999999  # Unlikely to be a real ott
+        db(db.visit_count.ott == ott).delete()
+        db.commit()
+        buffered_counts.flush_visits()  # Note how to connect, as a request would
+        buffered_counts.record_visits(api_hits=str(ott), leaf_clicks=str(ott))
+        try:
+            buffered_counts._flush_all_at_exit()
+        finally:
+            current.db = db
+        self.assertEqual(len(buffered_counts.visit_counts), 0)
+        db.commit()  # Start a new transaction, to see the rows written
+        row = db(db.visit_count.ott == ott).select().first()
+        self.assertEqual(
+            (row.detail_fetch_count, row.search_count, row.leaf_click_count),
+            (1, 0, 1))
+        db(db.visit_count.ott == ott).delete()
+        db.commit()
+
+    def test_record_visits(self):
+        db = current.db
+        ott = 999999999  # Unlikely to be a real ott
+        db(db.visit_count.ott == ott).delete()
+        buffered_counts.record_visits(api_hits="%d,%d" % (ott, ott), leaf_clicks=str(ott))
+        self.assertEqual(buffered_counts.visit_counts.get(ott), (2, 0, 1))
+        with self.assertRaises(ValueError):
+            buffered_counts.record_visits(search_hits="%d,1); DROP TABLE visit_count; --" % ott)
+        self.assertEqual(buffered_counts.visit_counts.get(ott), (2, 0, 1))
+
+        # Written in one go, and added to existing counts
+        buffered_counts.flush_visits(force=True)
+        buffered_counts.record_visits(api_hits=str(ott), search_hits=str(ott))
+        buffered_counts.flush_visits(force=True)
+        row = db(db.visit_count.ott == ott).select().first()
+        self.assertEqual(
+            (row.detail_fetch_count, row.search_count, row.leaf_click_count),
+            (3, 1, 1))
+        db(db.visit_count.ott == ott).delete()
+        db.commit()
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBufferedCounts))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -0,0 +1,98 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_popularity_index.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import datetime
+
+import popularity_index
+import tree_cache
+import tree_snapshots
+import tree_topology
+
+
+class TestPopularityIndex(unittest.TestCase):
+    maxDiff = None
+
+    def tearDown(self):
+        db.rollback()
+        tree_cache._precomputed.clear()
+
+    def test_merge_intervals(self):
+        self.assertEqual(popularity_index.merge_intervals([]), [])
+        self.assertEqual(
+            popularity_index.merge_intervals([(5, 9), (1, 2), (6, 6), (3, 3), (11, 20), (12, 30)]),
+            [(1, 3), (5, 9), (11, 30)])
+
+    def test_most_popular(self):
+        """Should give the same leaves as sorting in the database"""
+        for index in (popularity_index.PopularityIndex(), popularity_index.PopularityIndex(tree_topology.get())):
+            self.check_most_popular(index)
+
+    def test_snapshot(self):
+        """The index is only read from a snapshot, which gives the same answers"""
+        path = tempfile.mkdtemp()
+        try:
+            size = tree_snapshots.tree_size()
+            popularity_index.PopularityIndex().save(path, size)
+            self.check_most_popular(popularity_index.PopularityIndex.load(path, size))
+            with self.assertRaises(ValueError):
+                popularity_index.PopularityIndex.load(path, [size[0], size[1] + 1])
+        finally:
+            shutil.rmtree(path)
+
+    def check_most_popular(self, index):
+        nodes = db(db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 10).select(
+            db.ordered_nodes.leaf_lft, db.ordered_nodes.leaf_rgt,
+            orderby=~db.ordered_nodes.id, limitby=(0, 5))
+        intervals = popularity_index.merge_intervals([(r.leaf_lft, r.leaf_rgt) for r in nodes])
+        expected = db.executesql(
+            "SELECT id FROM ordered_leaves WHERE " +
+            " OR ".join("(id BETWEEN {:d} AND {:d})".format(lft, rgt) for lft, rgt in intervals) +
+            " ORDER BY popularity DESC, ott LIMIT 20")
+        self.assertEqual(index.most_popular(intervals, 20), [r[0] for r in expected])
+        self.assertEqual(index.most_popular([], 20), [])
+
+    def test_precomputed_most_popular(self):
+        """Lists in the popular_leaves table are used, but only for the tree they were built for"""
+        node = db(db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 10).select(
+            db.ordered_nodes.ALL, orderby=~db.ordered_nodes.id, limitby=(0, 1)).first()
+        if node is None:
+            self.skipTest("No suitably sized clades in the tree")
+        version = tree_cache.tree_version(recheck=True)
+        nodes = {node.id: (node.leaf_lft, node.leaf_rgt)}
+        expected = [r[0] for r in db.executesql(
+            "SELECT id FROM ordered_leaves WHERE id BETWEEN {0} AND {0} ORDER BY popularity DESC, ott LIMIT 5".format(
+                db.placeholder), (node.leaf_lft, node.leaf_rgt))]
+        # A small table, as build_popular_leaves.py would make
+        db(db.popular_leaves.node_id == node.id).delete()
+        for pos, leaf_id in enumerate(expected):
+            db.popular_leaves.insert(node_id=node.id, position=pos, leaf_id=leaf_id)
+        db(db.precomputed_tables.name == 'popular_leaves').delete()
+        db.precomputed_tables.insert(name='popular_leaves', tree_version=version, built=datetime.datetime.now())
+        tree_cache._precomputed.clear()
+        self.assertEqual(popularity_index.precomputed_most_popular(nodes, 5), {node.id: expected})
+        # Nodes without a long enough list, or whose list doesn't match the tree, are ignored
+        self.assertEqual(popularity_index.precomputed_most_popular(nodes, 6), {})
+        self.assertEqual(popularity_index.precomputed_most_popular({node.id: (0, 0)}, 5), {})
+        # The table is ignored if it was built for another tree
+        db(db.precomputed_tables.name == 'popular_leaves').update(tree_version=version + 1)
+        tree_cache._precomputed.clear()
+        self.assertEqual(popularity_index.precomputed_most_popular(nodes, 5), {})
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestPopularityIndex))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -0,0 +1,90 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_search_index.py
+"""
+import shutil
+import tempfile
+import unittest
+
+from search_index import PackedStrings, TopHits, WordPrefixIndex, word_matches, _load_arrays, _save_arrays
+
+
+class TestSearchIndex(unittest.TestCase):
+    maxDiff = None
+
+    def test_word_matches(self):
+        self.assertTrue(word_matches("Homo sapiens", "sap"))
+        self.assertTrue(word_matches("Homo sapiens", "h"))
+        self.assertFalse(word_matches("Homo sapiens", "omo"))
+        self.assertTrue(word_matches("Great (crested) grebe", "cr"))
+        self.assertTrue(word_matches("大熊猫", "熊", logographic=True))
+
+    def test_prefix_index(self):
+        names = ["Homo sapiens", "Homo erectus", "Hominidae", "Ox", "Oxalis", "", "Box tree", "Sapindus"]
+        index = WordPrefixIndex(names)
+        self.assertEqual(index.matching(["homo"]), {0, 1})
+        self.assertEqual(index.matching(["hom"]), {0, 1, 2})
+        self.assertEqual(index.matching(["ox"]), {3, 4})
+        self.assertEqual(index.matching(["sap"]), {0, 7})
+        self.assertEqual(index.matching(["sap", "h"]), {0})
+        self.assertEqual(index.matching(["tree", "b"]), {6})
+        self.assertEqual(index.matching(["x"]), set())
+        # Longer than the sorted key length
+        self.assertEqual(index.matching(["sapiensxxxxxxxxxxx"]), set())
+        self.assertEqual(index.matching(["sapiensxxxxxxxxxxxxxxxxxxxxxxx"]), set())
+
+    def test_prefix_index_unicode(self):
+        names = ["Grand émeu", "Émeu", "大熊猫", "熊"]
+        index = WordPrefixIndex(names)
+        self.assertEqual(index.matching(["ém"]), {0, 1})
+        self.assertEqual(index.matching(["grand", "émeu"]), {0})
+        index = WordPrefixIndex(names, logographic=True)
+        self.assertEqual(index.matching(["熊"]), {2, 3})
+        self.assertEqual(index.matching(["熊猫"]), {2})
+
+    def test_top_by_prefix(self):
+        names = ["Aa", "Ab", "Ba", "Ab ac"]
+        popularity = [1.0, 3.0, 2.0, 0.5]
+        index = WordPrefixIndex(names)
+        top = index.top_by_prefix(lambda r: [(popularity[r], r)], n_hits=2)
+        self.assertEqual(top['a'], [(3.0, 1), (1.0, 0)])
+        self.assertEqual(top['ab'], [(3.0, 1), (0.5, 3)])
+        self.assertEqual(top['ac'], [(0.5, 3)])
+        hits = TopHits(top)
+        self.assertEqual(hits.get('ab'), top['ab'])
+        self.assertEqual(hits.get('b'), top['b'])
+        self.assertEqual(hits.get('x', []), [])
+
+    def test_snapshot(self):
+        """Indexes can be saved, and memory-mapped again"""
+        names = ["Homo sapiens", "Émeu", "", "Ox"]
+        strings = PackedStrings.from_list(names)
+        index = WordPrefixIndex(names)
+        hits = TopHits(index.top_by_prefix(lambda r: [(float(r), r)]))
+        path = tempfile.mkdtemp()
+        try:
+            _save_arrays(path, dict(strings.arrays("names"), **index.arrays(), **hits.arrays()))
+            arrays = _load_arrays(path, dict(
+                PackedStrings.typecodes("names"), **WordPrefixIndex.typecodes(), **TopHits.typecodes()))
+            loaded_strings = PackedStrings.from_arrays(arrays, "names")
+            self.assertEqual(list(loaded_strings), names)
+            loaded = WordPrefixIndex(loaded_strings, arrays=arrays)
+            self.assertEqual(loaded.matching(["é"]), {1})
+            self.assertEqual(loaded.matching(["homo", "s"]), {0})
+            self.assertEqual(TopHits(arrays=arrays).get('o'), [(3.0, 3)])
+            del loaded, loaded_strings, arrays
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSearchIndex))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
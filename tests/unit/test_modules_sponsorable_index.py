@@ -0,0 +1,66 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_sponsorable_index.py
+"""
+import unittest
+
+import sponsorable_index
+import tree_cache
+from sponsorship import sponsorable_children_query
+
+
+class TestSponsorableIndex(unittest.TestCase):
+    maxDiff = None
+
+    def tearDown(self):
+        db.rollback()
+
+    def test_page(self):
+        """Should list the same leaves as sorting by name in the database"""
+        if not tree_cache.tree_cache_config()['snapshot_dir']:
+            self.skipTest("tree_cache.snapshot_dir is turned off")
+        index = sponsorable_index.build_snapshot(tree_cache.tree_version(recheck=True))
+        self.assertIsNotNone(index)
+        unavailable = sponsorable_index.sponsored_otts()
+        # The root (walked through in name order), and a smaller clade (sorted)
+        small = db(
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 20) &
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft < 200)
+        ).select(db.ordered_nodes.ALL, limitby=(0, 1)).first()
+        for node in (db.ordered_nodes[1], small):
+            if node is None:
+                continue
+            expected = db(sponsorable_children_query(node.id, qtype="id")).select(
+                db.ordered_leaves.id, orderby=db.ordered_leaves.name | db.ordered_leaves.id, limitby=(0, 30))
+            expected = [r.id for r in expected]
+            leaves = index.page(node.leaf_lft, node.leaf_rgt, 20, unavailable=unavailable)
+            self.assertEqual([id for pos, id in leaves], expected[:20])
+            # Following pages, by number and from the last position
+            self.assertEqual(
+                [id for pos, id in index.page(node.leaf_lft, node.leaf_rgt, 10, skip=10, unavailable=unavailable)],
+                expected[10:20])
+            if leaves:
+                self.assertEqual(
+                    [id for pos, id in index.page(
+                        node.leaf_lft, node.leaf_rgt, 10, after=leaves[-1][0], unavailable=unavailable)],
+                    expected[20:30])
+
+    def test_sponsored_otts(self):
+        otts = sponsorable_index.sponsored_otts()
+        self.assertEqual(list(otts), sorted(otts))
+        expected = db(db.reservations.verified_time != None).select(
+            db.reservations.OTT_ID, distinct=True)
+        self.assertEqual(set(otts), set(r.OTT_ID for r in expected if r.OTT_ID is not None))
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSponsorableIndex))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
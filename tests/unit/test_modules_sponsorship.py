@@ -14,6 +14,8 @@ from applications.OZtree.tests.unit import util
 
 from gluon.globals import Request
 
+import tree_cache
+
 from sponsorship import (
     get_reservation,
     clear_reservation,
@@ -24,12 +26,17 @@ from sponsorship import (
     reservation_confirm_payment,
     reservation_get_all_expired,
     reservation_expire,
+    reservation_expire_all,
     sponsor_hmac_key,
     sponsor_verify_url,
     sponsorship_email_reminders,
     sponsorship_email_reminders_post,
     sponsorship_restrict_contact,
     sponsor_renew_request_logic,
+    sponsorable_children_query,
+    precomputed_sponsorable_children,
+    sponsorship_get_leaf_status,
+    sponsorship_get_leaf_statuses,
 )
 
 
@@ -94,6 +101,16 @@ class TestMaintenance(unittest.TestCase):
         self.assertEqual(param, None)
         self.assertEqual(self.total, db(db.reservations).count())
 
+    def test_maintenance_leaf_statuses(self):
+        "Statuses looked up together match those looked up one at a time"
+        banned_ott = db(db.banned.ott != None).select(db.banned.ott, limitby=(0, 1)).first().ott
+        otts = self.otts + [banned_ott, -1000]
+        statuses = sponsorship_get_leaf_statuses(otts, batch_size=2)
+        self.assertEqual(statuses, {ott: sponsorship_get_leaf_status(ott)[0] for ott in otts})
+        self.assertEqual(statuses[self.otts[0]], 'maintenance')
+        self.assertEqual(statuses[banned_ott], 'banned')
+        self.assertEqual(statuses[-1000], 'invalid')
+
     def test_maintenance_invalid(self):
         "Invalid leaves return invalid even if in maintenance mode"
         status, param, _, _ = get_reservation(-1000, form_reservation_code="UT::001")
@@ -169,6 +186,43 @@ class TestSponsorship(unittest.TestCase):
         auth.add_membership(role="ut::candlestickmaker", user_id=user.id)
         self.assertEqual(sponsorship_enabled(), True)
 
+    def test_precomputed_sponsorable_children(self):
+        """Listed leaves are returned in order, skipping sponsored ones, but only for the current tree"""
+        node = db(
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 20) &
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft < 2000)
+        ).select(db.ordered_nodes.ALL, orderby=~db.ordered_nodes.id, limitby=(0, 1)).first()
+        if node is None:
+            self.skipTest("No suitably sized clades in the tree")
+        query = sponsorable_children_query(node.id, qtype="id")
+        price = db(query).select(db.ordered_leaves.price, limitby=(0, 1)).first().price
+        leaves = db(query & (db.ordered_leaves.price == price)).select(
+            db.ordered_leaves.ott, db.ordered_leaves.name, orderby=db.ordered_leaves.ott, limitby=(0, 6))
+        expected = [(r.ott, r.name) for r in leaves]
+        if len(expected) < 3:
+            self.skipTest("Too few sponsorable leaves in one price band")
+        # A small (complete) list, as build_sponsor_leaves.py would make
+        version = tree_cache.tree_version(recheck=True)
+        db(db.sponsor_leaves.node_id == node.id).delete()
+        for pos, (ott, name) in enumerate(expected):
+            db.sponsor_leaves.insert(node_id=node.id, price=price, position=pos, leaf_ott=ott, band_size=len(expected))
+        db(db.precomputed_tables.name == 'sponsor_leaves').delete()
+        db.precomputed_tables.insert(name='sponsor_leaves', tree_version=version, built=datetime.datetime.now())
+        tree_cache._precomputed.clear()
+        try:
+            self.assertEqual(precomputed_sponsorable_children(node.id, "id", price, 5), expected[:5])
+
+            util.purchase_reservation([expected[0][0]], payment_amount=float('inf'))
+            self.assertEqual(precomputed_sponsorable_children(node.id, "id", price, 5), expected[1:6])
+            # Nodes without lists are looked up in the database
+            self.assertEqual(precomputed_sponsorable_children(-1, "id", price, 5), None)
+            # As is everything, if the table was built for another tree
+            db(db.precomputed_tables.name == 'sponsor_leaves').update(tree_version=version + 1)
+            tree_cache._precomputed.clear()
+            self.assertEqual(precomputed_sponsorable_children(node.id, "id", price, 5), None)
+        finally:
+            tree_cache._precomputed.clear()
+
     def test_reservation_total_counts(self):
         """Can count for the home page"""
         # Purchase an OTT ages ago, which will expire, then 2 new ones
@@ -265,6 +319,17 @@ class TestSponsorship(unittest.TestCase):
         self.assertEqual(status, 'available')
         self.assertEqual(param, None)
 
+    def test_get_reservation__content_stamp(self):
+        """Reserving a leaf doesn't change the sponsorship totals, so shouldn't invalidate them"""
+        util.set_allow_sponsorship(1)
+        before = tree_cache.content_stamp('reservations')
+        ott = util.find_unsponsored_ott()
+        status, _, reservation_row, _ = get_reservation(ott, form_reservation_code="UT::001")
+        self.assertEqual(status, 'available')
+        status, _, reservation_row, _ = get_reservation(ott, form_reservation_code="UT::001", update_view_count=True)
+        self.assertEqual(status, 'available only to user')
+        self.assertEqual(tree_cache.content_stamp('reservations'), before)
+
     def test_get_reservation__slow(self):
         """Slow payments have their own status"""
         util.set_allow_sponsorship(1)
@@ -1159,6 +1224,42 @@ class TestSponsorship(unittest.TestCase):
         reservation_expire(rows[1])
         self.assertEqual([r.OTT_ID for r in gae()], [])
 
+    def test_reservation_expire_all(self):
+        """Expiring in bulk moves the same rows as expiring one at a time"""
+        otts = util.find_unsponsored_otts(3)
+        rows = util.purchase_reservation(otts[0:2], basket_details=dict(
+            e_mail='betty@unittest.example.com',
+            user_sponsor_name="Betty",
+        ))
+        current.request.now = current.request.now + datetime.timedelta(days=10)
+        util.purchase_reservation(otts[2:3], basket_details=dict(
+            e_mail='betty@unittest.example.com',
+            user_sponsor_name="Betty",
+        ))
+        views = {r.OTT_ID: r.num_views for r in db(db.reservations.OTT_ID.belongs(otts)).select()}
+
+        # 4 years later, the first two have expired, but not the last
+        current.request.now = current.request.now + datetime.timedelta(days=365*4+1-5)
+        expired_otts = reservation_expire_all(batch_size=1)
+        self.assertIn(otts[0], expired_otts)
+        self.assertIn(otts[1], expired_otts)
+        self.assertNotIn(otts[2], expired_otts)
+        self.assertEqual([r.OTT_ID for r in reservation_get_all_expired()], [])
+
+        # Moved into expired_reservations, with view counts kept in reservations
+        for r in rows:
+            expired = db(db.expired_reservations.OTT_ID == r.OTT_ID).select(
+                orderby=~db.expired_reservations.id).first()
+            self.assertEqual(expired.e_mail, 'betty@unittest.example.com')
+            self.assertEqual(expired.user_sponsor_name, 'Betty')
+            self.assertEqual(expired.verified_time, r.verified_time)
+            row = db(db.reservations.OTT_ID == r.OTT_ID).select().first()
+            self.assertEqual(row.verified_time, None)
+            self.assertEqual(row.e_mail, None)
+            self.assertEqual(row.num_views, views[r.OTT_ID])
+        row = db(db.reservations.OTT_ID == otts[2]).select().first()
+        self.assertEqual(row.e_mail, 'betty@unittest.example.com')
+
     def test_reservation_expire__keep_views(self):
         """Expiring a reservation keeps view counts"""
         ott = util.find_unsponsored_ott()
@@ -0,0 +1,166 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_tree_cache.py
+"""
+import datetime
+import os
+import unittest
+
+import tree_cache
+from OZfunc import nodes_info_from_string
+
+
+class TestTreeCache(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.orig_version = dict(tree_cache._version)
+
+    def tearDown(self):
+        tree_cache._version.update(self.orig_version)
+        db.rollback()
+
+    def test_lru(self):
+        c = tree_cache.LRUCache(3)
+        for i in range(3):
+            c.set(i, str(i))
+        self.assertEqual(c.get(0), "0")  # Now 1 is the least recently used
+        c.set(3, "3")
+        self.assertEqual(len(c), 3)
+        self.assertEqual(c.get(1), None)
+        self.assertEqual([c.get(i) for i in (0, 2, 3)], ["0", "2", "3"])
+
+        c = tree_cache.LRUCache(3, max_age=-1)
+        c.set(0, "0")
+        self.assertEqual(c.get(0, "missing"), "missing")
+
+    def test_version_change_invalidates(self):
+        c = tree_cache.TreeVersionedCache(10)
+        tree_cache._version.update(value=1, checked_at=float('inf'))
+        self.assertEqual(c.get_or_set("a", lambda: "v1"), "v1")
+        self.assertEqual(c.get_or_set("a", lambda: "new"), "v1")
+        tree_cache._version.update(value=2, checked_at=float('inf'))
+        self.assertEqual(c.get_or_set("a", lambda: "v2"), "v2")
+        # No valid tree: don't cache anything
+        tree_cache._version.update(value=None, checked_at=float('inf'))
+        self.assertEqual(c.get_or_set("a", lambda: "v3"), "v3")
+        self.assertEqual(c.get_or_set("a", lambda: "v4"), "v4")
+
+    def test_precomputed_table_built(self):
+        db = current.db
+        db(db.precomputed_tables.name == 'ott_details').delete()
+        tree_cache._version.update(value=1, checked_at=float('inf'))
+        tree_cache._precomputed.clear()
+        self.assertEqual(tree_cache.precomputed_table_built('ott_details'), None)
+        self.assertEqual(tree_cache.ott_details_available(), False)
+
+        # Built for this tree: used, but only once rechecked
+        built = datetime.datetime.now().replace(microsecond=0)
+        db.precomputed_tables.insert(name='ott_details', tree_version=1, built=built)
+        self.assertEqual(tree_cache.precomputed_table_built('ott_details'), None)
+        tree_cache._precomputed.clear()
+        self.assertEqual(tree_cache.precomputed_table_built('ott_details'), built)
+        self.assertEqual(tree_cache.ott_details_available(), True)
+
+        # Not used for another tree
+        tree_cache._version.update(value=2, checked_at=float('inf'))
+        self.assertEqual(tree_cache.precomputed_table_built('ott_details'), None)
+        self.assertEqual(tree_cache.ott_details_available(), False)
+
+        # Not used if too old
+        tree_cache._version.update(value=1, checked_at=float('inf'))
+        db(db.precomputed_tables.name == 'ott_details').update(built=built - datetime.timedelta(days=1000))
+        tree_cache._precomputed.clear()
+        self.assertEqual(tree_cache.ott_details_available(), False)
+        tree_cache._precomputed.clear()
+
+    def test_reset(self):
+        """After a reset, the version is looked up in the database again"""
+        version = tree_cache.tree_version(recheck=True)
+        tree_cache._version.update(value=-1, checked_at=float('inf'))
+        self.assertEqual(tree_cache.tree_version(), -1)
+        tree_cache.reset()
+        self.assertEqual(tree_cache.tree_version(), version)
+
+    def test_node_details(self):
+        tree_cache.tree_version(recheck=True)
+        db = current.db
+        nodes = [r.id for r in db(db.ordered_nodes.id > 1).select(db.ordered_nodes.id, limitby=(0, 5))]
+        leaves = [r.id for r in db(db.ordered_leaves.id > 0).select(db.ordered_leaves.id, limitby=(0, 5))]
+        ids = (",".join(str(i) for i in leaves), ",".join(str(i) for i in nodes))
+        expected = nodes_info_from_string(*ids, include_names_in="en-gb,en")
+        self.assertEqual(tree_cache.node_details(*ids, include_names_in="en-gb,en"), expected)
+        # Cached version, requested with ids in a different order & a different language string
+        ids = (",".join(str(i) for i in reversed(leaves)), ",".join(str(i) for i in nodes))
+        out = tree_cache.node_details(*ids, include_names_in="en-us")
+        self.assertEqual(out['lang'], "en-us")
+        self.assertEqual(dict(out, lang="en-gb,en"), expected)
+        with self.assertRaises(ValueError):
+            tree_cache.node_details("1,,2", "")
+
+    def test_node_details_exclude_rep_otts(self):
+        tree_cache.tree_version(recheck=True)
+        db = current.db
+        node = db(db.ordered_nodes.rep1 > 0).select(db.ordered_nodes.ALL, limitby=(0, 1)).first()
+        rep_otts = set(node['rep%d' % i] for i in range(1, 9)) - set([None, 0])
+        exclude = ",".join(str(o) for o in sorted(rep_otts))
+        tree_cache._node_details_cache and tree_cache._node_details_cache.clear()
+
+        # Not cached: excluded in the database lookup
+        out = tree_cache.node_details("", str(node.id), include_names_in="en", exclude_rep_otts=exclude)
+        self.assertEqual(out['leaves'], [])
+        self.assertEqual(out['leafPic'], [])
+        full = tree_cache.node_details("", str(node.id), include_names_in="en")
+        self.assertNotEqual(full['leaves'], [])
+        # Cached: filtered from the cached response, with the same result
+        self.assertEqual(
+            tree_cache.node_details("", str(node.id), include_names_in="en", exclude_rep_otts=exclude),
+            out)
+        # Explicitly requested leaves are still returned
+        leaf = db(db.ordered_leaves.ott == min(rep_otts)).select(db.ordered_leaves.id).first()
+        if leaf:
+            out = tree_cache.node_details(str(leaf.id), str(node.id), exclude_rep_otts=exclude)
+            self.assertEqual([r[0] for r in out['leaves']], [leaf.id])
+
+    def test_homepage_block(self):
+        tree_cache._version.update(value=1, checked_at=float('inf'))
+        stamp = "test_homepage_block"
+        path = tree_cache._content_stamp_path(stamp)
+        settle_secs = tree_cache.content_settle_secs
+        try:
+            self.assertEqual(tree_cache.homepage_block("test", lambda: "v1", stamps=(stamp, )), "v1")
+            self.assertEqual(tree_cache.homepage_block("test", lambda: "new", stamps=(stamp, )), "v1")
+            # Not cached until the change has had time to be committed
+            tree_cache.content_changed(stamp)
+            self.assertEqual(tree_cache.homepage_block("test", lambda: "v2", stamps=(stamp, )), "v2")
+            self.assertEqual(tree_cache.homepage_block("test", lambda: "v3", stamps=(stamp, )), "v3")
+            tree_cache.content_settle_secs = 0
+            self.assertEqual(tree_cache.homepage_block("test", lambda: "v4", stamps=(stamp, )), "v4")
+            self.assertEqual(tree_cache.homepage_block("test", lambda: "new", stamps=(stamp, )), "v4")
+        finally:
+            tree_cache.content_settle_secs = settle_secs
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_watch_table(self):
+        """Changes to the news through the DAL should change its content stamp"""
+        before = tree_cache.content_stamp('news')
+        db.news.insert(news_date=current.request.now, html_description="test_watch_table")
+        self.assertGreater(tree_cache.content_stamp('news'), before)
+        before = tree_cache.content_stamp('reservations')
+        # Reservations only count when they affect the sponsorship totals
+        db(db.reservations.id < 0).update(reserve_time=current.request.now)
+        self.assertEqual(tree_cache.content_stamp('reservations'), before)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTreeCache))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
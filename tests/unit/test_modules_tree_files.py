@@ -0,0 +1,91 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_tree_files.py
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from gluon import current
+from gluon.globals import Request
+from gluon.http import HTTP
+
+import tree_files
+
+
+class TestTreeFiles(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = b"var rawData = '(()())';"
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        with open(os.path.join(self.folder, "completetree_1.js"), "wb") as f:
+            f.write(self.data)
+        with open(os.path.join(self.folder, "completetree_1.js.gz"), "wb") as f:
+            f.write(gzip.compress(self.data))
+        with open(os.path.join(self.folder, "tree_files_1.json"), "wt") as f:
+            json.dump(dict(version=1, files={"completetree_1.js": dict(
+                sha256=self.sha256, size=len(self.data), encodings=dict(
+                    gzip=dict(file="completetree_1.js.gz", size=0)))}), f)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def serve(self, filename, **env):
+        current.request = Request(dict())
+        for k, v in env.items():
+            current.request.env[k] = v
+        with self.assertRaises(HTTP) as cm:
+            tree_files.serve(filename, self.folder)
+        return cm.exception
+
+    def test_choose_encoding(self):
+        self.assertEqual(tree_files.choose_encoding("gzip, deflate, br", ("gzip", "br")), "br")
+        self.assertEqual(tree_files.choose_encoding("gzip, deflate, br", ("gzip", )), "gzip")
+        self.assertEqual(tree_files.choose_encoding("br;q=0, gzip;q=0.5", ("gzip", "br")), "gzip")
+        self.assertEqual(tree_files.choose_encoding("*", ("gzip", )), "gzip")
+        self.assertEqual(tree_files.choose_encoding("", ("gzip", "br")), None)
+        self.assertEqual(tree_files.choose_encoding(None, ("gzip", "br")), None)
+
+    def test_manifest(self):
+        self.assertEqual(tree_files.manifest(1, self.folder)['files']['completetree_1.js']['sha256'], self.sha256)
+        self.assertEqual(tree_files.manifest(2, self.folder), None)
+
+    def test_hashed_names(self):
+        self.assertEqual(tree_files.hashed_names(1, self.folder), {"completetree_1.js": self.sha256[:16]})
+        self.assertEqual(tree_files.hashed_names(2, self.folder), {})
+
+    def test_serve(self):
+        out = self.serve("completetree_1.js", http_accept_encoding="gzip")
+        self.assertEqual(out.status, 200)
+        self.assertEqual(current.response.headers['Content-Encoding'], "gzip")
+        self.assertEqual(current.response.headers['ETag'], '"{}-gzip"'.format(self.sha256))
+        self.assertIn("immutable", current.response.headers['Cache-Control'])
+
+        out = self.serve("completetree_1.js", http_accept_encoding="gzip", http_if_none_match='"{}-gzip"'.format(self.sha256))
+        self.assertEqual(out.status, 304)
+        # A different encoding is a different representation
+        out = self.serve("completetree_1.js", http_if_none_match='"{}-gzip"'.format(self.sha256))
+        self.assertEqual(out.status, 200)
+
+        self.assertEqual(self.serve("completetree_2.js").status, 404)
+        self.assertEqual(self.serve("tree_files_1.json").status, 404)
+        self.assertEqual(self.serve("../completetree_1.js").status, 404)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTreeFiles))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
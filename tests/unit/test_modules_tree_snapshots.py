@@ -0,0 +1,95 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_tree_snapshots.py
+"""
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import tree_snapshots
+
+
+class TestTreeSnapshots(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.orig_snapshot_path = tree_snapshots.snapshot_path
+        tree_snapshots.snapshot_path = lambda kind, version: os.path.join(self.dir, "{}_{}".format(kind, version))
+        self.saved = 0
+
+    def tearDown(self):
+        tree_snapshots.snapshot_path = self.orig_snapshot_path
+        shutil.rmtree(self.dir)
+
+    def save(self, path):
+        self.saved += 1
+        with open(os.path.join(path, "value"), "w") as f:
+            f.write("built {}".format(self.saved))
+
+    def loader(self, path):
+        with open(os.path.join(path, "value")) as f:
+            value = f.read()
+        if value == "other tree":
+            raise ValueError("Snapshot of another tree")
+        return value
+
+    def test_build(self):
+        self.assertEqual(tree_snapshots.load("test", 1, self.loader), None)
+        self.assertEqual(tree_snapshots.build("test", 1, self.save, self.loader), "built 1")
+        self.assertEqual(tree_snapshots.load("test", 1, self.loader), "built 1")
+        # A snapshot which loads is never replaced
+        self.assertEqual(tree_snapshots.build("test", 1, self.save, self.loader), "built 1")
+        self.assertEqual(self.saved, 1)
+        # One which doesn't is
+        with open(os.path.join(self.dir, "test_1", "value"), "w") as f:
+            f.write("other tree")
+        self.assertEqual(tree_snapshots.load("test", 1, self.loader), None)
+        self.assertEqual(tree_snapshots.build("test", 1, self.save, self.loader), "built 2")
+        self.assertEqual(sorted(os.listdir(self.dir)), [".test_1.lock", "test_1"])
+
+    def test_build_locked(self):
+        """Don't wait for, or duplicate, a build by another process"""
+        with open(os.path.join(self.dir, ".test_1.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertEqual(tree_snapshots.build("test", 1, self.save, self.loader), None)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.assertEqual(self.saved, 0)
+        self.assertEqual(tree_snapshots.build("test", 1, self.save, self.loader), "built 1")
+
+    def test_remove_old(self):
+        """Old snapshots are kept for keep_old_secs after they were replaced, not after they were built"""
+        def make_old(name):
+            t = time.time() - tree_snapshots.keep_old_secs - 60
+            os.utime(os.path.join(self.dir, name), (t, t))
+        tree_snapshots.build("test", 1, self.save, self.loader)
+        make_old("test_1")
+        tree_snapshots.build("test", 2, self.save, self.loader)
+        self.assertEqual(
+            sorted(os.listdir(self.dir)),
+            [".test_1.lock", ".test_1.replaced", ".test_2.lock", "test_1", "test_2"])
+        make_old(".test_1.replaced")
+        os.mkdir(os.path.join(self.dir, ".test_2_partial"))
+        make_old(".test_2_partial")
+        tree_snapshots.build("test", 3, self.save, self.loader)
+        self.assertEqual(
+            sorted(os.listdir(self.dir)),
+            [".test_2.lock", ".test_2.replaced", ".test_3.lock", "test_2", "test_3"])
+        # Loading a replaced snapshot (e.g. going back to an earlier tree) makes it current again
+        self.assertEqual(tree_snapshots.load("test", 2, self.loader), "built 2")
+        self.assertNotIn(".test_2.replaced", os.listdir(self.dir))
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTreeSnapshots))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -0,0 +1,116 @@
+"""
+Run with::
+
+    grunt exec:test_server:test_modules_tree_topology.py
+"""
+import random
+import shutil
+import tempfile
+import unittest
+
+import pinpoint
+import tree_topology
+
+
+class TestTreeTopology(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.topology = tree_topology.get()
+        if self.topology is None:
+            self.skipTest("tree_cache.tree_topology is turned off")
+
+    def tearDown(self):
+        db.rollback()
+
+    def test_common_ancestor(self):
+        """Should give the same answers as walking up the tree in the database"""
+        rnd = random.Random(1)
+        leaves = db(db.ordered_leaves.ott != None).select(
+            db.ordered_leaves.ott, orderby=~db.ordered_leaves.popularity, limitby=(0, 50))
+        nodes = db(db.ordered_nodes.ott != None).select(
+            db.ordered_nodes.ott, orderby=~db.ordered_nodes.popularity, limitby=(0, 50))
+        otts = [r.ott for r in leaves] + [r.ott for r in nodes]
+        for n in (2, 2, 3, 5):
+            for i in range(20):
+                sample = rnd.sample(otts, n)
+                self.assertEqual(
+                    pinpoint.common_ancestor_of_otts(sample),
+                    pinpoint._common_ancestor_of_otts_in_db(sample),
+                    sample)
+        with self.assertRaises(ValueError):
+            pinpoint.common_ancestor_of_otts([otts[0], -1])
+
+    def test_lineage(self):
+        """Should give the same answers as walking up real_parent in the database"""
+        rnd = random.Random(1)
+        n_nodes = db(db.ordered_nodes).count()
+        for node_id in [1, n_nodes] + [rnd.randint(1, n_nodes) for _ in range(20)]:
+            self.assertEqual(
+                tree_topology.lineage(node_id), tree_topology._lineage_in_db(node_id), node_id)
+        lineage = tree_topology.lineage(n_nodes)
+        self.assertEqual(lineage[-1], 1)
+        self.assertTrue(all(self.topology.real_parent[id] >= 0 for id in lineage[1:]))
+        self.assertEqual(tree_topology.lineage(n_nodes + 1), [])
+
+    def test_is_within(self):
+        node = db(
+            (db.ordered_nodes.leaf_rgt - db.ordered_nodes.leaf_lft > 10) &
+            (db.ordered_nodes.parent > 0) &
+            (db.ordered_nodes.real_parent >= 0)  # Not a node created to break a polytomy
+        ).select(db.ordered_nodes.ALL, limitby=(0, 1)).first()
+        self.assertTrue(self.topology.is_within(node.id, node.id))
+        self.assertTrue(self.topology.is_within(node.node_rgt, node.id))
+        self.assertTrue(self.topology.is_within(-node.leaf_lft, node.id))
+        self.assertTrue(self.topology.is_within(-node.leaf_rgt, node.id))
+        self.assertTrue(self.topology.is_within(node.id, node.parent))
+        self.assertFalse(self.topology.is_within(node.parent, node.id))
+        self.assertFalse(self.topology.is_within(node.node_rgt + 1, node.id))
+        self.assertFalse(self.topology.is_within(-(node.leaf_rgt + 1), node.id))
+        self.assertFalse(self.topology.is_within(-node.leaf_lft, -node.leaf_rgt))
+        self.assertEqual(self.topology.common_ancestor([-node.leaf_lft, -node.leaf_rgt]), node.id)
+
+    def test_identifier_maps(self):
+        """Should map identifiers to otts as selecting on them in the database"""
+        for src, tables in (('eol', ('ordered_leaves', 'ordered_nodes')), ('iucn', ('ordered_leaves', ))):
+            values = [r[0] for r in db.executesql(
+                "SELECT {0} FROM ordered_leaves WHERE {0} IS NOT NULL LIMIT 200".format(src))]
+            values = [int(v.split("|")[0]) for v in values] if src == 'iucn' else values
+            if len(values) == 0:
+                continue
+            expected = {}
+            for table in tables:
+                for value, ott in db.executesql("SELECT {0}, ott FROM {1} WHERE {0} IN ({2})".format(
+                    src, table, ",".join([db.placeholder] * len(values))), values):
+                    expected[value] = ott
+            self.assertEqual(self.topology.ott_map(src, values + [-1]), expected, src)
+
+    def test_snapshot(self):
+        """A saved and memory-mapped snapshot should give the same answers"""
+        path = tempfile.mkdtemp()
+        try:
+            self.topology.save(path)
+            loaded = tree_topology.TreeTopology.load(path, tree_topology._tree_size())
+            for name in ('parent', 'node_rgt', 'leaf_parent', 'ott_sorted', 'ott_ozids'):
+                self.assertEqual(list(getattr(loaded, name)), list(getattr(self.topology, name)), name)
+            n_nodes = len(self.topology.parent) - 1
+            rnd = random.Random(1)
+            for _ in range(20):
+                ozids = [rnd.randint(1, n_nodes) for _ in range(3)]
+                self.assertEqual(loaded.common_ancestor(ozids), self.topology.common_ancestor(ozids))
+            with self.assertRaises(ValueError):
+                tree_topology.TreeTopology.load(path, [n_nodes + 1, 0])
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if current.globalenv['is_testing'] != True:
+        raise RuntimeError("Do not run tests in production environments, ensure is_testing = True")
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTreeTopology))
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -20,6 +20,7 @@ from sponsorship import (
 from usernames import (
     find_username,
     email_for_username,
+    emails_for_usernames,
     usernames_associated_to_email,
     donor_name_for_username,
 )
@@ -295,6 +296,11 @@ class TestUsername(unittest.TestCase):
         self.assertEqual(r_alfred_3.username, r_alfred_1.username)
         self.assertEqual(email_for_username(r_alfred_1.username), 'alfred@unittest.example.com')
 
+        # Looking up several at once gives the same, leaving out those with no e-mail address
+        self.assertEqual(emails_for_usernames([r.username, r_alfred_1.username], batch_size=1), {
+            r_alfred_1.username: 'alfred@unittest.example.com',
+        })
+
     def test_usernames_associated_to_email(self):
         # Alfred changed their e-mail address to something more formal
         otts = util.find_unsponsored_otts(4, allow_banned=True)
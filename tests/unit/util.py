@@ -23,12 +23,14 @@ def grunt_path():
     raise RuntimeError("Cannot find grunt executable")
 
 
-def call_controller(module, endpoint, vars={}, args=[], method=None, username=None):
+def call_controller(module, endpoint, vars={}, args=[], method=None, username=None, env={}):
     """Set up a semi-sane request environment, call a controller endpoint"""
     # Create request for given params
     current.request = Request(dict())
     for (k, v) in vars.items():
         current.request.vars[k] = v
+    for (k, v) in env.items():
+        current.request.env[k] = v
     current.request.args = args
     if method:
         current.request.env.request_method = method